@@ -0,0 +1,118 @@
+import os
+import hashlib
+from time import time
+import numpy as np
+import pandas as pd
+import h5py
+
+
+def hash_update(h, obj):
+    '''
+    hash_update(h, obj)
+
+    feeds obj into the hashlib object h. arrays are hashed by dtype, shape and content, pandas tables by
+    column names, index and values, lists/tuples/dicts recursively and everything else by its repr.
+    '''
+    if isinstance(obj, pd.DataFrame):
+        hash_update(h, [list(obj.columns), obj.index.values, obj.values])
+    elif isinstance(obj, np.ndarray) and obj.dtype==object:
+        hash_update(h, obj.tolist())
+    elif isinstance(obj, np.ndarray):
+        h.update(str(obj.dtype) + str(obj.shape))
+        h.update(np.ascontiguousarray(obj).data)
+    elif isinstance(obj, (list, tuple)):
+        h.update('%s%d' % (type(obj).__name__, len(obj)))
+        for o in obj:
+            hash_update(h, o)
+    elif isinstance(obj, dict):
+        h.update('dict%d' % len(obj))
+        for k in sorted(obj.keys()):
+            hash_update(h, k)
+            hash_update(h, obj[k])
+    else:
+        h.update(repr(obj))
+
+
+def content_key(*parts):
+    '''returns a hex digest that identifies the content of all the parts (see hash_update).'''
+    h = hashlib.sha1()
+    for p in parts:
+        hash_update(h, p)
+    return h.hexdigest()
+
+
+class feature_map_cache(object):
+    '''
+    A content-addressed on-disk cache of feature map dictionaries (e.g. the output of
+    gabor_feature_maps.create_feature_maps, or dnn layer activations).
+
+    Entries are hdf5 files named after the content_key of whatever determines the feature maps (filter bank,
+    stimuli, parameters). Every hit refreshes the modification time of the entry, and the least recently used
+    entries are deleted whenever the cache grows beyond max_bytes.
+
+    cache = feature_map_cache('/scratch/fmap_cache', max_bytes=100*1024**3)
+    feat_dict = gfm.create_feature_maps(stim_data, cache=cache)
+    '''
+    def __init__(self, cache_dir, max_bytes=50*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, *parts):
+        return content_key(*parts)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.h5')
+
+    def get(self, key):
+        '''returns the cached feature map dictionary, or None on a miss.'''
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path, None) # mark as recently used
+        feature_dict = {}
+        with h5py.File(path, 'r') as hf:
+            for name in hf.keys():
+                feature_dict[hf[name].attrs['key']] = hf[name][...]
+        return feature_dict
+
+    def put(self, key, feature_dict):
+        '''stores the feature map dictionary under key, then trims the cache to max_bytes.'''
+        path = self.path(key)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with h5py.File(tmp_path, 'w') as hf:
+            for i,(k,v) in enumerate(feature_dict.items()):
+                hf.create_dataset('%d' % i, data=v)
+                hf['%d' % i].attrs['key'] = k
+        os.rename(tmp_path, path) # atomic, readers never see a partial entry
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        '''deletes the least recently used entries until the cache fits in max_bytes. The entry keep is never deleted.'''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.h5'):
+                path = os.path.join(self.cache_dir, name)
+                entries += [(os.path.getmtime(path), os.path.getsize(path), path),]
+        total = sum([e[1] for e in entries])
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if keep is not None and path==self.path(keep):
+                continue
+            os.remove(path)
+            total -= size
+            print 'evicted %s from feature map cache' % os.path.basename(path)
+
+    def get_or_create(self, key, create_fn, *args, **kwargs):
+        '''returns the cached entry for key if there is one, otherwise calls create_fn(*args, **kwargs) and caches its result.'''
+        feature_dict = self.get(key)
+        if feature_dict is not None:
+            print 'feature map cache hit %s' % key
+            return feature_dict
+        start = time()
+        feature_dict = create_fn(*args, **kwargs)
+        self.put(key, feature_dict)
+        print 'feature map cache miss %s, created in %f s.' % (key, time()-start)
+        return feature_dict
@@ -0,0 +1,90 @@
+import numpy as np
+
+
+def fft_size(n):
+    '''smallest integer >= n whose only prime factors are 2, 3 and 5, for which the FFT is fast.'''
+    m = n
+    while True:
+        k = m
+        for p in (2,3,5):
+            while k % p == 0:
+                k //= p
+        if k == 1:
+            return m
+        m += 1
+
+def select_convolution_mode(n_pix, f_pix, fft_cost_factor=8.):
+    '''
+    select_convolution_mode(n_pix, f_pix)
+
+    returns 'fft' or 'direct' for a full convolution of an n_pix image by an f_pix filter.
+    the direct convolution costs f_pix**2 multiply-adds per output pixel, the fft convolution
+    costs on the order of log2 of the padded image size (the image spectrum being shared by every filter of the group).
+    fft_cost_factor is the relative cost of one fft operation to one direct multiply-add.
+    '''
+    n_fft = fft_size(n_pix+f_pix-1)
+    return 'fft' if f_pix**2 > fft_cost_factor*np.log2(n_fft**2) else 'direct'
+
+def threaded_convolution_mode(conv_mode,n_workers=1):
+    '''
+    threaded_convolution_mode(conv_mode,n_workers=1)
+
+    the convolution mode ('direct', 'fft' or 'auto') to use with n_workers threads. the compiled theano function of the
+    direct convolution is not thread-safe, so with n_workers > 1 'auto' becomes 'fft' and 'direct' is an error.
+    '''
+    if n_workers > 1:
+        assert conv_mode!='direct', "the direct (theano) convolution cannot run in multiple threads, use conv_mode='fft' or 'auto'"
+        if conv_mode=='auto':
+            return 'fft'
+    return conv_mode
+
+def fft_batch_size(n_filters,n_colors,n_fft,complex_cell=True,max_bytes=256*1024**2):
+    '''
+    fft_batch_size(n_filters,n_colors,n_fft,complex_cell=True,max_bytes=256*1024**2)
+
+    number of stimuli per batch of make_fft_gabor_function whose complex128 temporaries fit in max_bytes:
+    the stimulus spectra (n_colors), their products with the filter spectra summed over the colors (n_filters)
+    and the inverse transforms (n_filters), for n_fft x n_fft transforms (half of them for the real transforms).
+    '''
+    n_freq = n_fft if complex_cell else n_fft//2+1
+    bytes_per_stimulus = 16*n_fft*(n_colors*n_freq + n_filters*n_freq + n_filters*n_fft)
+    return int(max(1, max_bytes // bytes_per_stimulus))
+
+def make_fft_gabor_function(filter_stack,n_pix,complex_cell=True,batch_size=None,max_bytes=256*1024**2):
+    '''
+    make_fft_gabor_function(filter_stack,n_pix,complex_cell=True,batch_size=None,max_bytes=256*1024**2)
+
+    same as make_apply_gabor_function, but the convolution is done by multiplication in the Fourier domain.
+    the spectra of the filters are precomputed once here. each image spectrum is computed once and multiplied with
+    all the filter spectra, contracting the color axis without a stimuli x filters x colors temporary.
+    for complex cells, the real and imaginary parts of the filters are applied at once by
+    using the complex filter directly, since |conv(x, re) + 1j*conv(x, im)| is the complex cell response.
+
+    filter_stack ~ D x n_colors x f_pix x f_pix, complex if complex_cell
+    n_pix ~ resolution of the stimuli that will be filtered
+    batch_size ~ stimuli per batch. by default, as many as keep the temporaries under max_bytes (see fft_batch_size).
+
+    returns a function of the stimuli (T x n_colors x n_pix x n_pix) that returns the full
+    (T x D x n_pix+f_pix-1 x n_pix+f_pix-1) feature maps, computed batch_size stimuli at a time.
+    '''
+    D, n_colors, f_pix = filter_stack.shape[:3]
+    n_full = n_pix+f_pix-1
+    s = (fft_size(n_full),)*2
+    if batch_size is None:
+        batch_size = fft_batch_size(D, n_colors, s[0], complex_cell=complex_cell, max_bytes=max_bytes)
+    if complex_cell:
+        filter_spectra = np.fft.fft2(filter_stack, s=s)
+    else:
+        filter_spectra = np.fft.rfft2(np.real(filter_stack), s=s)
+
+    def make_feature_maps(stimuli):
+        feature_maps = np.zeros((len(stimuli),D,n_full,n_full), dtype='float32')
+        for t in range(0, len(stimuli), batch_size):
+            if complex_cell:
+                spectra = np.fft.fft2(stimuli[t:t+batch_size], s=s)
+                feature_maps[t:t+batch_size] = np.abs(np.fft.ifft2(np.einsum('bcxy,dcxy->bdxy', spectra, filter_spectra))[:,:,:n_full,:n_full])
+            else:
+                spectra = np.fft.rfft2(stimuli[t:t+batch_size], s=s)
+                feature_maps[t:t+batch_size] = np.fft.irfft2(np.einsum('bcxy,dcxy->bdxy', spectra, filter_spectra), s=s)[:,:,:n_full,:n_full]
+        return feature_maps
+    return make_feature_maps
@@ -3,8 +3,11 @@ import pandas as pd
 from theano import tensor as tnsr
 from theano import function, scan
 from time import time
+import h5py
+from multiprocessing.pool import ThreadPool
 from features import make_complex_gabor, make_gabor
-from PIL import Image
+from resampling import resample_stack, make_image_pyramid
+from fft_convolution import fft_size, select_convolution_mode, threaded_convolution_mode, make_fft_gabor_function
 from skimage.transform import resize
 
 
@@ -165,54 +168,233 @@ def make_apply_gabor_function(filter_stack_shape,complex_cell=True):
 
     return make_feature_maps
 
-def create_gabor_feature_map(image_stack,filter_stack,freq_table,complex_cell=True,interp_order=3):
+
+def resolved_convolution_modes(filter_stack,freq_table,conv_mode='auto',n_workers=1):
+    '''
+    resolved_convolution_modes(filter_stack,freq_table,conv_mode='auto',n_workers=1)
+
+    returns the list of (n_pix, mode) that create_gabor_feature_map uses for every resolution group, 'fft' or 'direct'.
+    with n_workers > 1, 'auto' resolves to 'fft' everywhere (see threaded_convolution_mode).
+    '''
+    conv_mode = threaded_convolution_mode(conv_mode, n_workers)
+    f_pix = filter_stack.shape[2]
+    return [(n_pix, select_convolution_mode(n_pix, f_pix) if conv_mode=='auto' else conv_mode) for n_pix,_ in resolution_groups(freq_table)]
+
+def resolution_groups(freq_table):
+    '''
+    resolution_groups(freq_table)
+
+    groups the rows of freq_table by the resolution (pix per stimulus) of the feature maps they produce.
+    all the orientations and phases of a given spatial frequency share the same resolution.
+
+    returns a list of (n_pix, positions) in increasing n_pix, where positions are the row positions
+    (i.e. indices into filter_stack) of the filters at that resolution.
+    '''
+    resolutions = np.round(freq_table['pix per stimulus'].values).astype('int')
+    return [(int(n_pix), np.where(resolutions==n_pix)[0]) for n_pix in np.unique(resolutions)]
+
+def resize_stimuli(image_stack,n_pix,interp_order=3):
+    '''
+    resize_stimuli(image_stack,n_pix,interp_order=3)
+
+    image_stack ~ T x n_colors x s_pix x s_pix
+    returns the stimuli resized to T x n_colors x n_pix x n_pix, with an anti-aliased interpolation
+    of order interp_order (0, 1 or 3). see resampling.resample_stack.
+    '''
+    return resample_stack(image_stack, n_pix, interp_order=interp_order, dtype=np.float32)
+
+def make_group_feature_map_functions(filter_stack,freq_table,complex_cell=True,conv_mode='auto'):
+    '''
+    make_group_feature_map_functions(filter_stack,freq_table,complex_cell=True,conv_mode='auto')
+
+    builds, once, the functions that apply every filter of a resolution group to stimuli at that resolution.
+
+    returns a list of (n_pix, positions, mode, apply_group) in increasing n_pix, where apply_group maps the stimuli
+    resized to n_pix (T x n_colors x n_pix x n_pix) to the cropped feature maps (T x len(positions) x n_pix x n_pix).
+    '''
+    ##this will be a theano function, compiled only if some resolution uses the direct convolution.
+    ##the number of filters varies from one resolution group to the next.
+    apply_filter = None
+    f_pix = filter_stack.shape[2]
+    groups = []
+    for n_pix,group in resolution_groups(freq_table):
+        ##every filter at this resolution (all orientations and phases) is applied in one call to the same resized stimuli
+        these_filters = filter_stack[group]
+        mode = select_convolution_mode(n_pix, f_pix) if conv_mode=='auto' else conv_mode
+        if mode=='fft':
+            convolve = make_fft_gabor_function(these_filters, n_pix, complex_cell=complex_cell)
+        else:
+            if apply_filter is None:
+                apply_filter = make_apply_gabor_function((None,)+filter_stack.shape[1:], complex_cell=complex_cell)
+            if complex_cell:
+                filter_args = (np.real(these_filters).astype('float32'), np.imag(these_filters).astype('float32'))
+            else:
+                filter_args = (these_filters.astype('float32'),)
+            convolve = lambda stimuli, filter_args=filter_args: apply_filter(stimuli, *filter_args)
+
+        def apply_group(stimuli, convolve=convolve, n_pix=n_pix):
+            tmp_feature_map = convolve(stimuli)
+            ##crop because convolution
+            new_size = tmp_feature_map.shape[2]
+            crop_start = np.round((new_size-n_pix)/2.).astype('int')
+            crop_stop = crop_start+n_pix
+            return tmp_feature_map[:, :, crop_start:crop_stop, crop_start:crop_stop]
+        groups += [(n_pix, group, mode, apply_group),]
+    return groups
+
+def create_gabor_feature_map(image_stack,filter_stack,freq_table,complex_cell=True,interp_order=3,conv_mode='auto',
+                             n_workers=1,chunk_size=None,hook=None):
     '''
     image_stack ~ T x n_colors x s_pix x s_pix
     filter_stack ~ D x n_colrs x f_pix x f_pix
+    conv_mode ~ 'direct' (theano conv2d), 'fft' or 'auto'. with 'auto', the mode is chosen per resolution
+                by select_convolution_mode, or is 'fft' everywhere with n_workers > 1.
+    interp_order ~ order of the anti-aliased interpolation used to resize the stimuli (0, 1 or 3)
+    n_workers ~ number of threads. with n_workers > 1, the resolution groups and chunks of chunk_size images
+                (default: T // n_workers) are processed in parallel, each writing into its own slice of the
+                preallocated feature maps. this relies on the resize and fft kernels releasing the GIL, and
+                needs the fft convolution since the compiled theano function is not thread-safe: 'auto' then
+                resolves to 'fft', and an explicit conv_mode='direct' raises an AssertionError.
+    hook ~ optional callback, called as hook(event, **fields) with the timing and size of each phase
+           ('allocate', 'resize', 'convolve', 'parallel'), e.g. functools.partial(instrumentation.emit, 'gabor')
     
     '''
+    if hook is None:
+        hook = lambda event, **fields: None
     
     ##initialize feature dictionary
     T = image_stack.shape[0]
     n_color_channels = image_stack.shape[1]
     feature_indices = freq_table.index
-    feature_dict = {}    
-    
-    ##this will be a theano function
-    apply_filter = make_apply_gabor_function(filter_stack.shape, complex_cell=complex_cell)
+    feature_dict = {}
+
+    conv_mode = threaded_convolution_mode(conv_mode, n_workers)
+    groups = make_group_feature_map_functions(filter_stack, freq_table, complex_cell=complex_cell, conv_mode=conv_mode)
 
     ##allocate memory first
     print 'allocating memory for feature maps'
     for ii in feature_indices:
         n_pix = np.round(freq_table.loc[ii,'pix per stimulus']).astype('int')
         feature_dict[ii] = np.zeros((T,n_color_channels,n_pix,n_pix)).astype('float32')
-    
+    hook('allocate', bytes=sum([fm.nbytes for fm in feature_dict.values()]))
+
+    ##the stimuli are resized to every resolution at once, one chunk of images at a time
+    if chunk_size is None:
+        chunk_size = max(1, T // n_workers)
+    chunks = [slice(t, t+chunk_size) for t in range(0, T, chunk_size)]
+    resolutions = [g[0] for g in groups]
+    def pyramid_task(ts):
+        return make_image_pyramid(image_stack[ts], resolutions, interp_order=interp_order)
+
+    def apply_task(task):
+        (n_pix,group,mode,apply_group), k = task
+        group_feature_maps = apply_group(pyramids[k][n_pix])
+        for jj,ii in enumerate(group):
+            feature_dict[feature_indices[ii]][chunks[k],:,:,:] = group_feature_maps[:, jj:jj+1]
+
     print 'constructing feature maps'
-    for ii,fidx in enumerate(feature_indices):
-        this_filter = filter_stack[ii,np.newaxis,:,:,:]
+    if n_workers > 1:
         start = time()
-        n_pix = feature_dict[ii].shape[2]  ##resolution of the feature map
-        stimuli = np.zeros((T,n_color_channels,n_pix,n_pix)).astype('float32')
-        for t in range(T):
-            for c in range(n_color_channels):
-                stimuli[t,c,:,:] = np.array(Image.fromarray(image_stack[t,c,:,:]).resize((n_pix,n_pix)),dtype='float32') #resize(image_stack[t,c,:,:], (n_pix,n_pix),order=interp_order)
-        if complex_cell:
-            tmp_feature_map = apply_filter(stimuli,
-                                            np.real(this_filter).astype('float32'),
-                                            np.imag(this_filter).astype('float32'))
-        else:
-            tmp_feature_map = apply_filter(stimuli,this_filter.astype('float32'))
-        
-        ##crop because convolution
-        new_size = tmp_feature_map.shape[2]
-        crop_start = np.round((new_size-n_pix)/2.).astype('int')
-        crop_stop = crop_start+n_pix
-        feature_dict[ii][:,:,:,:] = np.copy(tmp_feature_map[:, :, crop_start:crop_stop, crop_start:crop_stop])
-        print 'feature %s took %f s.' %(ii,time()-start)
-        
+        ##largest resolutions first, for load balancing
+        tasks = [(g, k) for g in groups[::-1] for k in range(len(chunks))]
+        pool = ThreadPool(n_workers)
+        try:
+            pyramids = pool.map(pyramid_task, chunks, chunksize=1)
+            pool.map(apply_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        print '%d resolutions in %d tasks on %d threads took %f s.' %(len(groups),len(tasks),n_workers,time()-start)
+        hook('parallel', seconds=time()-start, tasks=len(tasks), n_workers=n_workers)
+    else:
+        start = time()
+        pyramids = map(pyramid_task, chunks)
+        print 'resizing to %d resolutions took %f s.' %(len(resolutions),time()-start)
+        hook('resize', seconds=time()-start, resolutions=len(resolutions),
+             bytes=image_stack.nbytes+sum([p.nbytes for pyramid in pyramids for p in pyramid.values()]))
+        for g in groups:
+            start = time()
+            for k in range(len(chunks)):
+                apply_task((g, k))
+            print 'resolution %d (%d features, %s) took %f s.' %(g[0],len(g[1]),g[2],time()-start)
+            hook('convolve', seconds=time()-start, n_pix=g[0], features=len(g[1]), mode=g[2],
+                 bytes=T*n_color_channels*len(g[1])*g[0]**2*4)
+
     return feature_dict
 
 
+def iterate_gabor_feature_maps(image_batches,filter_stack,freq_table,complex_cell=True,interp_order=3,conv_mode='auto'):
+    '''
+    iterate_gabor_feature_maps(image_batches,filter_stack,freq_table,complex_cell=True,interp_order=3,conv_mode='auto')
+
+    generator version of create_gabor_feature_map. only one batch of images and its feature maps are held in memory.
+
+    image_batches ~ an iterable of image batches, each b x n_colors x s_pix x s_pix
+
+    yields, for each batch, a list of (n_pix, positions, feature_maps) in increasing n_pix where feature_maps
+    is b x len(positions) x n_pix x n_pix and positions are the rows of freq_table at that resolution.
+    '''
+    groups = make_group_feature_map_functions(filter_stack, freq_table, complex_cell=complex_cell, conv_mode=conv_mode)
+    resolutions = [g[0] for g in groups]
+    for images in image_batches:
+        pyramid = make_image_pyramid(images, resolutions, interp_order=interp_order)
+        yield [(n_pix, group, apply_group(pyramid[n_pix])) for n_pix,group,mode,apply_group in groups]
+
+
+def create_gabor_feature_map_store(store_file,image_batches,filter_stack,freq_table,complex_cell=True,interp_order=3,conv_mode='auto',
+                                   act_func=None,dtype=np.float32,compression=None,hook=None):
+    '''
+    create_gabor_feature_map_store(store_file,image_batches,filter_stack,freq_table,...)
+
+    computes the feature maps of image_batches one batch at a time and appends them to an hdf5 file, so that
+    memory use does not depend on the number of images.
+
+    the file contains one dataset per resolution, in increasing resolution, named 'fmaps_%d' % r, each
+    T x nf_r x n_pix x n_pix, chunked by image batch and by feature map. this is the same layout (and order) as the
+    fmaps returned by data_preparation.preprocess_gabor_feature_maps, and the datasets can be passed as such to
+    fwrf.model_space_tensor (see data_preparation.load_feature_map_store). with n_colors > 1, create_gabor_feature_map
+    holds every feature map in its n_colors channels (the convolution sums over the colors), which
+    preprocess_gabor_feature_maps concatenates: the store repeats every feature map n_colors times in the same way, so
+    that nf_r = n_colors x the number of filters at that resolution in both cases.
+
+    act_func ~ optional nonlinearity applied to the feature maps before they are written (as in preprocess_gabor_feature_maps)
+    compression ~ optional h5py compression filter (e.g. 'lzf')
+    hook ~ optional callback, called as hook('store', **fields) after every batch (see create_gabor_feature_map)
+
+    returns the list of the datasets shapes.
+    '''
+    if hook is None:
+        hook = lambda event, **fields: None
+    nonlinearity = act_func
+    if nonlinearity is None:
+        nonlinearity = lambda x: x
+    feature_indices = freq_table.index
+    n_colors = filter_stack.shape[1]
+    T = 0
+    with h5py.File(store_file, 'w') as hf:
+        datasets = None
+        for batch in iterate_gabor_feature_maps(image_batches, filter_stack, freq_table, complex_cell=complex_cell,
+                                                interp_order=interp_order, conv_mode=conv_mode):
+            start = time()
+            b = batch[0][2].shape[0]
+            if datasets is None:
+                datasets = []
+                for r,(n_pix,group,fmaps) in enumerate(batch):
+                    nf_r = len(group)*n_colors
+                    ds = hf.create_dataset('fmaps_%d' % r, shape=(0,nf_r,n_pix,n_pix), maxshape=(None,nf_r,n_pix,n_pix),
+                                           chunks=(b,1,n_pix,n_pix), dtype=dtype, compression=compression)
+                    ds.attrs['feature_keys'] = np.repeat(np.asarray(feature_indices[group]), n_colors)
+                    datasets += [ds,]
+                hf.attrs['resolution_count'] = len(datasets)
+            for ds,(n_pix,group,fmaps) in zip(datasets, batch):
+                ds.resize(T+b, axis=0)
+                ds[T:T+b] = nonlinearity(np.repeat(fmaps.astype(dtype), n_colors, axis=1)) ##the channels of create_gabor_feature_map
+            T += b
+            print 'stored %d images (%f s.)' % (T, time()-start)
+            hook('store', seconds=time()-start, images=b, bytes=sum([fmaps.size for _,_,fmaps in batch])*n_colors*np.dtype(dtype).itemsize)
+        return [ds.shape for ds in datasets]
+
+
 class gabor_feature_maps(object):
     def __init__(self,orientations,deg_per_stimulus,cycles_per_deg,
                      freq_spacing='log',
@@ -250,17 +432,48 @@ class gabor_feature_maps(object):
     
     
     ###if 
-    def create_feature_maps(self,image_stack,interp_order=3):
+    def create_feature_maps(self,image_stack,interp_order=3,conv_mode='auto',cache=None,n_workers=1,hook=None):
 	'''
 	image_stack ~ T x n_colors x s_pix x s_pix
 	filter_stack ~ D x n_colrs x f_pix x f_pix
+	conv_mode ~ 'direct', 'fft' or 'auto'
+	n_workers ~ number of threads (see create_gabor_feature_map)
+	hook ~ optional event callback (see create_gabor_feature_map)
+	cache ~ optional feature_cache.feature_map_cache. the feature maps are then looked up by the content of the
+	        gabor table, the filter stack, the stimuli, interp_order and the resolved convolution
+	        modes, and only computed on a miss.
 	
 	'''
+        if cache is not None:
+            ##the direct and fft convolutions only agree to float32 precision, so the resolved modes are part of the key
+            modes = resolved_convolution_modes(self.filter_stack, self.gbr_table, conv_mode=conv_mode, n_workers=n_workers)
+            key = cache.key('gabor', self.gbr_table, self.filter_stack, image_stack, interp_order, self.complex_cell, modes)
+            return cache.get_or_create(key, self.create_feature_maps, image_stack, interp_order=interp_order, conv_mode=conv_mode,
+                                       n_workers=n_workers, hook=hook)
         return create_gabor_feature_map(image_stack,
                                    self.filter_stack,
                                    self.gbr_table,
                                    complex_cell=self.complex_cell,
-                                   interp_order=interp_order)
+                                   interp_order=interp_order,
+                                   conv_mode=conv_mode,
+                                   n_workers=n_workers,
+                                   hook=hook)
+
+    def create_feature_map_store(self,store_file,image_batches,interp_order=3,conv_mode='auto',act_func=None,compression=None,hook=None):
+        '''
+        streaming version of create_feature_maps that writes the feature maps grouped by resolution
+        to an hdf5 file. see create_gabor_feature_map_store.
+        '''
+        return create_gabor_feature_map_store(store_file,
+                                   image_batches,
+                                   self.filter_stack,
+                                   self.gbr_table,
+                                   complex_cell=self.complex_cell,
+                                   interp_order=interp_order,
+                                   conv_mode=conv_mode,
+                                   act_func=act_func,
+                                   compression=compression,
+                                   hook=hook)
     
     
     def sensitivity(self,feat_dict,parameter):
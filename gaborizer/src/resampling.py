@@ -0,0 +1,75 @@
+import numpy as np
+
+
+##interpolation kernels by interp_order, with their support (half-width) in input pixels
+def _box(x):
+    return ((x > -0.5) & (x <= 0.5)).astype(x.dtype)
+
+def _triangle(x):
+    return np.maximum(1. - np.abs(x), 0.)
+
+def _cubic(x, a=-0.5):
+    ##Keys cubic convolution kernel, as in PIL's BICUBIC
+    x = np.abs(x)
+    return np.where(x < 1., ((a+2.)*x - (a+3.))*x*x + 1.,
+                    np.where(x < 2., ((a*x - 5.*a)*x + 8.*a)*x - 4.*a, 0.))
+
+interpolation_kernels = {0: (_box, 0.5), 1: (_triangle, 1.), 3: (_cubic, 2.)}
+
+
+def resampling_matrix(n_in, n_out, interp_order=3, dtype=np.float32):
+    '''
+    resampling_matrix(n_in, n_out, interp_order=3)
+
+    returns the (n_out, n_in) matrix R such that R.dot(x) resamples the signal x of length n_in to length n_out.
+    interp_order ~ 0 (nearest/box), 1 (linear) or 3 (cubic).
+    when downsampling, the kernel is stretched by n_in/n_out so that it also acts as the anti-aliasing filter
+    (the same scheme as PIL's resize). rows are normalized so that a constant image stays constant.
+    '''
+    assert interp_order in interpolation_kernels, "interp_order must be one of %s" % (sorted(interpolation_kernels.keys()),)
+    kernel, support = interpolation_kernels[interp_order]
+    scale = float(n_in) / n_out
+    stretch = max(scale, 1.)
+    centers = (np.arange(n_out) + 0.5) * scale - 0.5
+    R = kernel((np.arange(n_in)[np.newaxis,:] - centers[:,np.newaxis]) / stretch)
+    R[np.abs(np.arange(n_in)[np.newaxis,:] - centers[:,np.newaxis]) > support*stretch] = 0.
+    R /= np.sum(R, axis=1, keepdims=True)
+    return R.astype(dtype)
+
+
+def resample_stack(image_stack, n_pix, interp_order=3, dtype=np.float32):
+    '''
+    resample_stack(image_stack, n_pix, interp_order=3)
+
+    image_stack ~ T x n_colors x s_pix x s_pix
+    returns the whole stack resampled to T x n_colors x n_pix x n_pix by two separable matrix products.
+    '''
+    s_pix = image_stack.shape[2]
+    assert image_stack.shape[3]==s_pix, "Non square images not supported"
+    if s_pix==n_pix:
+        return np.asarray(image_stack, dtype=dtype)
+    R = resampling_matrix(s_pix, n_pix, interp_order=interp_order, dtype=dtype)
+    tmp = np.dot(np.asarray(image_stack, dtype=dtype), R.T) ##T x n_colors x s_pix x n_pix
+    return np.einsum('ij,tcjk->tcik', R, tmp)
+
+
+def make_image_pyramid(image_stack, resolutions, interp_order=3, dtype=np.float32):
+    '''
+    make_image_pyramid(image_stack, resolutions, interp_order=3)
+
+    builds every resolution of the pyramid for the whole stack at once, from the largest to the smallest.
+    each level is resampled from the smallest level already built that is at least twice its size (or from the
+    original stack), so that the cost of the small levels does not depend on the size of the original images
+    while every level still goes through a full anti-aliasing filter.
+
+    returns a dictionary {n_pix: T x n_colors x n_pix x n_pix}
+    '''
+    pyramid = {}
+    s_pix = image_stack.shape[2]
+    for n_pix in sorted(set(resolutions), reverse=True):
+        sources = [r for r in pyramid.keys() if r >= 2*n_pix]
+        if len(sources)>0:
+            pyramid[n_pix] = resample_stack(pyramid[min(sources)], n_pix, interp_order=interp_order, dtype=dtype)
+        else:
+            pyramid[n_pix] = resample_stack(image_stack, n_pix, interp_order=interp_order, dtype=dtype)
+    return pyramid
@@ -0,0 +1,188 @@
+'''
+Choose the batches of fwrf.model_space_tensor and fwrf.learn_params under a memory budget.
+
+The planners enumerate valid batch sizes (the candidate batch no longer has to divide nt, the residual batch is padded),
+estimate the memory and the runtime of each with a simple cost model, and return the fastest plan that fits, e.g.
+
+    plan = batch_planner.plan_learn_params(n, nf, nv, nt, bn=200, num_epochs=20, val_test_size=400, budget=32*1024**3)
+    ... = fwrf.learn_params(mst_data, voxels, w_params, batches=plan['batches'], ...)
+
+The cost model is (calls x call_overhead + flops / flop_rate + bytes uploaded / bandwidth + compilations x compile_time).
+Its constants default to conservative values and can be measured on the current machine with calibrate().
+'''
+import sys
+import numpy as np
+
+
+fpX = np.float32
+
+default_costs = {
+    'call_overhead': 2e-4,  # seconds per compiled function call
+    'flop_rate': 2e9,       # floating point operations per second
+    'bandwidth': 2e9,       # bytes per second for host to device uploads
+    'compile_time': 0.5,    # seconds per theano compilation
+}
+
+########################################################################
+###              BATCH SIZES                                         ###
+########################################################################
+
+def candidate_sizes(total, min_size=1):
+    '''the batch sizes worth trying for an axis of length total: its divisors, the powers of two below it, and total.'''
+    total = int(total)
+    sizes = set([d for d in range(1, int(np.sqrt(total))+1) if total % d==0])
+    sizes |= set([total // d for d in sizes])
+    sizes |= set([2**k for k in range(int(np.log2(total))+1)])
+    return sorted([s for s in sizes if min_size<=s<=total])
+
+def num_batches(total, size):
+    return (total + size - 1) // size
+
+
+########################################################################
+###              MEMORY AND RUNTIME MODELS                           ###
+########################################################################
+
+def model_space_tensor_cost(n, fmaps_sizes, nt, bn, bt, costs=None):
+    '''
+    Estimated (host_bytes, device_bytes, seconds) of fwrf.model_space_tensor with batches=(bn, bt) for feature maps
+    of shapes fmaps_sizes [(n, nf_r, n_pix, n_pix), ...] and nt candidates.
+    '''
+    c = dict(default_costs, **(costs or {}))
+    nf = sum([fs[1] for fs in fmaps_sizes])
+    pix = sum([fs[2]*fs[3] for fs in fmaps_sizes])
+    fpix = sum([fs[1]*fs[2]*fs[3] for fs in fmaps_sizes])
+    nbt = num_batches(nt, bt)
+    host = 4*n*nf*nt + 4*bn*nf*bt + 3*8*bt*pix          # output, one returned batch, gaussian construction
+    device = 4*bt*pix + 4*bn*fpix + 2*4*bn*nf*bt          # pooling fields, input batch, output batch and temporaries
+    calls = nbt * num_batches(n, bn)
+    flops = 2. * n * nbt*bt * fpix
+    uploads = float(nbt) * (4*bt*pix + 4*n*fpix)
+    seconds = c['compile_time'] + calls*c['call_overhead'] + flops/c['flop_rate'] + uploads/c['bandwidth']
+    return host, device, seconds
+
+
+def learn_params_cost(n, nf, nv, nt, bn, bv, bt, num_epochs=1, val_test_size=0, output_val_scores=-1, num_hyper=1, costs=None,
+                      input_rows=None, memmap=False):
+    '''
+    Estimated (host_bytes, device_bytes, seconds) of fwrf.learn_params with batches=(bn, bv, bt) for n fitted rows of a
+    (input_rows, nf, 1, nt) model space tensor (input_rows defaults to n, more when fitting a subset with rows=),
+    nv voxels and num_hyper (lr, l2) combinations. The host memory includes the input model space tensor, unless it is
+    a memmap, which learn_params only reads one candidate batch at a time.
+    '''
+    c = dict(default_costs, **(costs or {}))
+    input_rows = input_rows or n
+    nbv, nbt = num_batches(nv, bv), num_batches(nt, bt)
+    bth = bt*num_hyper
+    scores = {-1: nv*nt, 0: 0}.get(output_val_scores, bv*max(output_val_scores, 0)*nt)
+    ## input (unless memmapped), voxels and their shuffled rows, val_scores, shuffled and padded candidate batch
+    host = (0 if memmap else 4*input_rows*nf*nt) + 4*(input_rows+n)*nv + 4*num_epochs*scores + 2*4*n*nf*bt
+    device = 4*n*nf*bt + 4*n*bv + 3*4*(nf+1)*bv*bth + 3*4*bn*bv*bth + 4*bn*nf*bth  # data, params/grads/init, activations
+    calls = num_batches(n-val_test_size, bn) + num_batches(val_test_size, bn)
+    flops = 3 * 2. * n * nf * bv * bth                                 # forward and backward pass over one epoch
+    seconds = c['compile_time'] + nbv * (4.*n*bv/c['bandwidth'] + nbt * (4.*n*nf*bt/c['bandwidth'] + \
+        num_epochs * (calls*c['call_overhead'] + flops/c['flop_rate'])))
+    return host, device, seconds
+
+
+########################################################################
+###              PLANNERS                                            ###
+########################################################################
+
+def _fits(host, device, budget, device_budget):
+    if device_budget is None: # the device is the cpu
+        return host + device <= budget
+    return host <= budget and device <= device_budget
+
+
+def plan_model_space_tensor(n, fmaps_sizes, nt, budget, device_budget=None, costs=None, verbose=True):
+    '''
+    Fastest batches=(bn, bt) of fwrf.model_space_tensor within budget bytes of RAM (and device_budget bytes of VRAM,
+    if the theano device is a gpu). Returns a dict with the batches and their estimated memory and runtime.
+    '''
+    plans = []
+    for bt in candidate_sizes(nt):
+        for bn in candidate_sizes(n):
+            host, device, seconds = model_space_tensor_cost(n, fmaps_sizes, nt, bn, bt, costs=costs)
+            if _fits(host, device, budget, device_budget):
+                plans += [{'batches': (bn, bt), 'host_bytes': host, 'device_bytes': device, 'seconds': seconds},]
+    assert len(plans)>0, "the model space tensor (%.3fGb) does not fit in the budget" % (4.*n*sum([fs[1] for fs in fmaps_sizes])*nt / 1024**3)
+    plan = min(plans, key=lambda p: (p['seconds'], p['host_bytes']+p['device_bytes']))
+    if verbose:
+        print_plan('model_space_tensor', plan)
+    return plan
+
+
+def plan_learn_params(n, nf, nv, nt, bn=None, num_epochs=1, val_test_size=0, output_val_scores=-1, num_hyper=1, budget=8*1024**3,
+                      device_budget=None, costs=None, input_rows=None, memmap=False, verbose=True):
+    '''
+    Fastest batches=(bn, bv, bt) of fwrf.learn_params within budget bytes of RAM (and device_budget bytes of VRAM,
+    if the theano device is a gpu). Returns a dict with the batches and their estimated memory and runtime.
+
+    bn is the minibatch size of the gradient descent and changes the fit, so it is only chosen if not given.
+    bv and bt do not change the results. num_hyper is the number of (lr, l2) combinations of a sweep.
+    input_rows and memmap describe the input model space tensor, see learn_params_cost.
+    '''
+    plans = []
+    for bt in candidate_sizes(nt):
+        for bv in candidate_sizes(nv):
+            for bn_ in ([bn] if bn else candidate_sizes(n - val_test_size)):
+                host, device, seconds = learn_params_cost(n, nf, nv, nt, bn_, bv, bt, num_epochs=num_epochs, val_test_size=val_test_size,
+                                                          output_val_scores=output_val_scores, num_hyper=num_hyper, costs=costs,
+                                                          input_rows=input_rows, memmap=memmap)
+                if _fits(host, device, budget, device_budget):
+                    plans += [{'batches': (bn_, bv, bt), 'host_bytes': host, 'device_bytes': device, 'seconds': seconds},]
+    assert len(plans)>0, "learn_params does not fit in the budget with any batch size"
+    plan = min(plans, key=lambda p: (p['seconds'], p['host_bytes']+p['device_bytes']))
+    if verbose:
+        print_plan('learn_params', plan)
+    return plan
+
+
+def print_plan(stage, plan):
+    print "%s: batches=%s" % (stage, plan['batches'])
+    print "  estimated memory: %.3fGb (host) + %.3fGb (device)" % (plan['host_bytes'] / 1024.**3, plan['device_bytes'] / 1024.**3)
+    print "  estimated runtime: %.1fs (%.2fh)" % (plan['seconds'], plan['seconds'] / 3600.)
+    sys.stdout.flush()
+
+
+########################################################################
+###              CALIBRATION                                         ###
+########################################################################
+
+def calibrate(n=512, nf=32, nv=64, nt=64, num_epochs=2, seed=0):
+    '''
+    Measures the cost model constants with a short learn_params run on random data (a few seconds), using the
+    instrumentation phases: compilation time (bypassing graph_cache), upload bandwidth, and a least squares fit of the
+    epoch times with two sample batch sizes for the call overhead and the flop rate.
+    Returns a costs dictionary for the planners.
+    '''
+    import fwrf
+    import graph_cache as pgc
+    import instrumentation as pin
+    rng = np.random.RandomState(seed)
+    mst_data = rng.normal(size=(n, nf, 1, nt)).astype(fpX)
+    voxels = rng.normal(size=(n, nv)).astype(fpX)
+    w_params = [np.zeros(shape=(nv, nf), dtype=fpX), np.zeros(shape=(nv), dtype=fpX)]
+    events = []
+    with pin.recording(events.append), pgc.bypassed(): # every run compiles its graph, as an uncached learn_params would
+        for bn in [n // 32, n // 2]:
+            fwrf.learn_params(mst_data, voxels, w_params, batches=(bn, nv, nt), val_test_size=n // 4, num_epochs=num_epochs, output_val_scores=0)
+            for e in events:
+                e.setdefault('bn', bn)
+    costs = dict(default_costs)
+    compiles = [e['seconds'] for e in events if e['event']=='compile']
+    costs['compile_time'] = float(np.median(compiles))
+    uploads = [e for e in events if e['event']=='upload' and e['bytes']>0 and e['seconds']>0]
+    if len(uploads)>0:
+        costs['bandwidth'] = float(sum([e['bytes'] for e in uploads]) / sum([e['seconds'] for e in uploads]))
+    epochs = [e for e in events if e['event'] in ('epoch', 'validation')]
+    n_trn = n - n // 4
+    A = np.array([[num_batches(n_trn, e['bn']), 3*2.*n_trn*nf*nv*nt] if e['event']=='epoch' else \
+                  [num_batches(n // 4, e['bn']), 2.*(n // 4)*nf*nv*nt] for e in epochs]) # validation is a forward pass
+    y = np.array([e['seconds'] for e in epochs])
+    (overhead, inv_rate), _, _, _ = np.linalg.lstsq(A, y, rcond=None)
+    costs['call_overhead'] = float(max(overhead, 1e-6))
+    costs['flop_rate'] = float(1. / max(inv_rate, 1e-13))
+    print "calibrated costs: %s" % costs
+    return costs
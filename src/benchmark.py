@@ -0,0 +1,180 @@
+'''
+Synthetic-data benchmark of the fwrf pipeline.
+
+Generates feature maps and voxels with a known ground truth (one candidate receptive field and one set of feature
+weights per voxel), times every stage separately and writes one json record per stage, e.g.
+
+    python -m src.benchmark --n 1000 --nf 32 --n_pix 32 --grid 10 10 6 --nv 500 --out bench.jsonl
+
+Each record contains the stage name, its wall time, its throughput and the problem dimensions, so that runs with
+different backends or batch sizes can be compared, and regressions caught, with any json tool.
+'''
+import sys
+import time
+import json
+import socket
+import argparse
+import numpy as np
+
+import pooling as ppl
+
+
+fpX = np.float32
+
+########################################################################
+###              SYNTHETIC DATA                                      ###
+########################################################################
+
+def synthetic_model_specs(grid, view_angle=20., smin=0.5, smax=8.):
+    '''a sharedModel_specs with grid=(nx, ny, ns) candidates spanning view_angle, as in the training notebooks.'''
+    import fwrf
+    nx, ny, ns = grid
+    return [[(0., view_angle), (0., view_angle), (smin, smax)], [fwrf.linspace(nx), fwrf.linspace(ny), fwrf.logspace(ns)]]
+
+
+def synthetic_fwrf_data(n, nf, n_pix, nv, sharedModel_specs, n_res=1, noise=0.5, view_angle=20., seed=0):
+    '''
+    Random non-negative feature maps at n_res resolutions (n_pix, n_pix/2, ...) with nf features in total, and the
+    responses of nv voxels that each pool the z-scored features with a random candidate of sharedModel_specs and
+    random weights, plus gaussian noise of standard deviation noise (relative to the signal).
+
+    Returns a dictionary with fmaps, fmaps_sizes, voxels and the ground truth candidates, weights and biases.
+    '''
+    rng = np.random.RandomState(seed)
+    nt = np.prod([sms.length for sms in sharedModel_specs[1]])
+    nfs = [nf // n_res + (1 if r < nf % n_res else 0) for r in range(n_res)]
+    fmaps = [np.square(rng.normal(size=(n, nfs[r], max(1, n_pix // 2**r), max(1, n_pix // 2**r)))).astype(fpX) for r in range(n_res)]
+    pool = ppl.make_pooling_function([fm.shape for fm in fmaps], sharedModel_specs, view_angle=view_angle)
+    true_candidates = rng.randint(0, nt, size=nv)
+    true_w = rng.normal(size=(nv, nf)).astype(fpX)
+    true_b = rng.normal(size=nv).astype(fpX)
+    voxels = np.ndarray(shape=(n, nv), dtype=fpX)
+    pooled = np.concatenate([pool([fm[b:b+100] for fm in fmaps]) for b in range(0, n, 100)], axis=0)[:,:,true_candidates] ## (n, nf, nv)
+    pooled = (pooled - pooled.mean(axis=0, keepdims=True)) / (pooled.std(axis=0, keepdims=True) + 1e-6)
+    signal = np.einsum('nfv,vf->nv', pooled, true_w) + true_b
+    voxels[...] = signal + noise * signal.std(axis=0, keepdims=True) * rng.normal(size=signal.shape)
+    return {'fmaps': fmaps, 'fmaps_sizes': [fm.shape for fm in fmaps], 'voxels': voxels,
+            'candidates': true_candidates, 'w': true_w, 'b': true_b}
+
+
+########################################################################
+###              TIMING                                              ###
+########################################################################
+
+class benchmark_log(object):
+    '''collects one record per timed stage and writes them as json lines.'''
+    def __init__(self, out=None, **common):
+        self.out = out
+        self.common = common
+        self.records = []
+
+    def emit(self, record):
+        record = dict(self.common, **record)
+        self.records += [record,]
+        line = json.dumps(record, sort_keys=True)
+        if self.out is None:
+            print line
+        else:
+            with open(self.out, 'a') as f:
+                f.write(line + '\n')
+        sys.stdout.flush()
+
+    def time(self, stage, work, unit, fn, *args, **kwargs):
+        '''runs fn(*args, **kwargs), records its wall time and throughput in work units/s and returns its result.'''
+        start = time.time()
+        result = fn(*args, **kwargs)
+        seconds = time.time() - start
+        self.emit({'stage': stage, 'seconds': seconds, 'work': work, 'unit': unit, 'throughput': work / max(seconds, 1e-12)})
+        return result
+
+
+def environment():
+    import theano
+    return {'host': socket.gethostname(), 'numpy': np.__version__, 'theano': theano.__version__,
+            'floatX': theano.config.floatX, 'device': theano.config.device, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+########################################################################
+###              STAGES                                              ###
+########################################################################
+
+def run_fwrf_benchmark(log, n, nf, n_pix, grid, nv, n_res=1, epochs=5, val_test_size=None, mst_batches=None, fit_batches=None,
+                       kout_parts=0, seed=0):
+    '''time model_space_tensor, learn_params, get_prediction and (if kout_parts>1) the k-out routines on synthetic data.'''
+    import fwrf
+    specs = synthetic_model_specs(grid)
+    nt = np.prod(grid)
+    data = synthetic_fwrf_data(n, nf, n_pix, nv, specs, n_res=n_res, seed=seed)
+    n_val = n // 5
+    n_trn = n - n_val
+    val_test_size = val_test_size or n_trn // 5
+    mst_batches = mst_batches or (min(n, 200), grid[0]*grid[1])
+    fit_batches = fit_batches or (min(n_trn, 200), min(nv, 100), grid[0]*grid[1])
+    log.common.update({'n': n, 'nf': nf, 'n_pix': n_pix, 'n_res': n_res, 'nt': int(nt), 'nv': nv, 'epochs': epochs,
+                       'mst_batches': list(mst_batches), 'fit_batches': list(fit_batches)})
+
+    mst_data, mst_avg, mst_std = log.time('model_space_tensor', n*nt, 'sample-candidates', fwrf.model_space_tensor,
+        data['fmaps'], specs, zscore=True, trn_size=n_trn, batches=mst_batches, view_angle=20.)
+    w_params = [np.zeros(shape=(nv, nf), dtype=fpX), np.zeros(shape=(nv), dtype=fpX)]
+    val_scores, best_scores, best_epochs, best_candidates, best_w_params = log.time('learn_params', nv*nt*epochs, 'voxelmodel-epochs',
+        fwrf.learn_params, mst_data[:n_trn], data['voxels'][:n_trn], w_params, batches=fit_batches, val_test_size=val_test_size,
+        lr=1e-3, num_epochs=epochs, output_val_scores=0)
+    val_pred, val_cc = log.time('get_prediction', nv, 'voxels', fwrf.get_prediction,
+        mst_data[n_trn:], data['voxels'][n_trn:], best_candidates, best_w_params, batches=(n_val, fit_batches[1]))
+    log.emit({'stage': 'accuracy', 'rf_recovery': float(np.mean(best_candidates==data['candidates'])),
+              'median_val_cc': float(np.median(val_cc))})
+
+    if kout_parts > 1:
+        val_part_size = n // kout_parts
+        m = val_part_size * kout_parts
+        order = np.random.RandomState(seed).permutation(m)
+        model = log.time('kout_learn_params', nv*nt*epochs*kout_parts, 'voxelmodel-epochs', fwrf.kout_learn_params,
+            mst_data[:m], data['voxels'][:m], order, w_params, batches=(fit_batches[0], fit_batches[1], fit_batches[2]),
+            val_part_size=val_part_size, holdout_size=val_test_size, lr=1e-3, num_epochs=epochs)
+        log.time('kout_get_prediction', nv*kout_parts, 'voxels', fwrf.kout_get_prediction,
+            mst_data[:m], data['voxels'][:m], model, batches=(val_part_size, fit_batches[1]))
+
+
+def run_gabor_benchmark(log, n_images, s_pix, orientations, n_freq, conv_mode='auto', n_workers=1, seed=0):
+    '''time gabor_feature_maps.create_feature_maps on random images.'''
+    from gaborizer.src.gabor_feature_dictionaries import gabor_feature_maps
+    gfm = gabor_feature_maps(orientations, 20., (.25, 6., n_freq), pix_per_cycle=3.13333333, complex_cell=True,
+                             diams_per_filter=4, cycles_per_radius=1.0)
+    images = np.random.RandomState(seed).uniform(-1., 1., size=(n_images, 1, s_pix, s_pix)).astype(fpX)
+    log.common.update({'n_images': n_images, 's_pix': s_pix, 'orientations': orientations, 'n_freq': n_freq,
+                       'conv_mode': conv_mode, 'n_workers': n_workers})
+    log.time('gabor_create_feature_maps', n_images*len(gfm.gbr_table), 'image-features', gfm.create_feature_maps,
+             images, conv_mode=conv_mode, n_workers=n_workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic-data benchmark of the fwrf pipeline.')
+    parser.add_argument('--stages', nargs='+', default=['fwrf', 'gabor'], choices=['fwrf', 'gabor'])
+    parser.add_argument('--n', type=int, default=1000, help='number of samples')
+    parser.add_argument('--nf', type=int, default=32, help='number of features')
+    parser.add_argument('--n_pix', type=int, default=32, help='feature map resolution')
+    parser.add_argument('--n_res', type=int, default=1, help='number of feature map resolutions')
+    parser.add_argument('--grid', type=int, nargs=3, default=[10, 10, 6], help='candidate grid nx ny ns')
+    parser.add_argument('--nv', type=int, default=500, help='number of voxels')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--mst_batches', type=int, nargs=2, default=None, help='model_space_tensor batches (bn, bt)')
+    parser.add_argument('--fit_batches', type=int, nargs=3, default=None, help='learn_params batches (bn, bv, bt)')
+    parser.add_argument('--kout_parts', type=int, default=0, help='number of k-out parts (0 to skip)')
+    parser.add_argument('--n_images', type=int, default=100)
+    parser.add_argument('--s_pix', type=int, default=227)
+    parser.add_argument('--orientations', type=int, default=4)
+    parser.add_argument('--n_freq', type=int, default=12)
+    parser.add_argument('--conv_mode', default='auto', choices=['auto', 'direct', 'fft'])
+    parser.add_argument('--n_workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='json lines output file (default: stdout)')
+    args = parser.parse_args()
+
+    env = environment()
+    if 'fwrf' in args.stages:
+        run_fwrf_benchmark(benchmark_log(args.out, **env), args.n, args.nf, args.n_pix, tuple(args.grid), args.nv,
+            n_res=args.n_res, epochs=args.epochs, mst_batches=args.mst_batches, fit_batches=args.fit_batches,
+            kout_parts=args.kout_parts, seed=args.seed)
+    if 'gabor' in args.stages:
+        run_gabor_benchmark(benchmark_log(args.out, **env), args.n_images, args.s_pix, args.orientations, args.n_freq,
+            conv_mode=args.conv_mode, n_workers=args.n_workers, seed=args.seed)
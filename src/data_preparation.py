@@ -1,60 +1,93 @@
+import os
 import numpy as np
 import h5py
-import pickle
 import theano
 import theano.tensor as T
 
+from results_store import save_results
 
-def preprocess_gabor_feature_maps(feat_dict, act_func=None, dtype=np.float32):
+
+def allocate_feature_block(shape, dtype=np.float32, store=None, name=None):
+    '''
+    Allocate an uninitialized array of the given shape, either in RAM (store=None), as a dataset of an open h5py
+    File/Group (store=hf), or as a .npy memmap file in the directory store.
+    '''
+    if store is None:
+        return np.empty(shape, dtype=dtype)
+    elif isinstance(store, h5py.Group):
+        return store.create_dataset(name, shape=shape, dtype=dtype, chunks=(min(shape[0], 100), 1)+tuple(shape[2:]))
+    else:
+        if not os.path.exists(store):
+            os.makedirs(store)
+        return np.lib.format.open_memmap(os.path.join(store, name+'.npy'), mode='w+', dtype=dtype, shape=shape)
+
+
+def preprocess_gabor_feature_maps(feat_dict, act_func=None, dtype=np.float32, store=None, batch_size=100):
     '''
     Apply optional nonlinearity to the feature maps itself and concatenate feature maps of the same dimensions.
     Returns the feature maps and a list of theano variables to represent them, and the shape of the fmaps.
+
+    One contiguous (T, nf_r, n_pix, n_pix) block is preallocated per resolution and every feature map is written
+    into its slot once, with the nonlinearity applied batch_size samples at a time.
+    The blocks can be backed by an open h5py File/Group (same layout as
+    gabor_feature_dictionaries.create_gabor_feature_map_store) or by .npy memmaps in the directory store.
     '''
     fmap_rez = []
     for k in feat_dict.keys():
         fmap_rez += [feat_dict[k].shape[2],]
     resolutions = np.unique(fmap_rez)
-    # concatenate and sort as list
     fmaps_res_count = len(resolutions)
     fmaps_count = 0
-    fmaps, _fmaps = [], []
-    for r in range(fmaps_res_count):
-        fmaps  += [[],]
-        _fmaps += [T.tensor4(),]     # theano symbols
     nonlinearity = act_func
     if nonlinearity is None:
         nonlinearity = lambda x: x
+    # count the features of each resolution to preallocate
+    n = len(feat_dict[feat_dict.keys()[0]])
+    fmaps_sizes = [[n, 0, int(r), int(r)] for r in resolutions]
+    for k in feat_dict.keys():
+        fmaps_sizes[np.argmax(resolutions==feat_dict[k].shape[2])][1] += feat_dict[k].shape[1]
+    fmaps_sizes = [tuple(fs) for fs in fmaps_sizes]
+    fmaps, _fmaps = [], []
+    for r in range(fmaps_res_count):
+        fmaps  += [allocate_feature_block(fmaps_sizes[r], dtype=dtype, store=store, name='fmaps_%d' % r),]
+        _fmaps += [T.tensor4(),]     # theano symbols
+    if isinstance(store, h5py.Group):
+        store.attrs['resolution_count'] = fmaps_res_count
+    # fill in place
+    offsets = [0,]*fmaps_res_count
     for k in feat_dict.keys():
         # determine which resolution idx this map belongs to
         ridx = np.argmax(resolutions==feat_dict[k].shape[2])
-        if len(fmaps[ridx])==0:
-            fmaps[ridx] = nonlinearity(feat_dict[k].astype(dtype))
-        else:
-            fmaps[ridx] = np.concatenate((fmaps[ridx], nonlinearity(feat_dict[k].astype(dtype))), axis=1)       
+        fs = slice(offsets[ridx], offsets[ridx]+feat_dict[k].shape[1])
+        for b in range(0, n, batch_size):
+            fmaps[ridx][b:b+batch_size, fs] = nonlinearity(feat_dict[k][b:b+batch_size].astype(dtype, copy=False))
+        offsets[ridx] = fs.stop
         fmaps_count += 1
-    fmaps_sizes = [] 
-    for fmap in fmaps:
-        fmaps_sizes += [fmap.shape]
     print fmaps_sizes
-    print "total fmaps = %d" % fmaps_count 
-    return fmaps, _fmaps, fmaps_sizes 
+    print "total fmaps = %d" % fmaps_count
+    return fmaps, _fmaps, fmaps_sizes
+
+
+def load_feature_map_store(store_file):
+    '''
+    Open a feature map store written by gabor_feature_dictionaries.create_gabor_feature_map_store.
+    Returns the same (fmaps, _fmaps, fmaps_sizes) as preprocess_gabor_feature_maps, except that fmaps are read-only
+    h5py datasets that are read from disk when sliced (e.g. batch by batch in model_space_tensor). The file stays
+    open as long as the datasets are in use.
+    '''
+    hf = h5py.File(store_file, 'r')
+    fmaps = [hf['fmaps_%d' % r] for r in range(hf.attrs['resolution_count'])]
+    _fmaps = [T.tensor4() for fmap in fmaps]
+    fmaps_sizes = [fmap.shape for fmap in fmaps]
+    print fmaps_sizes
+    print "total fmaps = %d" % sum([fs[1] for fs in fmaps_sizes])
+    return fmaps, _fmaps, fmaps_sizes
 
 
 
 def save_stuff(save_to_this_file, data_objects_dict):
-    failed = []
-    with h5py.File(save_to_this_file+'.h5py', 'w') as hf:
-        for k,v in data_objects_dict.iteritems():
-            try:
-                hf.create_dataset(k,data=v)
-                print 'saved %s in h5py file' %(k)
-            except:
-                failed.append(k)
-                print 'failed to save %s as h5py. will try pickle' %(k)   
-    for k in failed:
-        with open(save_to_this_file+'_'+'%s.pkl' %(k), 'w') as pkl:
-            try:
-                pickle.dump(data_objects_dict[k],pkl)
-                print 'saved %s as pkl' %(k)
-            except:
-                print 'failed to save %s in any format. lost.' %(k) 
+    '''
+    Kept for the notebooks. Saves everything in save_to_this_file.h5py with results_store.save_results, which also
+    handles lists, nested dicts and other objects in the same file. Read it back with results_store.load_results.
+    '''
+    save_results(save_to_this_file+'.h5py', data_objects_dict)
@@ -0,0 +1,188 @@
+'''
+Dimensionality reduction of the model space tensor along the feature axis.
+
+The pooled (and z-scored) features of a candidate are usually highly correlated, in particular for dnn feature maps.
+A projection is learned on the training rows, with the features centered on their mean for every candidate: either
+one basis for all candidates ('global') or one basis per candidate ('candidate'), with an exact ('pca') or a
+randomized ('randomized') decomposition. In that basis the model space tensor is (n, k, 1, nt), each component scaled
+to unit variance so that learn_params sees the same feature scale as with z-scored features.
+
+model_space_tensor fits the projection as it pools the training rows and only stores the reduced tensor:
+
+    projection = feature_reduction.new_projection(64, mode='global')
+    trn_mst, mst_avg, mst_std = fwrf.model_space_tensor(trn_fmaps, sharedModel_specs, zscore=True, projection=projection, ...)
+    val_mst, _, _ = fwrf.model_space_tensor(val_fmaps, sharedModel_specs, zscore=True, mst_avg=mst_avg, mst_std=mst_std,
+                                            projection=projection, ...)
+
+and a full model space tensor can also be reduced afterwards with fit_projection and apply_projection.
+
+Weights fitted in the reduced basis map back to the original features with project_w_params, after which they can be
+used with the model space tensor statistics (real_space_model) and get_symbolic_prediction as usual.
+'''
+import sys
+import numpy as np
+from tqdm import tqdm
+
+
+fpX = np.float32
+
+########################################################################
+###              DECOMPOSITIONS                                      ###
+########################################################################
+
+def top_eigh(C, k, method='pca', n_iter=4, oversample=10, seed=0):
+    '''top k eigenvalues (decreasing) and eigenvectors (nf, k) of the symmetric positive matrix C.'''
+    if method=='pca' or k+oversample>=len(C):
+        e, U = np.linalg.eigh(C)
+        return e[::-1][:k], U[:,::-1][:,:k]
+    assert method=='randomized', "unknown method %s" % method
+    Q = np.random.RandomState(seed).normal(size=(len(C), k+oversample))
+    for i in range(n_iter):
+        Q, _ = np.linalg.qr(C.dot(Q))
+    e, V = np.linalg.eigh(Q.T.dot(C).dot(Q))
+    return e[::-1][:k], Q.dot(V[:,::-1][:,:k])
+
+
+def top_right_singular(A, k, method='pca', n_iter=4, oversample=10, seed=0):
+    '''top k singular values and right singular vectors (nf, k) of A (m, nf).'''
+    if method=='pca' or k+oversample>=min(A.shape):
+        _, s, Vt = np.linalg.svd(A, full_matrices=False)
+        return s[:k], Vt[:k].T
+    assert method=='randomized', "unknown method %s" % method
+    Q = np.random.RandomState(seed).normal(size=(A.shape[1], k+oversample))
+    Y = A.dot(Q)
+    for i in range(n_iter):
+        Y, _ = np.linalg.qr(Y)
+        Y = A.dot(A.T.dot(Y))
+    Q, _ = np.linalg.qr(Y)
+    _, s, Vt = np.linalg.svd(Q.T.dot(A), full_matrices=False)
+    return s[:k], Vt[:k].T
+
+
+########################################################################
+###              PROJECTION                                          ###
+########################################################################
+
+def new_projection(k, mode='global', method='pca'):
+    '''
+    An unfitted projection to k dimensions, for model_space_tensor (projection=), which fits it on the training rows
+    as they are pooled. mode and method are as in fit_projection.
+    '''
+    assert mode in ['global', 'candidate'], "unknown mode %s" % mode
+    return {'k': k, 'mode': mode, 'method': method}
+
+
+def fitted(projection):
+    return 'basis' in projection
+
+
+def projection_from_moments(projection, x, xx, m, epsilon=1e-6, seed=0):
+    '''
+    Fits the unfitted projection (see new_projection) in place from the moments of m training rows: the feature sums
+    x (nt, nf) and the sums of the feature products xx, summed over the candidates (nf, nf) for the 'global' mode or per
+    candidate (nt, nf, nf) for the 'candidate' mode. The features are centered on their mean for every candidate.
+    Returns the projection.
+    '''
+    k, mode, method = projection['k'], projection['mode'], projection['method']
+    nt, nf = x.shape
+    assert k<=min(nf, m), "cannot keep %d of %d features with %d samples" % (k, nf, m)
+    avg = x / m
+    if mode=='global':
+        C = xx - m * np.dot(avg.T, avg)
+        e, U = top_eigh(C, k, method=method, seed=seed)
+        scale = np.sqrt(np.maximum(e, 0.) / (m*nt)) + epsilon
+        explained = np.sum(e) / max(np.trace(C), 1e-30)
+    else:
+        U = np.ndarray(shape=(nt, nf, k), dtype=fpX)
+        scale = np.ndarray(shape=(nt, k), dtype=fpX)
+        explained = 0.
+        for t in range(nt):
+            C = xx[t] - m * np.outer(avg[t], avg[t])
+            e, U[t] = top_eigh(C, k, method=method, seed=seed)
+            scale[t] = np.sqrt(np.maximum(e, 0.) / m) + epsilon
+            explained += np.sum(e) / max(np.trace(C), 1e-30) / nt
+    print "%d of %d feature dimensions (%s, %s) explain %.1f%% of the variance" % (k, nf, mode, method, 100*explained)
+    projection.update({'basis': U.astype(fpX), 'scale': np.asarray(scale, dtype=fpX), 'avg': avg.astype(fpX), 'explained': explained})
+    return projection
+
+
+def fit_projection(mst_data, k, trn_size=None, mode='global', method='pca', batch_size=100, epsilon=1e-6, seed=0):
+    '''
+    Learns a k dimensional basis of the feature axis of mst_data (n, nf, 1, nt) on its first trn_size rows, with the
+    features centered on their training mean for every candidate.
+    mode ~ 'global' (one (nf, k) basis for all candidates, from the feature covariance accumulated over candidates)
+           or 'candidate' (one (nf, k) basis per candidate, i.e. a (nt, nf, k) stack).
+    method ~ 'pca' (exact) or 'randomized'.
+
+    Returns a projection dictionary with the mode, the basis, the scale (standard deviation) of every component and the
+    feature means avg (nt, nf). To fit it without the full model space tensor, see new_projection.
+    '''
+    n, nf, _, nt = mst_data.shape
+    if trn_size is None:
+        trn_size = n
+    assert k<=min(nf, trn_size), "cannot keep %d of %d features with %d samples" % (k, nf, trn_size)
+    projection = new_projection(k, mode=mode, method=method)
+    if mode=='global':
+        x = np.zeros(shape=(nt, nf), dtype=np.float64)
+        xx = np.zeros(shape=(nf, nf), dtype=np.float64)
+        for t in range(0, nt, batch_size):
+            X = np.asarray(mst_data[:trn_size,:,0,t:t+batch_size], dtype=np.float64)
+            x[t:t+batch_size] = np.sum(X, axis=0).T
+            xx += np.einsum('mft,mgt->fg', X, X)
+        return projection_from_moments(projection, x, xx, trn_size, epsilon=epsilon, seed=seed)
+    U = np.ndarray(shape=(nt, nf, k), dtype=fpX)
+    scale = np.ndarray(shape=(nt, k), dtype=fpX)
+    avg = np.ndarray(shape=(nt, nf), dtype=fpX)
+    explained = 0.
+    for t in tqdm(range(nt)):
+        A = np.asarray(mst_data[:trn_size,:,0,t], dtype=np.float64)
+        avg[t] = np.mean(A, axis=0)
+        A -= avg[t]
+        s, V = top_right_singular(A, k, method=method, seed=seed)
+        U[t], scale[t] = V, s / np.sqrt(trn_size) + epsilon
+        explained += np.sum(np.square(s)) / max(np.sum(np.square(A)), 1e-30) / nt
+    print "%d of %d feature dimensions (%s, %s) explain %.1f%% of the variance" % (k, nf, mode, method, 100*explained)
+    projection.update({'basis': U, 'scale': scale, 'avg': avg, 'explained': explained})
+    return projection
+
+
+def project_block(X, projection, rt=slice(None)):
+    '''the features X (n, nf, 1, lt) of the candidates rt in the reduced basis of projection, (n, k, 1, lt).'''
+    U, scale, avg = projection['basis'], projection['scale'], projection['avg'][rt]
+    X = X[:,:,0,:] - avg.T[np.newaxis]
+    if projection['mode']=='global':
+        Z = np.einsum('nft,fk->nkt', X, U) / scale[np.newaxis,:,np.newaxis]
+    else:
+        Z = np.einsum('nft,tfk->nkt', X, U[rt]) / scale[rt].T[np.newaxis]
+    return Z[:,:,np.newaxis,:].astype(fpX)
+
+
+def apply_projection(mst_data, projection, batch_size=100, out=None):
+    '''returns mst_data (n, nf, 1, nt) in the reduced basis of projection, (n, k, 1, nt), one batch of candidates at a time.'''
+    n, nf, _, nt = mst_data.shape
+    k = projection['basis'].shape[-1]
+    if out is None:
+        out = np.ndarray(shape=(n, k, 1, nt), dtype=fpX)
+    for t in range(0, nt, batch_size):
+        rt = slice(t, min(nt, t+batch_size))
+        out[:,:,:,rt] = project_block(mst_data[:,:,:,rt], projection, rt)
+    return out
+
+
+def project_w_params(w_params, projection, candidates=None):
+    '''
+    maps the weights [W (nv, k), b (nv)] fitted in the reduced basis back to the original features, [W (nv, nf), b (nv)].
+    candidates (nv) are the best candidates of each voxel, which set the centering of the features in the bias, and
+    the basis of the per-candidate projection.
+    '''
+    W, b = w_params
+    U, scale, avg = projection['basis'], projection['scale'], projection['avg']
+    assert candidates is not None or not np.any(avg), "the centered projection needs the candidate of each voxel"
+    if projection['mode']=='global':
+        W = (W / scale).dot(U.T)
+    else:
+        assert candidates is not None, "the per-candidate projection needs the candidate of each voxel"
+        W = np.einsum('vfk,vk->vf', U[candidates], W / scale[candidates])
+    if candidates is not None:
+        b = b - np.sum(W * avg[candidates], axis=1)
+    return [W.astype(fpX), np.asarray(b, dtype=fpX)]
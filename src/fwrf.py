@@ -13,24 +13,43 @@ import numpy as np
 from tqdm import tqdm
 import pickle
 import math
-
-import theano
-import theano.tensor as T
-
-import lasagne
-import lasagne.layers as L
-import lasagne.regularization as R
-import lasagne.nonlinearities as NL
-import lasagne.objectives as O
-import lasagne.init as I
+from collections import OrderedDict
 
 import numpy_utility as pnu
-import lasagne_utility as plu
+import scoring_utility as psu
+import instrumentation as pin
+import feature_reduction as pfr
+import pooling as ppl
+import graph_cache as pgc
 
 
 fpX = np.float32
-print "theano floatX: %s" % theano.config.floatX
-print "numpy floatX: %s" % fpX
+
+########################################################################
+###              BACKEND                                             ###
+########################################################################
+### theano and lasagne are only imported when a function that needs them is first called, so that the numpy parts
+### of this module (and the modules importing it) load quickly.
+theano = T = lasagne = L = R = NL = O = I = plu = None
+pvFWRFLayer = svFWRFLayer = None
+
+def load_backend():
+    '''imports theano, lasagne, lasagne_utility and the fwrf layers into this module. Does nothing after the first call.'''
+    global theano, T, lasagne, L, R, NL, O, I, plu, pvFWRFLayer, svFWRFLayer
+    if theano is not None:
+        return
+    import theano
+    import theano.tensor as T
+    import lasagne
+    import lasagne.layers as L
+    import lasagne.regularization as R
+    import lasagne.nonlinearities as NL
+    import lasagne.objectives as O
+    import lasagne.init as I
+    import lasagne_utility as plu
+    from fwrf_layers import pvFWRFLayer, svFWRFLayer
+    print "theano floatX: %s" % theano.config.floatX
+    print "numpy floatX: %s" % fpX
 
 ########################################################################
 ###              SUPPORT FUNCTIONS                                   ###
@@ -102,6 +121,13 @@ def iterate_slice(start, length, batchsize):
 def slice_arraylist(inputs, excerpt):            
     return [i[excerpt] for i in inputs]  
 
+def pad_candidate_batch(a, bt):
+    '''pads the last axis of a residual candidate batch up to the fixed batch size bt by repeating its last candidate.'''
+    lt = a.shape[-1]
+    if lt==bt:
+        return a
+    return np.concatenate([a, np.repeat(a[...,-1:], bt-lt, axis=-1)], axis=-1)
+
 def iterate_minibatches(inputs, targets, batchsize):
     '''return inputs.shape[0]//batchsize batches plus one residual batches smaller than batchsize if needed'''
     assert len(inputs) == len(targets)
@@ -163,6 +189,7 @@ def pRF(fwrf_weights, fmap_rf, pool_rf):
 ########################################################################
 
 def create_shared_batched_feature_maps_gaussian_weights(fmap_sizes, batch_v, batch_t, verbose=True):
+    load_backend()
     nf = 0
     _smsts = []
     mem_approx = 0
@@ -208,69 +235,7 @@ def set_shared_parameters(shared_vars, values):
 ########################################################################
 ###              SPECIAL LASAGNE LAYER AND MODEL                     ###
 ########################################################################
-class pvFWRFLayer(L.Layer):
-    '''
-    pvFWRFLayer is a new lasagne layer for 'per voxel (pv)' candidate receptive field models. It assumes an input
-    of shape (bn, nf, bv, bt) where bn is a batch of the time series, nf are the total number of features, bv is a batch of voxels and bt is a batch of candidate rf.
-
-    The return values correspond to the predicted voxel activities, of shape (bn, nv, nt)
-    '''
-    def __init__(self, incoming, W=lasagne.init.Normal(0.01),  b=lasagne.init.Constant(0.), nonlinearity=None, **kwargs):
-        super(pvFWRFLayer, self).__init__(incoming, **kwargs)
-        self.nf, self.nv, self.nt = self.input_shape[1:4]
-        self.W = self.add_param(W, (self.nf, self.nv, self.nt), name='W')
-        if b is not None:
-            self.b = self.add_param(b, (1, self.nv, self.nt), name='b', regularizable=False)
-            self.b = T.patternbroadcast(self.b, (True, False, False))
-        else:
-            self.b = None
-        self.nonlinearity = (NL.identity if nonlinearity is None else nonlinearity)
-        
-    def get_output_for(self, input, **kwargs):
-        _pred = T.batched_tensordot(input.flatten(ndim=3).dimshuffle((2,0,1)), \
-                self.W.flatten(ndim=2).dimshuffle((1,0)), axes=[[2],[1]]) \
-                .dimshuffle((1,0)).reshape((input.shape[0],self.nv,self.nt))
-        if self.b is not None:
-            _pred = _pred + self.b
-        return self.nonlinearity(_pred)
-
-    def get_output_shape_for(self, input_shape):
-        return (input_shape[0], self.nv, self.nt)
-    
-
-
-
-class svFWRFLayer(L.Layer):
-    '''
-    svFWRFLayer is a new lasagne layer for 'shared voxel (sv)' candidate receptive field models. It assumes an input
-    of shape (bn, nf, bt) where bn is a batch of the time series, nf are the total number of features, bv is a batch of voxels
-    and bt is a batch of candidate rf.
-
-    The return values correspond to the predicted voxel activities, of shape (bn, nv, nt)
-    '''
-    def __init__(self, incoming, nvoxels, W=lasagne.init.Normal(0.01),  b=lasagne.init.Constant(0.), nonlinearity=None, **kwargs):
-        super(svFWRFLayer, self).__init__(incoming, **kwargs)
-        self.nf = self.input_shape[1]
-        self.nt = self.input_shape[2]
-        self.nv = nvoxels
-        self.W = self.add_param(W, (self.nf, self.nv, self.nt), name='W')
-        if b is not None:
-            self.b = self.add_param(b, (1, self.nv, self.nt), name='b', regularizable=False)
-            self.b = T.patternbroadcast(self.b, (True, False, False))
-        else:
-            self.b = None
-        self.nonlinearity = (NL.identity if nonlinearity is None else nonlinearity)
-        
-    def get_output_for(self, input, **kwargs):
-        _pred = T.batched_tensordot(input.dimshuffle((2,0,1)), self.W.dimshuffle((2,0,1)), axes=[[2],[1]]).dimshuffle((1,2,0))
-        if self.b is not None:
-            _pred = _pred + self.b
-        return self.nonlinearity(_pred)
-
-    def get_output_shape_for(self, input_shape):
-        return (input_shape[0], self.nv, self.nt)
-
-
+# pvFWRFLayer and svFWRFLayer are defined in fwrf_layers, and available here after load_backend().
 
 
 
@@ -279,12 +244,14 @@ def get_mst_data(__fmaps, __smsts):
     _fmaps is a list of grouped feature maps at different resolutions. F maps in total.
     _smsts is a matching resolution stack of batch_t RF model candidates.
     returns a symbolic tensor of receptive field candiate weighted feature maps (bn, features, bv, bt)'''
+    load_backend()
     __mstfmaps = [T.tensordot(_fm, __smsts[i], [[2,3], [2,3]])  for i,_fm in enumerate(__fmaps)]
     __mst_data = T.concatenate(__mstfmaps, axis=1)
     return __mst_data
 
 
 def normalize_mst_data(__mst_data, avg, std):
+    load_backend()
     _sAvg = theano.shared(avg.T.astype(fpX)[np.newaxis,:,:,np.newaxis])
     _sStd = theano.shared(std.T.astype(fpX)[np.newaxis,:,:,np.newaxis])
     ### set the broadcastability of the sample axis
@@ -298,6 +265,7 @@ def pvFWRF(__mst_data, nf, nv, nt):
     Create a symbolic lasagne network for the per voxel candidate case.
     returns a symbolic outpuy of shape (bn, bv, bt).
     '''
+    load_backend()
     _input = L.InputLayer((None, nf, nv, nt), input_var=__mst_data.reshape((-1,nf,nv,nt)))
     ## try to add a parametrized local nonlinearity layer.
     _pred  = pvFWRFLayer(_input, W=I.Normal(0.02), b=I.Constant(0.), nonlinearity=None)
@@ -311,6 +279,7 @@ def svFWRF(__mst_data, nf, nv, nt):
     Create a symbolic lasagne network for the shared voxel candidate case.
     returns a symbolic outpuy of shape (bn, bv, bt).
     '''
+    load_backend()
     _input = L.InputLayer((None, nf, nt), input_var=__mst_data.reshape((-1,nf,nt)))
     _pred  = svFWRFLayer(_input, nvoxels=nv, W=I.Normal(0.02), b=I.Constant(0.), nonlinearity=None) #NL.tanh
     #print "> input using approx %.1f x batch_size Mb of memory (VRAM and RAM)" % (fpX(4*nf*nv*nt) /(1024*1024))
@@ -334,7 +303,8 @@ def svModelSpace(sharedModel_specs):
 def model_space_tensor(
         datas, sharedModel_specs, _symbolicFeatureMaps=None, featureMapSizes=None, _symbolicInputVars=None, 
         nonlinearity=None, zscore=False, mst_avg=None, mst_std=None, epsilon=1e-6, trn_size=None,
-        batches=(1,1), view_angle=20., verbose=False, dry_run=False):
+        batches=(1,1), view_angle=20., engine='theano',
+        pooling_tolerance=5e-2, projection=None, out=None, verbose=False, dry_run=False):
     '''
     batches dims are (samples, candidates)
 
@@ -344,6 +314,19 @@ def model_space_tensor(
 
     This function returns a 4 dimensional model_space tensor, which has dimensions (samples, total number of features, 1, total number of candidates rf).
     The singleton dimension represent the voxels index. However in our case, all voxels share the same candidates rf which is why this dimension is 1.
+
+    projection ~ a projection of feature_reduction. The (nonlinear, z-scored) features of every batch are then projected
+                 as soon as they are pooled, and only the reduced tensor (samples, k, 1, candidates) is stored, in out if
+                 given (e.g. a memmap). An unfitted projection (feature_reduction.new_projection) is fitted in place on
+                 the first trn_size samples, which are pooled once more for that, and once more for the z-scoring
+                 statistics if mst_avg and mst_std are not given. The 'candidate' mode accumulates nf x nf products
+                 for every candidate. Map the fitted weights back with feature_reduction.project_w_params.
+
+    engine ~ 'theano' (one dot product per candidate and feature map, on the theano device, bt candidates at a time), or
+             one of the numpy engines of pooling.make_pooling_function: 'separable' (one separable gaussian filtering
+             pass per sigma, sampled at the candidate centers, for all candidates at once), 'pyramid' (the same, with each
+             sigma pooling the feature maps downsampled as far as the relative pooling error stays under pooling_tolerance)
+             or 'dense'. The numpy engines take the feature maps directly (no symbolic inputs).
     '''
     n = len(datas[0])
     bn, bt = batches
@@ -351,60 +334,104 @@ def model_space_tensor(
     nt = np.prod([sms.length for sms in sharedModel_specs[1]])          
     mx, my, ms = svModelSpace(sharedModel_specs)
     nbt = nt // bt
-    rbt = nt - nbt * bt
-    assert rbt==0, "the candidate batch size must be an exact divisor of the total number of candidates"
-    ### CHOOSE THE INPUT VARIABLES
-    print 'CREATING SYMBOLS\n'
-    if _symbolicFeatureMaps is None:
-        _fmaps, fmap_sizes = [], []
-        for d in datas:
-            _fmaps += [T.tensor4(),] 
-            fmap_sizes += [d.shape,]
-    else:
-        _fmaps = _symbolicFeatureMaps
-        fmap_sizes = featureMapsSizes
-        assert fmap_sizes is not None
-
-    if _symbolicInputVars is None:
-        _invars = _fmaps
-        for d,fs in zip(datas,fmap_sizes):
-            assert d.shape[1:]==fs[1:]
+    rbt = nt - nbt * bt # the residual candidate batch is padded up to bt
+    if projection is not None:
+        k = projection['basis'].shape[-1] if pfr.fitted(projection) else projection['k']
+    if engine!='theano':
+        assert _symbolicFeatureMaps is None and _symbolicInputVars is None, "the %s engine takes the feature maps directly" % engine
+        nf = sum([d.shape[1] for d in datas])
+        _smsts = []
+        start_time = time.time()
+        print "\nPrecomputing mst candidate responses (%s pooling)..." % engine
+        sys.stdout.flush()
+        mst_data = out if out is not None else np.ndarray(shape=(n,nf if projection is None else k,1,nt), dtype=fpX)
+        if dry_run:
+            return mst_data, None, None
+        pool = ppl.make_pooling_function([d.shape for d in datas], sharedModel_specs, view_angle=view_angle, engine=engine,
+                                          tolerance=pooling_tolerance, verbose=verbose)
+        def blocks(m):
+            '''the pooled features of the first m samples, (size, nf, 1, nt) blocks with their samples and candidates.'''
+            for excerpt, size in tqdm(iterate_slice(0, m, bn)): ## SAMPLE BATCH LOOP
+                with pin.phase('model_space_tensor', 'compute', candidates=nt, samples=size) as ph:
+                    args = slice_arraylist(datas, excerpt)
+                    block = pool(args)[:,:,np.newaxis,:]
+                    ph.add(bytes=pin.nbytes(args)+size*nf*nt*4)
+                yield excerpt, slice(0, nt), block
     else:
-        _invars = _symbolicInputVars
-    ### CREATE SYMBOLIC EXPRESSIONS AND COMPILE
-    _smsts, nf = create_shared_batched_feature_maps_gaussian_weights(fmap_sizes, 1, bt, verbose=verbose)
-    _mst_data = get_mst_data(_fmaps, _smsts)  
-    if verbose:
-        print ">> Storing the full modelspace tensor will require approx %.03fGb of RAM!" % (fpX(n*nf*nt*4) / 1024**3)
-        print ">> Will be divided in chunks of %.03fGb of VRAM!\n" % ((fpX(n*nf*bt*4) / 1024**3))
-    print 'COMPILING...'
-    sys.stdout.flush()
-    comp_t = time.time()
-    mst_data_fn  = theano.function(_invars, _mst_data)
-    print '%.2f seconds to compile theano functions' % (time.time()-comp_t)
-    ### EVALUATE MODEL SPACE TENSOR
-    start_time = time.time()
-    print "\nPrecomputing mst candidate responses..."
-    sys.stdout.flush()
-    mst_data = np.ndarray(shape=(n,nf,1,nt), dtype=fpX)   
-    if dry_run:
-        return mst_data, None, None
-    for t in tqdm(range(nbt)): ## CANDIDATE BATCH LOOP     
-        # set the receptive field weight for this batch of voxelmodel
-        set_shared_batched_feature_maps_gaussian_weights(_smsts, mx[:,t*bt:(t+1)*bt], my[:,t*bt:(t+1)*bt], ms[:,t*bt:(t+1)*bt], size=view_angle)
-        for excerpt, size in iterate_slice(0, n, bn):
-            args = slice_arraylist(datas, excerpt)  
-            mst_data[excerpt,:,:,t*bt:(t+1)*bt] = mst_data_fn(*args)
+        load_backend()
+        ### CHOOSE THE INPUT VARIABLES
+        print 'CREATING SYMBOLS\n'
+        if _symbolicFeatureMaps is None:
+            _fmaps, fmap_sizes = [], []
+            for d in datas:
+                _fmaps += [T.tensor4(),] 
+                fmap_sizes += [d.shape,]
+        else:
+            _fmaps = _symbolicFeatureMaps
+            fmap_sizes = featureMapsSizes
+            assert fmap_sizes is not None
+
+        if _symbolicInputVars is None:
+            _invars = _fmaps
+            for d,fs in zip(datas,fmap_sizes):
+                assert d.shape[1:]==fs[1:]
+        else:
+            _invars = _symbolicInputVars
+        ### CREATE SYMBOLIC EXPRESSIONS AND COMPILE
+        _smsts, nf = create_shared_batched_feature_maps_gaussian_weights(fmap_sizes, 1, bt, verbose=verbose)
+        _mst_data = get_mst_data(_fmaps, _smsts)  
+        if verbose:
+            print ">> Storing the full modelspace tensor will require approx %.03fGb of RAM!" % (fpX(n*nf*nt*4) / 1024**3)
+            print ">> Will be divided in chunks of %.03fGb of VRAM!\n" % ((fpX(n*nf*bt*4) / 1024**3))
+        print 'COMPILING...'
+        sys.stdout.flush()
+        with pin.phase('model_space_tensor', 'compile') as ph:
+            mst_data_fn  = theano.function(_invars, _mst_data)
+        print '%.2f seconds to compile theano functions' % ph.seconds
+        ### EVALUATE MODEL SPACE TENSOR
+        start_time = time.time()
+        print "\nPrecomputing mst candidate responses..."
+        sys.stdout.flush()
+        mst_data = out if out is not None else np.ndarray(shape=(n,nf if projection is None else k,1,nt), dtype=fpX)
+        if dry_run:
+            return mst_data, None, None
+        weight_bytes = bt * sum([fs[2]*fs[3] for fs in fmap_sizes]) * np.dtype(fpX).itemsize # the pooling fields, without reading them back from the device
+        def blocks(m):
+            '''the pooled features of the first m samples, (size, nf, 1, lt) blocks with their samples and candidates.'''
+            for rt, lt in tqdm(iterate_slice(0, nt, bt)): ## CANDIDATE BATCH LOOP
+                # set the receptive field weight for this batch of voxelmodel
+                with pin.phase('model_space_tensor', 'weight_setup', bytes=weight_bytes):
+                    set_shared_batched_feature_maps_gaussian_weights(_smsts, pad_candidate_batch(mx[:,rt], bt), pad_candidate_batch(my[:,rt], bt), pad_candidate_batch(ms[:,rt], bt), size=view_angle)
+                for excerpt, size in iterate_slice(0, m, bn):
+                    with pin.phase('model_space_tensor', 'compute', candidates=lt, samples=size) as ph:
+                        args = slice_arraylist(datas, excerpt)
+                        block = mst_data_fn(*args)[:,:,:,:lt]
+                        ph.add(bytes=pin.nbytes(args)+size*nf*bt*4)
+                    yield excerpt, rt, block
+    ### OPTIONAL DIMENSIONALITY REDUCTION, BATCH BY BATCH
+    if projection is not None:
+        mst_avg_loc, mst_std_loc = _reduced_model_space_tensor(blocks, mst_data, projection, nf, trn_size or n, nonlinearity=nonlinearity,
+                                                               zscore=zscore, mst_avg=mst_avg, mst_std=mst_std, epsilon=epsilon)
+        full_time = time.time() - start_time
+        print "%d reduced mst candidate responses took %.3fs @ %.3f models/s" % (nt, full_time, fpX(nt)/full_time)
+        for _s in _smsts:
+            _s.set_value(np.asarray([], dtype=fpX).reshape((0,0,0,0)))
+        return mst_data, mst_avg_loc, mst_std_loc
+    for excerpt, rt, block in blocks(n):
+        mst_data[excerpt,:,:,rt] = block
     full_time = time.time() - start_time
     print "%d mst candidate responses took %.3fs @ %.3f models/s" % (nt, full_time, fpX(nt)/full_time)
     ### OPTIONAL NONLINEARITY
     if nonlinearity:
         print "Applying nonlinearity to modelspace tensor..."
         sys.stdout.flush()
-        for rr, rl in tqdm(iterate_slice(0, mst_data.shape[3], bt)): 
-            mst_data[:,:,:,rr] = nonlinearity(mst_data[:,:,:,rr])
+        with pin.phase('model_space_tensor', 'nonlinearity', bytes=mst_data.nbytes):
+            for rr, rl in tqdm(iterate_slice(0, mst_data.shape[3], bt)): 
+                mst_data[:,:,:,rr] = nonlinearity(mst_data[:,:,:,rr])
     ### OPTIONAL Z-SCORING
+    mst_avg_loc, mst_std_loc = mst_avg, mst_std
     if zscore:
+        zscore_t = time.time()
         if trn_size==None:
             trn_size = len(mst_data)
         print "Z-scoring modelspace tensor..."
@@ -430,83 +457,167 @@ def model_space_tensor(
                 mst_data[:,:,:,rr] -= mst_avg_loc[:,:,:,rr]
                 mst_data[:,:,:,rr] /= mst_std_loc[:,:,:,rr]
                 mst_data[:,:,:,rr] = np.nan_to_num(mst_data[:,:,:,rr])
+        pin.emit('model_space_tensor', 'zscore', seconds=time.time()-zscore_t, bytes=mst_data.nbytes)
     ### Free the VRAM
     for _s in _smsts:
         _s.set_value(np.asarray([], dtype=fpX).reshape((0,0,0,0)))
     return mst_data, mst_avg_loc, mst_std_loc
 
 
-
-def learn_params(
-        mst_data, voxels, w_params, \
-        batches=(1,1,1), val_test_size=100, lr=1e-4, l2=0.0, num_epochs=1, output_val_scores=-1, output_val_every=1, verbose=False, dry_run=False):
-    ''' 
-        batches dims are (samples, voxels, candidates)
+def _reduced_model_space_tensor(blocks, out, projection, nf, trn_size, nonlinearity=None, zscore=False, mst_avg=None, mst_std=None, epsilon=1e-6):
     '''
-    assert len(mst_data)==len(voxels), "data/target length mismatch"  
-    n, nf, _, nt = mst_data.shape
-    _, nv = voxels.shape
-    bn, bv, bt = batches    
-    nbv, nbt = nv // bv, nt // bt
-    rbv, rbt = nv - nbv * bv, nt - nbt * bt
-    assert rbt==0, "the model batch size must be an divisor of the total number of models"
-    if verbose:
-        print "Grad. Desc. planned in %d batch with batch size %d and residual %d" % \
-            (int(np.ceil(float(n-val_test_size) / bn)), bn, (n-val_test_size)%bn)
-        print "%d voxel batches of size %d with residual %d" % (nbv, bv, rbv)
-        print "%d candidate batches of size %d with residual %d" % (nbt, bt, rbt)
-        print "for %d voxelmodel fits." % (nv*nt)
-        sys.stdout.flush()     
+    fills out (n, k, 1, nt) with the pooled feature blocks of model_space_tensor in the reduced basis of projection,
+    after fitting the z-scoring statistics and the projection on the first trn_size samples if needed.
+    Returns the z-scoring statistics (1, nf, 1, nt), or None.
+    '''
+    n, _, _, nt = out.shape
+    if zscore and (mst_avg is None or mst_std is None):
+        print "Z-scoring statistics of the modelspace tensor..."
+        sys.stdout.flush()
+        s1 = np.zeros(shape=(1,nf,1,nt), dtype=np.float64)
+        s2 = np.zeros(shape=(1,nf,1,nt), dtype=np.float64)
+        for excerpt, rt, block in blocks(trn_size):
+            if nonlinearity:
+                block = nonlinearity(block)
+            s1[:,:,:,rt] += np.sum(block, axis=0, dtype=np.float64)
+            s2[:,:,:,rt] += np.sum(np.square(block, dtype=np.float64), axis=0)
+        avg = s1 / trn_size
+        mst_avg = avg.astype(fpX)
+        mst_std = (np.sqrt(np.maximum(s2 / trn_size - np.square(avg), 0.)) + epsilon).astype(fpX)
+    def features(block, rt):
+        if nonlinearity:
+            block = nonlinearity(block)
+        if zscore:
+            block = np.nan_to_num((block - mst_avg[:,:,:,rt]) / mst_std[:,:,:,rt])
+        return block
+    if not pfr.fitted(projection):
+        print "Learning a %d dimensional feature projection..." % projection['k']
+        sys.stdout.flush()
+        x = np.zeros(shape=(nt,nf), dtype=np.float64)
+        xx = np.zeros(shape=(nf,nf) if projection['mode']=='global' else (nt,nf,nf), dtype=np.float64)
+        for excerpt, rt, block in blocks(trn_size):
+            X = np.asarray(features(block, rt)[:,:,0,:], dtype=np.float64)
+            x[rt] += np.sum(X, axis=0).T
+            if projection['mode']=='global':
+                xx += np.einsum('mft,mgt->fg', X, X)
+            else:
+                xx[rt] += np.einsum('mft,mgt->tfg', X, X)
+        pfr.projection_from_moments(projection, x, xx, trn_size, epsilon=epsilon)
+    print "Projecting modelspace tensor..."
+    sys.stdout.flush()
+    for excerpt, rt, block in blocks(n):
+        out[excerpt,:,:,rt] = pfr.project_block(features(block, rt), projection, rt)
+    return mst_avg, mst_std
+
 
+def _learn_params_graph(nf, bv, bt, nh, verbose=False):
+    '''
+    compiles the training and validation functions of learn_params for (nf, bv, bt) batches and nh hyperparameter
+    combinations. Returns them with the shared variables they use (see graph_cache.cached).
+    '''
+    load_backend()
+    bth = bt*nh
     print 'CREATING SYMBOLS\n'
-    _V  = T.matrix()
-    __V = _V.dimshuffle((0,1,'x'))
-    __lr = theano.shared(fpX(lr))
-    __l2 = theano.shared(fpX(l2))    
+    __lr_s = theano.shared(np.zeros(shape=(1,1,bth), dtype=fpX))
+    __l2_s = theano.shared(np.zeros(shape=(1,1,bth), dtype=fpX))
+    __lr = T.patternbroadcast(__lr_s, (True, True, False))
+    __l2 = T.patternbroadcast(__l2_s, (True, True, False))
     ### request shared memory    
-    __mst_sdata = theano.shared(np.zeros(shape=(n, nf, 1, bt), dtype=fpX))
-    __vox_sdata = theano.shared(np.zeros(shape=(n, bv), dtype=fpX))
+    __mst_sdata = theano.shared(np.zeros(shape=(1, nf, 1, bt), dtype=fpX))
+    __vox_sdata = theano.shared(np.zeros(shape=(1, bv), dtype=fpX))
     __range = T.ivector()
     _smst_batch = __mst_sdata[__range[0]:__range[1]]
-    _fwrf_o = svFWRF(_smst_batch, nf, bv, bt)
+    if nh>1: # every candidate is uploaded once and repeated for its hyperparameter combinations
+        _smst_batch = T.repeat(_smst_batch, nh, axis=3)
+    _fwrf_o = svFWRF(_smst_batch, nf, bv, bth)
     if verbose:
         plu.print_lasagne_network(_fwrf_o, skipnoparam=False)
     ### define and compile the training expressions.       
-    _fwrf_o_reg = __l2 * R.regularize_layer_params(_fwrf_o, R.l2)
     fwrf_o_params = L.get_all_params(_fwrf_o, trainable=True)
 
     _sV = __vox_sdata[__range[0]:__range[1]].dimshuffle((0,1,'x'))
     _fwrf_o_trn_pred = L.get_output(_fwrf_o, deterministic=False)
     _fwrf_o_trn_preloss = O.squared_error(_fwrf_o_trn_pred, _sV).mean(axis=0)
-    _fwrf_o_trn_loss = _fwrf_o_trn_preloss.sum() + _fwrf_o_reg
+    _fwrf_o_trn_loss = _fwrf_o_trn_preloss.sum()
 
     _fwrf_o_val_pred = L.get_output(_fwrf_o, deterministic=True)
     _fwrf_o_val_preloss = O.squared_error(_fwrf_o_val_pred, _sV).mean(axis=0) #average across the batch elements
-    ###
-    __fwrf_o_updates = lasagne.updates.sgd(_fwrf_o_trn_loss, fwrf_o_params, learning_rate=__lr)
-    #__fwrf_o_updates = lasagne.updates.adam(_fwrf_o_trn_loss, fwrf_o_params, learning_rate=self.__lr, beta1=0.5, epsilon=1e-12)
-    print 'COMPILING...'
-    sys.stdout.flush()
-    comp_t = time.time()
+    ### plain sgd on the independent voxelmodel losses, with the learning rate and the l2 penalty (of W only) of each column.
+    ### sgd has no state to reset, so the same compiled function serves every candidate batch.
+    W, b = fwrf_o_params
+    _gW, _gb = T.grad(_fwrf_o_trn_loss, [W, b])
+    __fwrf_o_updates = OrderedDict([(W, W - __lr * (_gW + 2 * __l2 * W)), (b, b - __lr * _gb)])
     fwrf_o_trn_fn = theano.function([__range], updates=__fwrf_o_updates)
     fwrf_o_val_fn = theano.function([__range], _fwrf_o_val_preloss)
-    print '%.2f seconds to compile theano functions' % (time.time()-comp_t)
+    return {'trn_fn': fwrf_o_trn_fn, 'val_fn': fwrf_o_val_fn, 'params': fwrf_o_params, 'mst_sdata': __mst_sdata, 'vox_sdata': __vox_sdata,
+            'lr': __lr_s, 'l2': __l2_s}
 
-    ### shuffle the time series of voxels and mst_data
-    order = np.arange(n, dtype=int)
-    np.random.shuffle(order)
-    mst_data = mst_data[order]
-    voxels = voxels[order]        
+
+def learn_params(
+        mst_data, voxels, w_params, \
+        batches=(1,1,1), val_test_size=100, lr=1e-4, l2=0.0, num_epochs=1, output_val_scores=-1, output_val_every=1, rows=None,
+        verbose=False, dry_run=False):
+    ''' 
+        batches dims are (samples, voxels, candidates)
+
+        rows optionally restricts the fit to these rows of mst_data and voxels (e.g. the training rows of a k-out part).
+        mst_data is only read one candidate batch at a time, in shuffled row order, so it can be a memmap.
+
+        lr and l2 can also be lists. Every (lr, l2) combination is then trained side by side with the candidates, as an
+        extra axis of the same compiled function (bt x len(lr) x len(l2) voxelmodels per candidate batch), and the best
+        combination of every voxel is selected on the holdout set along with its candidate. val_scores holds the best
+        combination of every candidate, and the (lr, l2) values of every voxel (nv, 2) are returned as a 6th value.
+    '''
+    load_backend()
+    assert len(mst_data)==len(voxels), "data/target length mismatch"  
+    _, nf, _, nt = mst_data.shape
+    _, nv = voxels.shape
+    rows = np.arange(len(mst_data), dtype=int) if rows is None else np.asarray(rows, dtype=int)
+    n = len(rows)
+    bn, bv, bt = batches    
+    sweep = np.ndim(lr)>0 or np.ndim(l2)>0
+    hyperparams = np.asarray([(a, c) for a in np.atleast_1d(lr) for c in np.atleast_1d(l2)], dtype=fpX) # (nh, 2), lr major
+    nh = len(hyperparams)
+    bth = bt*nh # the compiled models, candidate major: column t*nh + h
+    nbv, nbt = nv // bv, nt // bt
+    rbv, rbt = nv - nbv * bv, nt - nbt * bt # the residual candidate batch is padded up to bt
+    if verbose:
+        print "Grad. Desc. planned in %d batch with batch size %d and residual %d" % \
+            (int(np.ceil(float(n-val_test_size) / bn)), bn, (n-val_test_size)%bn)
+        print "%d voxel batches of size %d with residual %d" % (nbv, bv, rbv)
+        print "%d candidate batches of size %d with residual %d" % (nbt, bt, rbt)
+        print "for %d voxelmodel fits." % (nv*nt*nh)
+        sys.stdout.flush()     
+
+    print 'COMPILING...'
+    sys.stdout.flush()
+    with pin.phase('learn_params', 'compile') as ph:
+        graph = pgc.cached('learn_params', (nf, bv, bt, nh), lambda: _learn_params_graph(nf, bv, bt, nh, verbose=verbose))
+    print '%.2f seconds to compile (or load) theano functions' % ph.seconds
+    fwrf_o_trn_fn, fwrf_o_val_fn = graph['trn_fn'], graph['val_fn']
+    __mst_sdata, __vox_sdata = graph['mst_sdata'], graph['vox_sdata']
+    fwrf_o_params = graph['params']
+    W, b = fwrf_o_params
+    ### the learning rate and l2 penalty of every compiled model column
+    graph['lr'].set_value(np.tile(hyperparams[:,0], bt).reshape((1,1,bth)))
+    graph['l2'].set_value(np.tile(hyperparams[:,1], bt).reshape((1,1,bth)))
+
+    ### shuffle the time series of voxels. The rows of mst_data are shuffled one candidate batch at a time, when uploaded.
+    with pin.phase('learn_params', 'shuffle', bytes=voxels.nbytes):
+        order = np.arange(n, dtype=int)
+        np.random.shuffle(order)
+        order = rows[order]
+        voxels = voxels[order]        
         
     ### THIS IS WHERE THE MODEL OPTIMIZATION IS PERFORMED ### 
     print "\nVoxel-Candidates model optimization..."
     start_time = time.time()
-    val_batch_scores = np.zeros((bv, bt), dtype=fpX)
+    val_batch_scores = np.zeros((bv, bth), dtype=fpX)
     best_epochs = np.zeros(shape=(nv), dtype=int)
     best_scores = np.full(shape=(nv), fill_value=np.inf, dtype=fpX)
     best_models = np.zeros(shape=(nv), dtype=int)
+    best_hyper = np.zeros(shape=(nv), dtype=int)
 
-    W, b = fwrf_o_params
     best_w_params = [np.zeros(p.shape, dtype=fpX) for p in w_params]      
         
     ### save score history
@@ -523,6 +634,8 @@ def learn_params(
         __vox_sdata.set_value(np.asarray([], dtype=fpX).reshape((0,0)))
         W.set_value(np.asarray([], dtype=fpX).reshape((0,)*len(W.get_value().shape)))
         b.set_value(np.asarray([], dtype=fpX).reshape((0,)*len(b.get_value().shape)))
+        if sweep:
+            return val_scores, best_scores, best_epochs, best_models, best_w_params, hyperparams[best_hyper]
         return val_scores, best_scores, best_epochs, best_models, best_w_params
     ### VOXEL LOOP
     for v, (rv, lv) in tqdm(enumerate(iterate_range(0, nv, bv))):
@@ -530,68 +643,80 @@ def learn_params(
         best_epochs_slice = best_epochs[rv] 
         best_scores_slice = best_scores[rv]
         best_models_slice = best_models[rv] 
+        best_hyper_slice = best_hyper[rv]
         rW, rb = w_params[0][rv,:], w_params[1][rv]
         if lv<bv: #PATCH UP MISSING DATA FOR THE FIXED VOXEL BATCH SIZE
             voxelSlice = np.concatenate((voxelSlice, np.zeros(shape=(n, bv-lv), dtype=fpX)), axis=1)
             rW = np.concatenate((rW, np.zeros(shape=(bv-lv, nf), dtype=fpX)), axis=0)
             rb = np.concatenate((rb, np.zeros(shape=(bv-lv), dtype=fpX)), axis=0)       
-        pW = np.repeat(rW.T, repeats=bt).reshape((nf,bv,bt)) # ALL CANDIDATE MODELS GET THE SAME INITIAL PARAMETER VALUES
-        pb = np.repeat(rb, repeats=bt).reshape((1, bv,bt))      
+        pW = np.repeat(rW.T, repeats=bth).reshape((nf,bv,bth)) # ALL CANDIDATE MODELS GET THE SAME INITIAL PARAMETER VALUES
+        pb = np.repeat(rb, repeats=bth).reshape((1, bv,bth))      
                     
-        set_shared_parameters([__vox_sdata], [voxelSlice])
+        with pin.phase('learn_params', 'upload', bytes=voxelSlice.nbytes):
+            set_shared_parameters([__vox_sdata], [voxelSlice])
         ### CANDIDATE LOOP
-        for t in range(nbt): ## CANDIDATE BATCH LOOP
-            # need to recompile to reset the solver!!! (depending on the solver used)
-            fwrf_o_trn_fn = theano.function([__range], updates=__fwrf_o_updates)
+        for t in range(nbt + int(rbt>0)): ## CANDIDATE BATCH LOOP
+            lt = min(bt, nt - t*bt)
+            lth = lt*nh
             # set the shared parameter values for this candidates. Every candidate restart at the same point.
-            set_shared_parameters(fwrf_o_params+[__mst_sdata], [pW, pb, mst_data[:,:,:,t*bt:(t+1)*bt]])
-            print "\n  Voxel %d:%d of %d, Candidate %d:%d of %d" % (rv[0], rv[-1]+1, nv, t*bt, (t+1)*bt, nt)
+            with pin.phase('learn_params', 'weight_setup', bytes=pW.nbytes+pb.nbytes):
+                set_shared_parameters(fwrf_o_params, [pW, pb])
+            with pin.phase('learn_params', 'upload', bytes=n*nf*bt*4):
+                set_shared_parameters([__mst_sdata], [pad_candidate_batch(mst_data[:,:,:,t*bt:t*bt+lt][order], bt)])
+            print "\n  Voxel %d:%d of %d, Candidate %d:%d of %d" % (rv[0], rv[-1]+1, nv, t*bt, t*bt+lt, nt)
             ### EPOCH LOOP
             epoch_start = time.time()
             for epoch in range(num_epochs):
                 ######## ONE EPOCH OF TRAINING ###########
                 val_batch_scores.fill(0)  
                 # In each epoch, we do a full pass over the training data:
-                for rb, lb in iterate_bounds(0, n-val_test_size, bn):
-                    fwrf_o_trn_fn(rb)
+                with pin.phase('learn_params', 'epoch', epoch=epoch, voxelmodels=lv*lth):
+                    for rb, lb in iterate_bounds(0, n-val_test_size, bn):
+                        fwrf_o_trn_fn(rb)
                 # and one pass over the validation set.  
-                val_batches = 0
-                for rb, lb in iterate_bounds(n-val_test_size, val_test_size, bn): 
-                    loss = fwrf_o_val_fn(rb)
-                    val_batch_scores += loss
-                    val_batches += lb
-                val_batch_scores /= val_batches
+                with pin.phase('learn_params', 'validation', epoch=epoch, voxelmodels=lv*lth):
+                    val_batches = 0
+                    for rb, lb in iterate_bounds(n-val_test_size, val_test_size, bn): 
+                        loss = fwrf_o_val_fn(rb)
+                        val_batch_scores += loss
+                        val_batches += lb
+                    val_batch_scores /= val_batches
                 if verbose:
                     print "    validation <loss>: %.6f" % (val_batch_scores.mean())
                 ### RECORD TIME SERIES ###
-                if epoch%output_val_every==0:
+                if epoch%output_val_every==0: # the best hyperparameters of each candidate
+                    candidate_scores = np.amin(val_batch_scores.reshape((bv, bt, nh)), axis=2)
                     if output_val_scores==-1:
-                        val_scores[int(epoch / output_val_every), rv, t*bt:(t+1)*bt] = val_batch_scores[:lv,:] 
+                        val_scores[int(epoch / output_val_every), rv, t*bt:t*bt+lt] = candidate_scores[:lv,:lt] 
                     elif output_val_scores>0:
-                        val_scores[int(epoch / output_val_every), v*outv:(v+1)*outv, t*bt:(t+1)*bt] = val_batch_scores[:min(outv, lv),:]
+                        val_scores[int(epoch / output_val_every), v*outv:(v+1)*outv, t*bt:t*bt+lt] = candidate_scores[:min(outv, lv),:lt]
                 ##### RECORD MINIMUM SCORE AND MODELS #####
-                best_models_for_this_epoch = np.argmin(val_batch_scores[:lv,:], axis=1)
-                best_scores_for_this_epoch = np.amin(val_batch_scores[:lv,:], axis=1)
+                best_columns_for_this_epoch = np.argmin(val_batch_scores[:lv,:lth], axis=1)
+                best_scores_for_this_epoch = np.amin(val_batch_scores[:lv,:lth], axis=1)
                 # This updates the BEST RELATIVE MODELS, along with their associated scores 
                 best_scores_mask = (best_scores_for_this_epoch<best_scores_slice) #all the voxels that show an improvement
                 best_epochs_slice[best_scores_mask] = epoch  
                 np.copyto(best_scores_slice, best_scores_for_this_epoch, casting='same_kind', where=best_scores_mask)      
-                np.copyto(best_models_slice, best_models_for_this_epoch + t*bt, casting='same_kind', where=best_scores_mask) #notice the +t*bt to return the best model across all models, not just the batch's
+                np.copyto(best_models_slice, best_columns_for_this_epoch // nh + t*bt, casting='same_kind', where=best_scores_mask) #notice the +t*bt to return the best model across all models, not just the batch's
+                np.copyto(best_hyper_slice, best_columns_for_this_epoch % nh, casting='same_kind', where=best_scores_mask)
                 #to select the weight slices we need, we need to specify the voxels that showed improvement AND the models that correspond to these improvements.
-                update_vm_pos = np.zeros((bv, bt), dtype=bool)
-                update_vm_pos[np.arange(lv)[best_scores_mask], best_models_for_this_epoch[best_scores_mask]] = True
-                update_vm_idx = np.arange(bv*bt)[update_vm_pos.flatten()]
+                update_vm_pos = np.zeros((bv, bth), dtype=bool)
+                update_vm_pos[np.arange(lv)[best_scores_mask], best_columns_for_this_epoch[best_scores_mask]] = True
+                update_vm_idx = np.arange(bv*bth)[update_vm_pos.flatten()]
                 # update the best parameter values based on the voxelmodel validation scores.
-                best_w_params[0][np.asarray(rv)[best_scores_mask], :] = (W.get_value().reshape((nf,-1))[:,update_vm_idx]).T
-                best_w_params[1][np.asarray(rv)[best_scores_mask]]    = b.get_value().reshape((-1))[update_vm_idx]   
+                with pin.phase('learn_params', 'gather', bytes=(nf+1)*bv*bth*4):
+                    best_w_params[0][np.asarray(rv)[best_scores_mask], :] = (W.get_value().reshape((nf,-1))[:,update_vm_idx]).T
+                    best_w_params[1][np.asarray(rv)[best_scores_mask]]    = b.get_value().reshape((-1))[update_vm_idx]   
 
             batch_time = time.time()-epoch_start
-            print "    %d Epoch for %d voxelmodels took %.3fs @ %.3f voxelmodels/s" % (num_epochs, lv*bt, batch_time, fpX(lv*bt)/batch_time)
+            print "    %d Epoch for %d voxelmodels took %.3fs @ %.3f voxelmodels/s" % (num_epochs, lv*lth, batch_time, fpX(lv*lth)/batch_time)
+            pin.emit('learn_params', 'candidate_batch', seconds=batch_time, voxels=(rv[0], rv[-1]+1), candidates=(t*bt, t*bt+lt), voxelmodels=lv*lth)
             sys.stdout.flush()
         #end candidate loop    
         best_epochs[rv] = np.copy(best_epochs_slice)
         best_scores[rv] = np.copy(best_scores_slice) ##NECESSARY TO COPY BACK
         best_models[rv] = np.copy(best_models_slice)   
+        best_hyper[rv] = np.copy(best_hyper_slice)
     # end voxel loop 
     # free shared vram
     __mst_sdata.set_value(np.asarray([], dtype=fpX).reshape((0,0,0,0)))
@@ -601,12 +726,149 @@ def learn_params(
 
     full_time = time.time() - start_time
     print "\n---------------------------------------------------------------------"
-    print "%d Epoch for %d voxelmodels took %.3fs @ %.3f voxelmodels/s" % (num_epochs, nv*nt, full_time, fpX(nv*nt)/full_time)
+    print "%d Epoch for %d voxelmodels took %.3fs @ %.3f voxelmodels/s" % (num_epochs, nv*nt*nh, full_time, fpX(nv*nt*nh)/full_time)
+    pin.emit('learn_params', 'total', seconds=full_time, voxelmodels=nv*nt*nh, epochs=num_epochs)
+    if sweep:
+        return val_scores, best_scores, best_epochs, best_models, best_w_params, hyperparams[best_hyper]
     return val_scores, best_scores, best_epochs, best_models, best_w_params
     
 
 
 
+########################################################################
+###              MULTI-SUBJECT FITS                                  ###
+########################################################################
+
+def group_subjects(voxels, samples=None):
+    '''
+    Groups the subjects of the dictionary voxels {subject: (n_s, nv_s)} by identical sample subsets, where samples
+    {subject: (n_s) row indices of the model space tensor} defaults to all the rows, in order.
+    Returns a list of (row indices or None, [subjects]), in the sorted order of the subjects.
+    '''
+    groups, keys = [], {}
+    for s in sorted(voxels.keys()):
+        idx = None if samples is None or samples.get(s) is None else np.asarray(samples[s], dtype=int)
+        key = None if idx is None else tuple(idx.tolist())
+        if key not in keys:
+            keys[key] = len(groups)
+            groups += [(idx, []),]
+        groups[keys[key]][1].append(s)
+    return groups
+
+
+def _subject_columns(subjects, voxels):
+    '''the slice of every subject in the concatenated voxel columns.'''
+    bounds = np.cumsum([0,] + [voxels[s].shape[1] for s in subjects])
+    return dict([(s, slice(bounds[i], bounds[i+1])) for i,s in enumerate(subjects)])
+
+
+def _group_voxels(subjects, voxels, idx, n):
+    '''
+    the voxels of the subjects, concatenated along the voxel axis. With sample indices idx, they are placed in the
+    rows idx of an (n, nv) array, so that learn_params reads these rows of the model space tensor in place.
+    '''
+    group_voxels = np.concatenate([voxels[s] for s in subjects], axis=1).astype(fpX)
+    if idx is None:
+        return group_voxels
+    assert len(np.unique(idx))==len(idx)==len(group_voxels), "subjects %s: the samples do not match the voxel rows" % subjects
+    full = np.zeros(shape=(n, group_voxels.shape[1]), dtype=fpX)
+    full[idx] = group_voxels
+    return full
+
+
+def _split_columns(a, cols, nv, axis):
+    '''a[..., cols] along axis if that axis spans all the nv concatenated voxels, else a unchanged (e.g. [] or sampled scores).'''
+    if isinstance(a, list):
+        return [_split_columns(x, cols, nv, 0) for x in a]
+    if not isinstance(a, np.ndarray) or a.ndim<=axis or a.shape[axis]!=nv:
+        return a
+    return a[(slice(None),)*axis + (cols,)]
+
+
+def learn_params_multi(mst_data, voxels, w_params=None, samples=None, **kwargs):
+    '''
+    Fits several subjects against one shared model space tensor. voxels is a dictionary {subject: (n_s, nv_s)} whose
+    rows are the rows samples[subject] of mst_data (all the rows by default), w_params {subject: [W, b]} are the
+    initial parameters (zeros by default) and kwargs are passed to learn_params.
+
+    The subjects with the same samples are concatenated along the voxel axis and fitted in a single call of
+    learn_params, so that every candidate batch is uploaded, and every epoch run, once for all of them. They share the
+    same shuffled holdout set. The subjects with different samples, even overlapping ones, are fitted in separate
+    passes (one per distinct sample set), each reading its rows of mst_data in place (the rows of learn_params), without
+    copying the model space tensor. Returns {subject: (val_scores, best_scores, best_epochs, best_candidates, best_w_params)},
+    and the hyperparameters of every voxel with lists of lr or l2.
+    '''
+    nf = mst_data.shape[1]
+    results = {}
+    for idx, subjects in group_subjects(voxels, samples):
+        cols = _subject_columns(subjects, voxels)
+        group_voxels = _group_voxels(subjects, voxels, idx, len(mst_data))
+        nv = group_voxels.shape[1]
+        if w_params is None:
+            group_params = [np.zeros(shape=(nv, nf), dtype=fpX), np.zeros(shape=(nv), dtype=fpX)]
+        else:
+            group_params = [np.concatenate([w_params[s][i] for s in subjects], axis=0).astype(fpX) for i in range(2)]
+        print "\n### Subjects %s: %d samples, %d voxels ###" % (', '.join([str(s) for s in subjects]), len(group_voxels) if idx is None else len(idx), nv)
+        group_results = learn_params(mst_data, group_voxels, group_params, rows=idx, **kwargs)
+        for s in subjects: # val_scores, then best_scores, best_epochs, best_candidates, best_w_params (and the hyperparameters)
+            results[s] = (_split_columns(group_results[0], cols[s], nv, 1),) + \
+                tuple([_split_columns(r, cols[s], nv, 0) for r in group_results[1:]])
+    return results
+
+
+def kout_learn_params_multi(mst_data, voxels, val_sample_order, w_params=None, samples=None, **kwargs):
+    '''
+    A multi-subject variant of kout_learn_params (see learn_params_multi). val_sample_order is either one order of the
+    samples of every subject or a dictionary {subject: order}, which has to be the same for the subjects with the same
+    samples. As in learn_params_multi, only the subjects with the same samples share their passes over mst_data, which
+    is never copied. Returns {subject: model}, in the format of kout_learn_params, over the samples of each subject.
+    '''
+    nf = mst_data.shape[1]
+    models = {}
+    for idx, subjects in group_subjects(voxels, samples):
+        cols = _subject_columns(subjects, voxels)
+        group_voxels = _group_voxels(subjects, voxels, idx, len(mst_data))
+        nv = group_voxels.shape[1]
+        if w_params is None:
+            group_params = [np.zeros(shape=(nv, nf), dtype=fpX), np.zeros(shape=(nv), dtype=fpX)]
+        else:
+            group_params = [np.concatenate([w_params[s][i] for s in subjects], axis=0).astype(fpX) for i in range(2)]
+        order = val_sample_order
+        if isinstance(val_sample_order, dict):
+            order = val_sample_order[subjects[0]]
+            assert np.all([np.array_equal(val_sample_order[s], order) for s in subjects]), \
+                "subjects %s share their samples but not their validation order" % subjects
+        print "\n### Subjects %s: %d samples, %d voxels ###" % (', '.join([str(s) for s in subjects]), len(group_voxels) if idx is None else len(idx), nv)
+        model = kout_learn_params(mst_data, group_voxels, order, group_params, rows=idx, **kwargs)
+        for s in subjects:
+            models[s] = {}
+            for k,v in model.items():
+                if isinstance(v, dict): # one resampling block, whose val_mask is over the samples
+                    models[s][k] = dict([(kk, vv if kk=='val_mask' else _split_columns(vv, cols[s], nv, 1 if kk=='val_scores' else 0)) \
+                                         for kk,vv in v.items()])
+                else:
+                    models[s][k] = _split_columns(v, cols[s], nv, 1 if k=='val_pred' else 0)
+    return models
+
+
+def _get_prediction_graph(nf, bv):
+    '''compiles the prediction functions of get_prediction for bv voxels, and returns them with their parameters.'''
+    load_backend()
+    print 'CREATING SYMBOLS\n'
+    _V  = T.matrix()
+    __V = _V.dimshuffle((0,1,'x'))
+    _mst_data = T.tensor4()
+    _fwrf_t = pvFWRF(_mst_data, nf, bv, 1)   
+    fwrf_t_params = L.get_all_params(_fwrf_t, trainable=True)
+        
+    _fwrf_t_val_pred = L.get_output(_fwrf_t, deterministic=True)   
+    _fwrf_t_val_cc = ((_fwrf_t_val_pred - _fwrf_t_val_pred.mean(axis=0, keepdims=True)) * (__V - __V.mean(axis=0, keepdims=True))).mean(axis=0) / \
+        T.sqrt(T.sqr(_fwrf_t_val_pred - _fwrf_t_val_pred.mean(axis=0, keepdims=True)).mean(axis=0) * T.sqr(__V - __V.mean(axis=0, keepdims=True)).mean(axis=0))         
+    fwrf_t_pred_fn = theano.function([_mst_data], _fwrf_t_val_pred)
+    fwrf_t_test_fn = theano.function([_mst_data, _V], [_fwrf_t_val_pred, _fwrf_t_val_cc])        
+    return {'pred_fn': fwrf_t_pred_fn, 'test_fn': fwrf_t_test_fn, 'params': fwrf_t_params}
+
+
 def get_prediction(mst_data, voxels, mst_rel_models, w_params, batches=(1,1)):
     '''
     batches dims are (samples, voxels)
@@ -620,6 +882,7 @@ def get_prediction(mst_data, voxels, mst_rel_models, w_params, batches=(1,1)):
     Returns:
      voxel prediction, per voxel corr_coeff
     '''
+    load_backend()
     n, nf, _, nt = mst_data.shape
     _, nv = voxels.shape
     bn, bv = batches
@@ -631,22 +894,12 @@ def get_prediction(mst_data, voxels, mst_rel_models, w_params, batches=(1,1)):
     assert n<=bn, "validation needs to be done in a single batch."
     print "%d voxel batches of size %d with residual %d" % (nbv, bv, rbv) 
 
-    print 'CREATING SYMBOLS\n'
-    _V  = T.matrix()
-    __V = _V.dimshuffle((0,1,'x'))
-    _mst_data = T.tensor4()
-    _fwrf_t = pvFWRF(_mst_data, nf, bv, 1)   
-    fwrf_t_params = L.get_all_params(_fwrf_t, trainable=True)
-        
-    _fwrf_t_val_pred = L.get_output(_fwrf_t, deterministic=True)   
-    _fwrf_t_val_cc = ((_fwrf_t_val_pred - _fwrf_t_val_pred.mean(axis=0, keepdims=True)) * (__V - __V.mean(axis=0, keepdims=True))).mean(axis=0) / \
-        T.sqrt(T.sqr(_fwrf_t_val_pred - _fwrf_t_val_pred.mean(axis=0, keepdims=True)).mean(axis=0) * T.sqr(__V - __V.mean(axis=0, keepdims=True)).mean(axis=0))         
     print 'COMPILING...'
     sys.stdout.flush()
-    comp_t = time.time()
-    fwrf_t_pred_fn = theano.function([_mst_data], _fwrf_t_val_pred)
-    fwrf_t_test_fn = theano.function([_mst_data, _V], [_fwrf_t_val_pred, _fwrf_t_val_cc])        
-    print '%.2f seconds to compile theano functions' % (time.time()-comp_t)
+    with pin.phase('get_prediction', 'compile') as ph:
+        graph = pgc.cached('get_prediction', (nf, bv), lambda: _get_prediction_graph(nf, bv))
+    print '%.2f seconds to compile (or load) theano functions' % ph.seconds
+    fwrf_t_test_fn, fwrf_t_params = graph['test_fn'], graph['params']
 
     predictions = np.zeros(shape=(n, nv), dtype=fpX)
     cc_scores   = np.zeros(shape=(nv), dtype=fpX)
@@ -664,15 +917,67 @@ def get_prediction(mst_data, voxels, mst_rel_models, w_params, batches=(1,1)):
         pW = rW.T.reshape((nf,bv,1))
         pb = rb.reshape((1,bv,1))      
 
-        pv_mst_data = mst_data[:, :, 0, vm_slice, np.newaxis]
-        set_shared_parameters(fwrf_t_params, [pW, pb])
+        with pin.phase('get_prediction', 'gather') as ph:
+            pv_mst_data = mst_data[:, :, 0, vm_slice, np.newaxis]
+            ph.add(bytes=pv_mst_data.nbytes)
+        with pin.phase('get_prediction', 'weight_setup', bytes=pW.nbytes+pb.nbytes):
+            set_shared_parameters(fwrf_t_params, [pW, pb])
         ###            
-        pred, cc = fwrf_t_test_fn(pv_mst_data, voxelSlice)
+        with pin.phase('get_prediction', 'compute', voxels=lv, bytes=pv_mst_data.nbytes+voxelSlice.nbytes):
+            pred, cc = fwrf_t_test_fn(pv_mst_data, voxelSlice)
         predictions[:, rv], cc_scores[rv] = pred[:,:lv,0], cc[:lv,0]
     return predictions, cc_scores
 
 
 
+def get_partition_predictions(mst_data, voxels, mst_rel_models, w_params, partitions, leave_one_out=False, batch_size=None, max_bytes=512*1024**2):
+    '''
+    Predictions of the fitted models restricted to groups of features, for all the groups in one pass over mst_data.
+
+    Arguments:
+     mst_data, voxels, mst_rel_models, w_params: as get_prediction.
+     partitions: a list of feature index groups (index arrays, lists or slices), e.g. one per feature map resolution.
+     leave_one_out: also predict with all the features but each group.
+     batch_size: voxels per block (default: as many as fit their (n, nf) candidate columns in max_bytes).
+
+    The candidate columns of a block of voxels are contracted with the weights of each group's features in turn, so
+    that no (n, nf, voxels) product is built; the leave-one-out predictions are the full ones minus each group's.
+    Every partial prediction includes the bias, as the masked parameters of the template notebooks.
+
+    Returns a dictionary with the full prediction 'pred' (n, nv) and its correlation 'cc' (nv), the partial predictions
+    'partition_pred' (ng, n, nv), their correlations 'partition_cc' (ng, nv) and shares of the full correlation
+    'partition_r' (ng, nv) (see scoring_utility.column_partition_corr), and likewise 'loo_pred', 'loo_cc', 'loo_r'.
+    '''
+    n, nf, _, nt = mst_data.shape
+    _, nv = voxels.shape
+    assert len(mst_data)==len(voxels)
+    assert len(mst_rel_models)==nv
+    ng = len(partitions)
+    groups = [p if isinstance(p, slice) else np.asarray(p) for p in partitions] # slices are views of the block
+    if batch_size is None:
+        batch_size = int(max(1, min(nv, max_bytes // (n * nf * np.dtype(fpX).itemsize))))
+    pred = np.zeros(shape=(n, nv), dtype=fpX)
+    partition_pred = np.zeros(shape=(ng, n, nv), dtype=fpX)
+    for rv, lv in tqdm(iterate_range(0, nv, batch_size)):
+        with pin.phase('get_partition_predictions', 'gather') as ph:
+            x = mst_data[:, :, 0, mst_rel_models[rv]]                   # (n, nf, bv)
+            ph.add(bytes=x.nbytes)
+        with pin.phase('get_partition_predictions', 'compute', voxels=lv):
+            W, b = w_params[0][rv], w_params[1][rv]
+            pred[:, rv] = np.einsum('nfv,vf->nv', x, W) + b
+            for g,f in enumerate(groups):
+                partition_pred[g][:, rv] = np.einsum('nfv,vf->nv', x[:, f], W[:, f]) + b
+    results = {'pred': pred, 'cc': psu.column_corr(pred, voxels), 'partition_pred': partition_pred,
+               'partition_cc': np.stack([psu.column_corr(p, voxels) for p in partition_pred]),
+               'partition_r': np.stack([psu.column_partition_corr(p, pred, voxels) for p in partition_pred])}
+    if leave_one_out:
+        loo_pred = pred[np.newaxis] - partition_pred + w_params[1]
+        results.update({'loo_pred': loo_pred, 'loo_cc': np.stack([psu.column_corr(p, voxels) for p in loo_pred]),
+                        'loo_r': np.stack([psu.column_partition_corr(p, pred, voxels) for p in loo_pred])})
+    return results
+
+
+
 def real_space_model(mst_rel_models, sharedModel_specs, mst_avg=None, mst_std=None):
     '''
     Convert candidate in the model space tensor into real space, per-voxel models.
@@ -717,6 +1022,7 @@ def get_symbolic_prediction(_symbolicFeatureMaps, featureMapSizes, rf_params, w_
     Note: There is quite a bit of repetition due the idiosyncracies of the training procedure. Make sure
     that this compiled expression returns the same values has validate_models when run on the same data.
     '''
+    load_backend()
     shared_var = {}
     nf = np.sum([fm[1] for fm in featureMapSizes])
     nv = rf_params.shape[0]
@@ -751,13 +1057,18 @@ def get_symbolic_prediction(_symbolicFeatureMaps, featureMapSizes, rf_params, w_
 ################################################################
 ###                 K-OUT VARIANTS                           ###
 ################################################################
-def kout_learn_params(mst_data, voxels, val_sample_order, w_params, batches=(1,1,1), val_part_size=1, holdout_size=1, lr=1e-4, l2=0.0, num_epochs=1, verbose=False, dry_run=False, test_run=False):
+def kout_learn_params(mst_data, voxels, val_sample_order, w_params, batches=(1,1,1), val_part_size=1, holdout_size=1, lr=1e-4, l2=0.0, num_epochs=1, rows=None, verbose=False, dry_run=False, test_run=False):
     '''
         A k-out variant of the fwrf shared_model_training routine.
 
         batches dims are (samples, voxels, candidates)
+
+        rows optionally restricts the k-out to these rows of mst_data and voxels, as in learn_params. val_sample_order,
+        the val_mask and val_pred are then over these rows. The training rows of every part are passed to learn_params
+        as rows, so that mst_data is not copied.
     '''
-    data_size, nv = voxels.shape
+    rows = np.arange(len(mst_data), dtype=int) if rows is None else np.asarray(rows, dtype=int)
+    data_size, nv = len(rows), voxels.shape[1]
     num_val_part = int(data_size / val_part_size)
     trn_size = data_size - val_part_size
 
@@ -774,16 +1085,14 @@ def kout_learn_params(mst_data, voxels, val_sample_order, w_params, batches=(1,1
         trn_mask = np.ones(data_size, dtype=bool)
         trn_mask[val_sample_order[vs]] = False # leave out the first batch of validation point
             
-        trn_mst_data = mst_data[trn_mask]
-        val_mst_data = mst_data[~trn_mask]
-
-        trn_voxel_data = voxels[trn_mask, 0:tnv]
-        val_voxel_data = voxels[~trn_mask, 0:tnv]
+        val_mst_data = mst_data[rows[~trn_mask]]
+        val_voxel_data = voxels[rows[~trn_mask], 0:tnv]
         voxelParams = [p[0:tnv] for p in w_params]
         ### fit this part ###
-        val_scores, best_scores, best_epochs, best_candidates, best_w_params = learn_params(\
-            trn_mst_data, trn_voxel_data, w_params, batches=batches,\
+        results = learn_params(\
+            mst_data, voxels[:, 0:tnv], voxelParams, batches=batches, rows=rows[trn_mask],\
             val_test_size=holdout_size, lr=lr, l2=l2, num_epochs=num_epochs, output_val_scores=-1, output_val_every=1, verbose=verbose, dry_run=dry_run)
+        val_scores, best_scores, best_epochs, best_candidates, best_w_params = results[:5]
         val_pred, val_cc = get_prediction(val_mst_data, val_voxel_data, best_candidates, best_w_params, batches=(val_part_size, batches[1]))
 
         model[k] = {}
@@ -794,6 +1103,8 @@ def kout_learn_params(mst_data, voxels, val_sample_order, w_params, batches=(1,1
         model[k]['candidates'] = best_candidates
         model[k]['val_mask']  = ~trn_mask
         model[k]['val_cc']    = val_cc    
+        if len(results)>5:
+            model[k]['hyperparams'] = results[5]
         #####################
         model['n_parts'] = 1       
         model['val_pred'] = val_pred
@@ -801,7 +1112,7 @@ def kout_learn_params(mst_data, voxels, val_sample_order, w_params, batches=(1,1
        
     else:
         # The more parts, the more data each part has to learn the prediction. It's a leave k-out.
-        full_val_pred = np.zeros(shape=voxels.shape, dtype=fpX)
+        full_val_pred = np.zeros(shape=(data_size, nv), dtype=fpX)
         for k,(vs,ls) in enumerate(iterate_slice(0, data_size, val_part_size)):
             print "################################"
             print "###   Resampling block %2d   ###" % k
@@ -809,15 +1120,13 @@ def kout_learn_params(mst_data, voxels, val_sample_order, w_params, batches=(1,1
             trn_mask = np.ones(data_size, dtype=bool)
             trn_mask[val_sample_order[vs]] = False # leave out the first batch of validation point
             
-            trn_mst_data = mst_data[trn_mask]
-            val_mst_data = mst_data[~trn_mask]
-
-            trn_voxel_data = voxels[trn_mask]
-            val_voxel_data = voxels[~trn_mask]
+            val_mst_data = mst_data[rows[~trn_mask]]
+            val_voxel_data = voxels[rows[~trn_mask]]
             ### fit this part ###
-            val_scores, best_scores, best_epochs, best_candidates, best_w_params = learn_params(\
-                trn_mst_data, trn_voxel_data, w_params, batches=batches,\
+            results = learn_params(\
+                mst_data, voxels, w_params, batches=batches, rows=rows[trn_mask],\
                 val_test_size=holdout_size, lr=lr, l2=l2, num_epochs=num_epochs, output_val_scores=0, output_val_every=10, verbose=verbose, dry_run=dry_run)
+            val_scores, best_scores, best_epochs, best_candidates, best_w_params = results[:5]
             val_pred, val_cc = get_prediction(val_mst_data, val_voxel_data, best_candidates, best_w_params, batches=(val_part_size, batches[1]))
 
             model[k] = {}
@@ -827,13 +1136,12 @@ def kout_learn_params(mst_data, voxels, val_sample_order, w_params, batches=(1,1
             model[k]['candidates'] = best_candidates
             model[k]['val_mask']  = ~trn_mask
             model[k]['val_cc']    = val_cc    
+            if len(results)>5:
+                model[k]['hyperparams'] = results[5]
             #####################
             full_val_pred[~trn_mask] = val_pred 
-        ##
-        full_cc = np.zeros(nv)
-        for v in range(nv):
-            full_cc[v] = np.corrcoef(full_val_pred[:,v], voxels[:,v])[0,1]
         ## global pred and cc
+        full_cc = psu.column_corr(full_val_pred, voxels[rows])
         model['n_parts'] = num_val_part
         model['val_pred'] = full_val_pred
         model['val_cc'] = full_cc
@@ -862,9 +1170,7 @@ def kout_get_prediction(mst_data, voxels, model, batches=(1,1)):
 
         val_pred,_ = get_prediction(val_mst_data, val_voxel_data, best_candidates, best_w_params, batches=batches)
         full_val_pred[val_mask] = val_pred 
-    full_cc = np.zeros(nv)
-    for v in range(nv):
-        full_cc[v] = np.corrcoef(full_val_pred[:,v], voxels[:,v])[0,1]
+    full_cc = psu.column_corr(full_val_pred, voxels)
     return full_val_pred, full_cc
 
 
@@ -0,0 +1,72 @@
+'''
+The lasagne layers of the fwrf models, imported by fwrf.load_backend() when the theano backend is first needed.
+'''
+import theano
+import theano.tensor as T
+
+import lasagne
+import lasagne.layers as L
+import lasagne.nonlinearities as NL
+
+
+class pvFWRFLayer(L.Layer):
+    '''
+    pvFWRFLayer is a new lasagne layer for 'per voxel (pv)' candidate receptive field models. It assumes an input
+    of shape (bn, nf, bv, bt) where bn is a batch of the time series, nf are the total number of features, bv is a batch of voxels and bt is a batch of candidate rf.
+
+    The return values correspond to the predicted voxel activities, of shape (bn, nv, nt)
+    '''
+    def __init__(self, incoming, W=lasagne.init.Normal(0.01),  b=lasagne.init.Constant(0.), nonlinearity=None, **kwargs):
+        super(pvFWRFLayer, self).__init__(incoming, **kwargs)
+        self.nf, self.nv, self.nt = self.input_shape[1:4]
+        self.W = self.add_param(W, (self.nf, self.nv, self.nt), name='W')
+        if b is not None:
+            self.b = self.add_param(b, (1, self.nv, self.nt), name='b', regularizable=False)
+            self.b = T.patternbroadcast(self.b, (True, False, False))
+        else:
+            self.b = None
+        self.nonlinearity = (NL.identity if nonlinearity is None else nonlinearity)
+        
+    def get_output_for(self, input, **kwargs):
+        _pred = T.batched_tensordot(input.flatten(ndim=3).dimshuffle((2,0,1)), \
+                self.W.flatten(ndim=2).dimshuffle((1,0)), axes=[[2],[1]]) \
+                .dimshuffle((1,0)).reshape((input.shape[0],self.nv,self.nt))
+        if self.b is not None:
+            _pred = _pred + self.b
+        return self.nonlinearity(_pred)
+
+    def get_output_shape_for(self, input_shape):
+        return (input_shape[0], self.nv, self.nt)
+    
+
+
+
+class svFWRFLayer(L.Layer):
+    '''
+    svFWRFLayer is a new lasagne layer for 'shared voxel (sv)' candidate receptive field models. It assumes an input
+    of shape (bn, nf, bt) where bn is a batch of the time series, nf are the total number of features, bv is a batch of voxels
+    and bt is a batch of candidate rf.
+
+    The return values correspond to the predicted voxel activities, of shape (bn, nv, nt)
+    '''
+    def __init__(self, incoming, nvoxels, W=lasagne.init.Normal(0.01),  b=lasagne.init.Constant(0.), nonlinearity=None, **kwargs):
+        super(svFWRFLayer, self).__init__(incoming, **kwargs)
+        self.nf = self.input_shape[1]
+        self.nt = self.input_shape[2]
+        self.nv = nvoxels
+        self.W = self.add_param(W, (self.nf, self.nv, self.nt), name='W')
+        if b is not None:
+            self.b = self.add_param(b, (1, self.nv, self.nt), name='b', regularizable=False)
+            self.b = T.patternbroadcast(self.b, (True, False, False))
+        else:
+            self.b = None
+        self.nonlinearity = (NL.identity if nonlinearity is None else nonlinearity)
+        
+    def get_output_for(self, input, **kwargs):
+        _pred = T.batched_tensordot(input.dimshuffle((2,0,1)), self.W.dimshuffle((2,0,1)), axes=[[2],[1]]).dimshuffle((1,2,0))
+        if self.b is not None:
+            _pred = _pred + self.b
+        return self.nonlinearity(_pred)
+
+    def get_output_shape_for(self, input_shape):
+        return (input_shape[0], self.nv, self.nt)
@@ -0,0 +1,112 @@
+'''
+Cache of the compiled theano graphs of fwrf.
+
+The graphs of learn_params and get_prediction only depend on a few batch dimensions (their shape signature), yet
+every call used to build and compile them again. cached(name, signature, build) keeps the result of build(), the
+compiled functions along with the shared variables they read and update, in memory for the rest of the process and,
+if a cache directory is set, pickled on disk so that fresh processes (workers, short jobs) only unpickle them:
+
+    import graph_cache
+    graph_cache.enable('/scratch/fwrf_graphs')   # or export FWRF_GRAPH_CACHE=/scratch/fwrf_graphs
+
+The disk entries are keyed by the name, the signature and the theano version, floatX and device. Theano does not
+reoptimize unpickled functions (reoptimize_unpickled_function=False), and the compiled c modules are reused from
+its own compiledir.
+'''
+import os
+import sys
+import socket
+import pickle
+import hashlib
+from contextlib import contextmanager
+
+
+cache_dir = os.environ.get('FWRF_GRAPH_CACHE', None)
+_memory = {}
+_bypass = 0
+
+def enable(path):
+    '''stores the compiled graphs in path (created if needed) from now on.'''
+    global cache_dir
+    cache_dir = path
+
+def disable():
+    '''keeps the compiled graphs in memory only.'''
+    global cache_dir
+    cache_dir = None
+
+@contextmanager
+def bypassed():
+    '''within the block, every graph is built again, without reading or filling the caches (e.g. to time the compilation).'''
+    global _bypass
+    _bypass += 1
+    try:
+        yield
+    finally:
+        _bypass -= 1
+
+def clear(disk=False):
+    '''forgets the graphs held in memory and, if disk, deletes the cache directory entries.'''
+    _memory.clear()
+    if disk and cache_dir is not None and os.path.exists(cache_dir):
+        for f in os.listdir(cache_dir):
+            if f.endswith('.pkl'):
+                os.remove(os.path.join(cache_dir, f))
+
+
+def key(name, signature):
+    import theano
+    config = (name, tuple(signature), theano.__version__, theano.config.floatX, theano.config.device)
+    return '%s_%s' % (name, hashlib.sha1(repr(config)).hexdigest()[:16])
+
+
+def _load(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e: # written by another theano version, truncated, ...
+        print "graph cache: ignoring %s (%s)" % (path, e)
+        return None
+
+def _store(path, graph):
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, 50000)) # theano graphs are deep
+    tmp = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp, 'wb') as f:
+            pickle.dump(graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except Exception as e:
+        print "graph cache: could not store %s (%s)" % (path, e)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    finally:
+        sys.setrecursionlimit(limit)
+
+
+def cached(name, signature, build):
+    '''
+    Returns build() for this name and shape signature, from memory, from the cache directory, or by calling it.
+    build returns a dictionary of compiled functions and of the shared variables they use, which are pickled
+    together so that the loaded functions still read and update the returned shared variables.
+    '''
+    if _bypass:
+        return build()
+    k = key(name, signature)
+    if k in _memory:
+        return _memory[k]
+    graph = None
+    path = None if cache_dir is None else os.path.join(cache_dir, k + '.pkl')
+    if path is not None and os.path.exists(path):
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 50000))
+        graph = _load(path)
+        sys.setrecursionlimit(limit)
+    if graph is None:
+        graph = build()
+        if path is not None:
+            _store(path, graph)
+    _memory[k] = graph
+    return graph
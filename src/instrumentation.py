@@ -0,0 +1,166 @@
+'''
+Event hooks for the fwrf stages.
+
+The stages (fwrf.model_space_tensor, learn_params, get_prediction, the gabor feature maps, ...) report what they do
+as events, i.e. dictionaries such as
+
+    {'stage': 'learn_params', 'event': 'epoch', 'seconds': 0.41, 'bytes': 0, 'peak_memory': 5123342336, ...}
+
+Phases are timed events (compile, weight setup, upload, epoch, validation, gather, ...). Nothing is recorded unless a
+hook is registered, e.g.
+
+    import instrumentation as pin
+    summary = pin.phase_summary()
+    with pin.recording(pin.json_lines_hook('run.jsonl'), summary):
+        ...fwrf.learn_params(...)
+    summary.report()
+
+The gaborizer, which does not depend on this package, takes a hook=functools.partial(pin.emit, 'gabor') argument.
+'''
+import sys
+import time
+import json
+import resource
+from contextlib import contextmanager
+import numpy as np
+
+
+########################################################################
+###              HOOKS                                               ###
+########################################################################
+
+_hooks = []
+
+def add_hook(hook):
+    '''hook is called with every event dictionary.'''
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+def remove_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+def clear_hooks():
+    del _hooks[:]
+
+def active():
+    return len(_hooks)>0
+
+@contextmanager
+def recording(*hooks):
+    '''registers hooks for the duration of a with block.'''
+    for h in hooks:
+        add_hook(h)
+    try:
+        yield hooks
+    finally:
+        for h in hooks:
+            remove_hook(h)
+
+
+########################################################################
+###              MEASUREMENTS                                        ###
+########################################################################
+
+def peak_memory():
+    '''peak resident memory of this process so far, in bytes.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform=='darwin' else peak*1024
+
+def nbytes(*arrays):
+    '''total size in bytes of arrays (or lists of arrays). Anything without an nbytes counts for 0.'''
+    total = 0
+    for a in arrays:
+        if isinstance(a, (list, tuple)):
+            total += nbytes(*a)
+        else:
+            total += int(getattr(a, 'nbytes', 0))
+    return total
+
+
+########################################################################
+###              EVENTS                                              ###
+########################################################################
+
+def emit(stage, event, **fields):
+    '''sends an event to all the registered hooks. Does nothing (and measures nothing) when there is none.'''
+    if not _hooks:
+        return
+    record = dict(fields, stage=stage, event=event, time=time.time(), peak_memory=peak_memory())
+    for h in list(_hooks):
+        h(record)
+
+
+class phase(object):
+    '''
+    Context manager that times a phase of a stage and emits it on exit, with the elapsed seconds and any fields,
+    e.g.
+
+        with pin.phase('learn_params', 'upload', bytes=pin.nbytes(block)):
+            shared.set_value(block)
+
+    Fields can also be added from within the block with add(bytes=...).
+    '''
+    def __init__(self, stage, name, **fields):
+        self.stage = stage
+        self.name = name
+        self.fields = fields
+
+    def add(self, **fields):
+        for k,v in fields.items():
+            self.fields[k] = self.fields.get(k, 0) + v
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds = time.time() - self.start
+        emit(self.stage, self.name, seconds=self.seconds, **self.fields)
+
+
+########################################################################
+###              STANDARD HOOKS                                      ###
+########################################################################
+
+class json_lines_hook(object):
+    '''writes every event as one json line to filename (appending), or to stdout.'''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.f = sys.stdout if filename is None else open(filename, 'a')
+
+    def __call__(self, record):
+        self.f.write(json.dumps(record, sort_keys=True, default=_json_default) + '\n')
+        self.f.flush()
+
+    def close(self):
+        if self.filename is not None:
+            self.f.close()
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return repr(obj)
+
+
+class phase_summary(object):
+    '''accumulates the count, seconds and bytes of every (stage, event), and the overall peak memory.'''
+    def __init__(self):
+        self.totals = {}
+        self.peak_memory = 0
+
+    def __call__(self, record):
+        key = (record['stage'], record['event'])
+        count, seconds, moved = self.totals.get(key, (0, 0., 0))
+        self.totals[key] = (count+1, seconds+record.get('seconds', 0.), moved+record.get('bytes', 0))
+        self.peak_memory = max(self.peak_memory, record['peak_memory'])
+
+    def report(self):
+        '''prints the phases by decreasing total time.'''
+        print "%-24s %-16s %8s %12s %12s" % ('stage', 'event', 'count', 'seconds', 'Mb')
+        for (stage, event), (count, seconds, moved) in sorted(self.totals.items(), key=lambda kv: -kv[1][1]):
+            print "%-24s %-16s %8d %12.3f %12.1f" % (stage, event, count, seconds, float(moved) / 1024**2)
+        print "peak memory %.1f Mb" % (float(self.peak_memory) / 1024**2)
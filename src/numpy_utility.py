@@ -1,5 +1,4 @@
 import numpy as np
-import scipy.io as sio
 from scipy.special import erf
 import math
 
@@ -55,6 +54,33 @@ def make_gaussian_mass_stack(xs, ys, sigmas, n_pix, size=None, dtype=np.float32)
         _,_,Z[i,:,:] = make_gaussian_mass(xs[i], ys[i], sigmas[i], n_pix, size=size, dtype=dtype)
     return X, Y, Z
 
+def gaussian_mass_profile(c, mu, sigma, dpix):
+    '''
+    The gaussian mass of make_gaussian_mass is separable, Z[i,j] = p(-c[i], y, sigma) * p(c[j], x, sigma), with c the pixel
+    centers. Returns the 1d factor p at the pixel centers c (1, n_pix) for centers mu (m, 1) and sigma (m, 1), and its
+    derivatives with respect to mu and sigma, each (m, n_pix). Like make_gaussian_mass, the gaussian is integrated over
+    each pixel (erf) when sigma < dpix and sampled at the pixel centers otherwise.
+    '''
+    u = c - mu
+    small = sigma < dpix
+    ## sampled gaussian
+    g = dpix / (np.sqrt(2*np.pi) * sigma) * np.exp(-u**2 / (2*sigma**2))
+    g_mu = g * u / sigma**2
+    g_s = g * (u**2 / sigma**3 - 1. / sigma)
+    ## integrated gaussian
+    ap, am = (u + dpix/2) / (np.sqrt(2)*sigma), (u - dpix/2) / (np.sqrt(2)*sigma)
+    ep, em = np.exp(-ap**2), np.exp(-am**2)
+    e = 0.5 * (erf(ap) - erf(am))
+    e_mu = -(ep - em) / (np.sqrt(2*np.pi) * sigma)
+    e_s = -(ep*ap - em*am) / (np.sqrt(np.pi) * sigma)
+    return np.where(small, e, g), np.where(small, e_mu, g_mu), np.where(small, e_s, g_s)
+
+def pixel_centers(n_pix, size=None):
+    '''the coordinates of the pixel centers of make_gaussian_mass along x (along y, they are negated).'''
+    deg = float(n_pix) if size==None else size
+    dpix = float(deg) / n_pix
+    return -deg/2. + dpix*(np.arange(n_pix, dtype=np.float64) + 0.5), dpix
+
 
 
 def pruning_mask(shaped_as, prune_ratio=0.0):
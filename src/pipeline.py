@@ -0,0 +1,417 @@
+'''
+Command line runner of the fwrf pipeline, as a graph of cached stages described by a json config file:
+
+    python -m src.pipeline config.json [--cache_dir fwrf_cache] [--stages predict] [--force train] [--status]
+
+    {
+      "data":        {"stimuli": "stim.npy", "voxels": "voxels.npy", "trn_size": 1750},
+      "features":    {"kind": "gabor", "n_orientations": 4, "deg_per_stimulus": 20, "cycles_per_deg": [0.25, 6.0, 12],
+                      "pix_per_cycle": 3.1333, "complex_cell": true, "nonlinearity": "log_sqrt"},
+      "model_space": {"view_angle": 20, "grid": [26, 26, 12], "sigma": [0.5, 8.0], "batches": [500, 676], "engine": "theano"},
+      "train":       {"method": "sgd", "batches": [200, 1000, 1352], "val_test_size": 350, "lr": 1e-3, "l2": 0.0, "num_epochs": 40},
+      "predict":     {"partitions": "resolution", "leave_one_out": false},
+      "output":      "gabor_fwrf_results.h5py"
+    }
+
+The stages are
+
+    features      the feature maps: computed from the stimuli ("kind": "gabor"), or read from .npy files ("kind": "npy",
+                  "fmaps": [one file per resolution]) or from a feature map store ("kind": "store", "store": file)
+    model_space   fwrf.model_space_tensor of the feature maps, z-scored on the first trn_size samples
+    train         the fit on the first trn_size samples: fwrf.learn_params ("method": "sgd") or the closed form ridge
+                  regression of sufficient_stats.fit_model_space_tensor ("method": "closed_form")
+    kout          fwrf.kout_learn_params with the train arguments, if the config has a "kout" section
+                  ({"val_part_size": ..., "holdout_size": ..., "seed": 0})
+    real_space    fwrf.real_space_model of the trained candidates
+    predict       the prediction of the other samples, per feature group (fwrf.get_partition_predictions)
+
+Every stage is keyed by a hash of its config sections, of the size and modification time of its input files and of the
+keys of the stages it depends on, and its outputs are stored in the cache directory under that key. A stage only runs
+when no artifact has its key, and only reads the artifacts of its dependencies when it runs: changing l2 reruns train
+and the stages after it, and an unchanged pipeline completes without loading anything. Artifacts are written to a
+temporary directory and renamed when complete, so an interrupted run resumes from the last completed stage.
+
+The "output" results file records the keys of the stages it was written from, and is rewritten whenever they differ
+from the keys of the config. With --stages, it is only rewritten if the selected stages leave every trained stage up
+to date.
+'''
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import pickle
+import hashlib
+import argparse
+import numpy as np
+
+
+fpX = np.float32
+
+nonlinearities = {
+    None: None,
+    'none': None,
+    'log_sqrt': lambda x: np.log(1 + np.sqrt(x)),
+    'sqrt': np.sqrt,
+}
+
+########################################################################
+###              STAGES                                              ###
+########################################################################
+
+def _model_specs(config):
+    import fwrf
+    ms = config['model_space']
+    va = ms.get('view_angle', 20.)
+    nx, ny, ns = ms['grid']
+    smin, smax = ms.get('sigma', (0.5, 8.))
+    return [[(0., va), (0., va), (smin, smax)], [fwrf.linspace(nx), fwrf.linspace(ny), fwrf.logspace(ns)]]
+
+def _voxels(config):
+    return np.load(config['data']['voxels'], mmap_mode='r')
+
+def _trn_size(config, n):
+    return config['data'].get('trn_size', n)
+
+
+def stage_features(config, inputs):
+    f = config['features']
+    kind = f.get('kind', 'npy')
+    if kind=='npy':
+        fmaps = [np.load(p, mmap_mode='r') for p in f['fmaps']]
+    elif kind=='store':
+        from data_preparation import load_feature_map_store
+        fmaps, _, _ = load_feature_map_store(f['store'])
+    else:
+        from gaborizer.src.gabor_feature_dictionaries import gabor_feature_maps
+        from data_preparation import preprocess_gabor_feature_maps
+        stim_data = np.load(config['data']['stimuli'], mmap_mode='r')
+        if stim_data.ndim==3:
+            stim_data = stim_data[:,np.newaxis]
+        gfm = gabor_feature_maps(f.get('n_orientations', 4), f.get('deg_per_stimulus', 20.), tuple(f.get('cycles_per_deg', (0.25, 6., 12))),
+                                 pix_per_cycle=f.get('pix_per_cycle', 3.13333333), complex_cell=f.get('complex_cell', True),
+                                 diams_per_filter=f.get('diams_per_filter', 4), cycles_per_radius=f.get('cycles_per_radius', 1.0))
+        feat_dict = gfm.create_feature_maps(np.asarray(stim_data, dtype=fpX), conv_mode=f.get('conv_mode', 'auto'),
+                                            n_workers=f.get('n_workers', 1))
+        fmaps, _, _ = preprocess_gabor_feature_maps(feat_dict, nonlinearities[f.get('nonlinearity', None)])
+    return {'fmaps': fmaps, 'fmaps_sizes': [tuple(int(s) for s in fm.shape) for fm in fmaps]}
+
+
+def stage_model_space(config, inputs):
+    import fwrf
+    ms = config['model_space']
+    fmaps = inputs['features']['fmaps']
+    n = len(fmaps[0])
+    specs = _model_specs(config)
+    nt = np.prod([sms.length for sms in specs[1]])
+    mst_data, mst_avg, mst_std = fwrf.model_space_tensor(fmaps, specs, zscore=ms.get('zscore', True), trn_size=_trn_size(config, n),
+        batches=tuple(ms.get('batches', (min(n, 500), nt))), view_angle=ms.get('view_angle', 20.), engine=ms.get('engine', 'theano'),
+        epsilon=ms.get('epsilon', 1e-6), pooling_tolerance=ms.get('pooling_tolerance', 5e-2))
+    return {'mst_data': mst_data, 'mst_avg': mst_avg, 'mst_std': mst_std}
+
+
+def _train_arguments(config, n, nv, nt):
+    t = config['train']
+    return {'batches': tuple(t.get('batches', (min(n, 200), min(nv, 1000), nt))), 'val_test_size': t.get('val_test_size', 100),
+            'lr': t.get('lr', 1e-4), 'l2': t.get('l2', 0.0), 'num_epochs': t.get('num_epochs', 1)}
+
+def stage_train(config, inputs):
+    import fwrf
+    import sufficient_stats as pss
+    mst_data = inputs['model_space']['mst_data']
+    voxels = _voxels(config)
+    n, nf, _, nt = mst_data.shape
+    nv = voxels.shape[1]
+    m = _trn_size(config, n)
+    t = config['train']
+    np.random.seed(t.get('seed', 0))
+    args = _train_arguments(config, m, nv, nt)
+    if t.get('method', 'sgd')=='sgd':
+        w_params = [np.zeros(shape=(nv, nf), dtype=fpX), np.zeros(shape=(nv), dtype=fpX)]
+        results = fwrf.learn_params(mst_data[:m], voxels[:m], w_params, **args)
+    else:
+        results = pss.fit_model_space_tensor(mst_data[:m], voxels[:m], val_test_size=args['val_test_size'], l2=args['l2'],
+                                             batches=args['batches'], epsilon=t.get('epsilon', 1e-6))
+    outputs = dict(zip(['val_scores', 'best_scores', 'best_epochs', 'best_candidates', 'best_w_params'], results[:5]))
+    if len(results)>5:
+        outputs['hyperparams'] = results[5]
+    return outputs
+
+
+def stage_kout(config, inputs):
+    import fwrf
+    mst_data = inputs['model_space']['mst_data']
+    voxels = _voxels(config)
+    n, nf, _, nt = mst_data.shape
+    nv = voxels.shape[1]
+    m = _trn_size(config, n)
+    k = config['kout']
+    args = _train_arguments(config, m, nv, nt)
+    order = np.random.RandomState(k.get('seed', 0)).permutation(m)
+    w_params = [np.zeros(shape=(nv, nf), dtype=fpX), np.zeros(shape=(nv), dtype=fpX)]
+    model = fwrf.kout_learn_params(mst_data[:m], voxels[:m], order, w_params, batches=args['batches'], val_part_size=k['val_part_size'],
+                                   holdout_size=k.get('holdout_size', args['val_test_size']), lr=args['lr'], l2=args['l2'],
+                                   num_epochs=args['num_epochs'])
+    return {'model': model}
+
+
+def stage_real_space(config, inputs):
+    import fwrf
+    ms = inputs['model_space']
+    rf_params, mst_avg, mst_std = fwrf.real_space_model(np.asarray(inputs['train']['best_candidates']), _model_specs(config),
+                                                        mst_avg=ms['mst_avg'], mst_std=ms['mst_std'])
+    return {'best_rf_params': rf_params, 'best_mst_avg': mst_avg, 'best_mst_std': mst_std}
+
+
+def stage_predict(config, inputs):
+    import fwrf
+    mst_data = inputs['model_space']['mst_data']
+    trained = inputs['train']
+    voxels = _voxels(config)
+    n, nf = mst_data.shape[:2]
+    m = _trn_size(config, n)
+    assert m < n, "no validation samples (trn_size=%d of %d)" % (m, n)
+    p = config.get('predict', {})
+    partitions = [slice(None)]
+    if p.get('partitions', None)=='resolution':
+        ## one group per feature map resolution, unless the model space tensor was reduced
+        bounds = np.cumsum([0,] + [s[1] for s in inputs['features']['fmaps_sizes']])
+        if bounds[-1]==nf:
+            partitions = [slice(b0, b1) for b0,b1 in zip(bounds[:-1], bounds[1:])]
+    elif p.get('partitions', None) is not None:
+        partitions = p['partitions']
+    results = fwrf.get_partition_predictions(np.asarray(mst_data[m:]), np.asarray(voxels[m:]), np.asarray(trained['best_candidates']),
+        [np.asarray(w) for w in trained['best_w_params']], partitions, leave_one_out=p.get('leave_one_out', False),
+        batch_size=p.get('batch_size', None))
+    return dict([('val_' + k, v) for k,v in results.items()])
+
+
+## name: (stage function, upstream stages, config sections, input files)
+stages = [
+    ('features',    (stage_features,    [],                                  ['features'],            ['features'])),
+    ('model_space', (stage_model_space, ['features'],                        ['model_space', 'data'], [])),
+    ('train',       (stage_train,       ['model_space'],                     ['train', 'data'],       ['voxels'])),
+    ('kout',        (stage_kout,        ['model_space'],                     ['train', 'kout', 'data'], ['voxels'])),
+    ('real_space',  (stage_real_space,  ['model_space', 'train'],            [],                      [])),
+    ('predict',     (stage_predict,     ['features', 'model_space', 'train'], ['predict', 'data'],    ['voxels'])),
+]
+stage_dict = dict(stages)
+
+## the outputs written to the "output" results file
+output_stages = ['train', 'kout', 'real_space', 'predict']
+
+########################################################################
+###              ARTIFACTS                                           ###
+########################################################################
+
+def file_fingerprint(path):
+    '''identifies an input file by its absolute path, size and modification time, without reading it.'''
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, int(st.st_mtime)]
+
+
+def save_artifact(path, outputs):
+    '''
+    Writes the outputs of a stage to the directory path: arrays and lists of arrays as .npy files (memmapped when
+    loaded back), everything else pickled. The directory is written under a temporary name and renamed when complete.
+    '''
+    tmp = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+    os.makedirs(tmp)
+    index, objects = {}, {}
+    for k,v in outputs.items():
+        if isinstance(v, np.ndarray):
+            np.save(os.path.join(tmp, '%s.npy' % k), v)
+            index[k] = ('array', 1)
+        elif isinstance(v, (list, tuple)) and len(v)>0 and all([isinstance(a, np.ndarray) for a in v]):
+            for i,a in enumerate(v):
+                np.save(os.path.join(tmp, '%s.%d.npy' % (k, i)), np.asarray(a))
+            index[k] = ('list', len(v))
+        elif hasattr(v, 'shape') and hasattr(v, 'dtype'): # h5py datasets, memmaps
+            np.save(os.path.join(tmp, '%s.npy' % k), np.asarray(v))
+            index[k] = ('array', 1)
+        else:
+            objects[k] = v
+    with open(os.path.join(tmp, 'artifact.pkl'), 'wb') as f:
+        pickle.dump({'index': index, 'objects': objects}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        os.rename(tmp, path)
+    except OSError: # completed by another run in the meantime
+        shutil.rmtree(tmp)
+
+
+def load_artifact(path):
+    with open(os.path.join(path, 'artifact.pkl'), 'rb') as f:
+        a = pickle.load(f)
+    outputs = dict(a['objects'])
+    for k,(kind, count) in a['index'].items():
+        if kind=='array':
+            outputs[k] = np.load(os.path.join(path, '%s.npy' % k), mmap_mode='r')
+        else:
+            outputs[k] = [np.load(os.path.join(path, '%s.%d.npy' % (k, i)), mmap_mode='r') for i in range(count)]
+    return outputs
+
+########################################################################
+###              RUNNER                                              ###
+########################################################################
+
+class pipeline(object):
+    '''
+    p = pipeline(config, cache_dir)
+    p.run()                     # all the stages of the config
+    p.run(['train'], force=['train'])  # train again, and invalidate real_space, predict and kout (the "output" file is
+                                       # only rewritten once they are up to date again)
+    p.get('predict')            # the outputs of a stage, loaded or computed
+    '''
+    def __init__(self, config, cache_dir='fwrf_cache', verbose=True):
+        self.config = config
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        self.outputs = {}
+        self._keys = {}
+        self.ran = []
+
+    def enabled(self):
+        '''the stages of the config, in order.'''
+        return [name for name,_ in stages if name!='kout' or 'kout' in self.config]
+
+    def key(self, name):
+        '''the hash of the stage's config sections, input files and upstream keys.'''
+        if name not in self._keys:
+            _, deps, sections, files = stage_dict[name]
+            fingerprints = []
+            for f in files:
+                if f=='voxels':
+                    fingerprints += [file_fingerprint(self.config['data']['voxels'])]
+                elif f=='features':
+                    fs = self.config['features']
+                    paths = fs.get('fmaps', []) + ([fs['store']] if 'store' in fs else [])
+                    if fs.get('kind', 'npy')=='gabor':
+                        paths = [self.config['data']['stimuli']]
+                    fingerprints += [file_fingerprint(p) for p in paths]
+            desc = json.dumps([name, [self.config.get(s, None) for s in sections], fingerprints, [self.key(d) for d in deps]], sort_keys=True)
+            self._keys[name] = hashlib.sha1(desc).hexdigest()[:16]
+        return self._keys[name]
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, '%s_%s' % (name, self.key(name)))
+
+    def cached(self, name):
+        return os.path.exists(self.path(name))
+
+    def _cacheable(self, name):
+        # feature maps read from files are not copied to the cache
+        return name!='features' or self.config['features'].get('kind', 'npy')=='gabor'
+
+    def get(self, name):
+        '''the outputs of a stage: in memory, loaded from the cache, or computed (after its dependencies).'''
+        if name in self.outputs:
+            return self.outputs[name]
+        fn, deps, _, _ = stage_dict[name]
+        if self._cacheable(name) and self.cached(name):
+            self.outputs[name] = load_artifact(self.path(name))
+            return self.outputs[name]
+        inputs = dict([(d, self.get(d)) for d in deps])
+        if self.verbose:
+            print "\n=== %s [%s] ===" % (name, self.key(name))
+            sys.stdout.flush()
+        start_time = time.time()
+        outputs = fn(self.config, inputs)
+        if self._cacheable(name):
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            save_artifact(self.path(name), outputs)
+            outputs = load_artifact(self.path(name))
+            self.ran += [name]
+        if self.verbose:
+            print "=== %s done in %.3fs ===" % (name, time.time() - start_time)
+        self.outputs[name] = outputs
+        return outputs
+
+    def dependents(self, names):
+        '''names and all the stages that depend on them, directly or not.'''
+        out = set(names)
+        for name, (_, deps, _, _) in stages: # in dependency order
+            if any([d in out for d in deps]):
+                out.add(name)
+        return out
+
+    def invalidate(self, names):
+        '''deletes the artifacts of names and of their dependents, which then run again when needed.'''
+        for name in self.dependents(names):
+            self.outputs.pop(name, None)
+            if self._cacheable(name) and os.path.exists(self.path(name)):
+                shutil.rmtree(self.path(name))
+
+    def status(self, targets=None):
+        return [(name, self.key(name), self.cached(name) if self._cacheable(name) else None) for name in (targets or self.enabled())]
+
+    def output_keys(self):
+        '''the stage keys recorded in the "output" results file, or None if it is missing or unreadable.'''
+        output = self.config.get('output', None)
+        if output is None or not os.path.exists(output):
+            return None
+        from results_store import load_results
+        try:
+            with load_results(output) as results:
+                return results['pipeline_keys'].load()
+        except Exception:
+            return None
+
+    def run(self, targets=None, force=()):
+        '''
+        Brings the target stages (default: all of the config) up to date, running only the ones without an artifact
+        (force invalidates these stages and their dependents first). If the config has an "output" file, the outputs
+        of the trained stages are written to it whenever a stage ran or the stage keys it records differ from the
+        current ones, as long as the targets leave every trained stage up to date: with targets that skip a stale
+        trained stage, the results file is left as is. Returns the names of the stages that ran.
+        '''
+        targets = targets or self.enabled()
+        self.invalidate(force)
+        self.ran = []
+        for name in targets:
+            if not self._cacheable(name) or self.cached(name): # inputs are only read for the stages that run
+                continue
+            self.get(name)
+        output = self.config.get('output', None)
+        if output is not None:
+            trained = [name for name in output_stages if name in self.enabled()]
+            stale = [name for name in trained if not self.cached(name)]
+            keys = dict([(name, self.key(name)) for name in self.enabled()])
+            if len(stale)>0:
+                if self.verbose:
+                    print "%s not updated: %s not up to date" % (output, ', '.join(stale))
+            elif len(self.ran)>0 or self.output_keys()!=keys:
+                from results_store import save_results
+                results = {'pipeline_keys': keys}
+                for name in trained:
+                    results.update(self.get(name))
+                save_results(output, results)
+                if self.verbose:
+                    print "results saved to %s" % output
+        return self.ran
+
+
+def load_config(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the fwrf pipeline of a config file, reusing the cached stages.')
+    parser.add_argument('config', help='json config file')
+    parser.add_argument('--cache_dir', default=None, help='artifact directory (default: the "cache_dir" of the config, or fwrf_cache)')
+    parser.add_argument('--stages', nargs='+', default=None, choices=[name for name,_ in stages], help='target stages (default: all); the output file is only rewritten if they leave every trained stage up to date')
+    parser.add_argument('--force', nargs='+', default=[], choices=[name for name,_ in stages], help='stages to rerun, with the stages that depend on them, even if cached')
+    parser.add_argument('--status', action='store_true', help='only print the key and cache state of every stage')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    p = pipeline(config, cache_dir=args.cache_dir or config.get('cache_dir', 'fwrf_cache'))
+    if args.status:
+        for name, key, cached in p.status(args.stages):
+            print "%-12s %s  %s" % (name, key, {True: 'cached', False: 'to run', None: 'input'}[cached])
+    else:
+        start_time = time.time()
+        ran = p.run(args.stages, force=args.force)
+        print "\n%d stage(s) run (%s) in %.3fs" % (len(ran), ', '.join(ran) or 'all cached', time.time() - start_time)
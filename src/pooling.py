@@ -0,0 +1,237 @@
+import sys
+import time
+import numpy as np
+
+import numpy_utility as pnu
+
+
+fpX = np.float32
+
+########################################################################
+###              CANDIDATE POOLING FIELDS                            ###
+########################################################################
+
+def candidate_grid(sharedModel_specs):
+    '''
+    returns the x, y and sigma ranges (rx, ry, rs) of the shared candidate model space, and the flattened (nt,)
+    candidate coordinates mx, my, ms in the same order as fwrf.svModelSpace, i.e. candidate index = (ix*ny + iy)*ns + is.
+    '''
+    vm = np.asarray(sharedModel_specs[0])
+    rx, ry, rs = [np.asarray(sms(vm[i,0], vm[i,1]), dtype=fpX) for i,sms in enumerate(sharedModel_specs[1])]
+    xs, ys, ss = np.meshgrid(rx, ry, rs, indexing='ij')
+    return (rx, ry, rs), (xs.flatten(), ys.flatten(), ss.flatten())
+
+
+def candidate_pooling_fields(fmap_sizes, mx, my, ms, view_angle=20., dtype=fpX):
+    '''
+    returns, for each feature map resolution in fmap_sizes, the (nt, n_pix, n_pix) stack of gaussian mass pooling fields
+    of the candidates (mx, my, ms). These are the same weights that fwrf.model_space_tensor uploads batch by batch.
+    '''
+    return [pnu.make_gaussian_mass_stack(mx, my, ms, fs[2], size=view_angle, dtype=dtype)[2] for fs in fmap_sizes]
+
+
+def separable_pooling_factors(rx, ry, rs, n_pix, view_angle=20., dtype=fpX):
+    '''
+    The gaussian mass pooling field of candidate (x, y, sigma) is the outer product of a row factor (in y) and a column
+    factor (in x). Returns the column factors Gx (ns, nx, n_pix) and the row factors Gy (ns, ny, n_pix) of the grid
+    (rx, ry, rs), such that the field of candidate (ix, iy, is) is Gy[is, iy][:,np.newaxis] * Gx[is, ix][np.newaxis,:].
+    '''
+    c, dpix = pnu.pixel_centers(n_pix, size=view_angle)
+    s = np.asarray(rs, dtype=np.float64)[:,np.newaxis,np.newaxis]
+    Gx = pnu.gaussian_mass_profile(c[np.newaxis,np.newaxis,:], np.asarray(rx, dtype=np.float64)[np.newaxis,:,np.newaxis], s, dpix)[0]
+    Gy = pnu.gaussian_mass_profile(-c[np.newaxis,np.newaxis,:], np.asarray(ry, dtype=np.float64)[np.newaxis,:,np.newaxis], s, dpix)[0]
+    return Gx.astype(dtype), Gy.astype(dtype)
+
+
+def area_downsampling_matrix(n_in, n_out, dtype=np.float64):
+    '''(n_out, n_in) matrix that averages the input pixels over each output pixel, weighted by their overlap.'''
+    lo_in, hi_in = np.arange(n_in, dtype=np.float64) / n_in, np.arange(1, n_in+1, dtype=np.float64) / n_in
+    lo_out, hi_out = np.arange(n_out, dtype=np.float64) / n_out, np.arange(1, n_out+1, dtype=np.float64) / n_out
+    D = np.maximum(0., np.minimum(hi_out[:,np.newaxis], hi_in[np.newaxis,:]) - np.maximum(lo_out[:,np.newaxis], lo_in[np.newaxis,:]))
+    return (D / np.sum(D, axis=1, keepdims=True)).astype(dtype)
+
+
+def _band(D):
+    '''the banded form (idx, wts), both (n_out, w), of a downsampling matrix D (n_out, n_in) with contiguous rows.'''
+    n_out, n_in = D.shape
+    start = np.argmax(D>0, axis=1)
+    w = np.max(np.sum(D>0, axis=1))
+    idx = start[:,np.newaxis] + np.arange(w)[np.newaxis,:]
+    wts = np.where(idx<n_in, D[np.arange(n_out)[:,np.newaxis], np.minimum(idx, n_in-1)], 0.)
+    return np.minimum(idx, n_in-1), wts.astype(D.dtype)
+
+
+def _downsample(fm, band):
+    '''area-downsamples the last two axes of fm (..., n_in, n_in) with the banded matrix band, in O(n_in**2) operations.'''
+    idx, wts = band
+    fm = np.sum(fm[..., idx] * wts, axis=-1)                               # (..., n_in, n_out)
+    return np.sum(fm[..., idx, :] * wts[:,:,np.newaxis], axis=-2)          # (..., n_out, n_out)
+
+
+def pyramid_sizes(n_pix):
+    '''the resolutions of the pooling pyramid: n_pix, then halved (rounding up) down to a single pixel.'''
+    sizes = [n_pix,]
+    while sizes[-1]>1:
+        sizes += [(sizes[-1]+1) // 2,]
+    return sizes
+
+
+def pyramid_pooling_levels(fmap_sizes, sharedModel_specs, tolerance=5e-2, view_angle=20.):
+    '''
+    For every resolution of fmap_sizes, returns the coarsest level (ns,) of the pyramid (see pyramid_sizes) at which
+    each sigma level can pool. Pooling the area-downsampled feature maps with the pooling fields of the coarse grid is
+    the same as pooling the full feature maps with the coarse fields spread back over the fine pixels. For non-negative
+    feature maps the relative pooling error is then bounded by the L1 distance between these fields and the full
+    resolution fields, relative to their mass, which is kept under tolerance for every candidate of the sigma level. This is a worst case
+    bound, the error on smooth feature maps is usually an order of magnitude lower.
+    '''
+    (rx, ry, rs), _ = candidate_grid(sharedModel_specs)
+    levels = []
+    for fs in fmap_sizes:
+        sizes = pyramid_sizes(fs[2])
+        Gx, Gy = separable_pooling_factors(rx, ry, rs, sizes[0], view_angle=view_angle, dtype=np.float64)
+        mass_x, mass_y = np.sum(np.abs(Gx), axis=2), np.sum(np.abs(Gy), axis=2) # (ns, nx), (ns, ny)
+        level = np.zeros(len(rs), dtype=int)
+        D = np.eye(sizes[0])
+        for l in range(1, len(sizes)):
+            D = np.dot(area_downsampling_matrix(sizes[l-1], sizes[l]), D) # from the full resolution to level l
+            Cx, Cy = separable_pooling_factors(rx, ry, rs, sizes[l], view_angle=view_angle, dtype=np.float64)
+            Cx, Cy = np.dot(Cx, D), np.dot(Cy, D)
+            err_x, err_y = np.sum(np.abs(Gx - Cx), axis=2), np.sum(np.abs(Gy - Cy), axis=2)
+            ## |Gy Gx - Cy Cx| <= |Gy| |Gx - Cx| + |Cx| |Gy - Cy|, for every candidate (ix, iy) of each sigma level
+            bound = (mass_y[:,np.newaxis,:] * err_x[:,:,np.newaxis] + np.sum(np.abs(Cx), axis=2)[:,:,np.newaxis] * err_y[:,np.newaxis,:]) / \
+                np.maximum(mass_y[:,np.newaxis,:] * mass_x[:,:,np.newaxis], 1e-30)
+            ok = np.max(bound.reshape((len(rs), -1)), axis=1) <= tolerance
+            level[ok] = l
+        levels += [level,]
+    return levels
+
+
+def make_pooling_function(fmap_sizes, sharedModel_specs, view_angle=20., engine='separable', tolerance=5e-2, dtype=fpX, verbose=False):
+    '''
+    Precomputes the pooling fields of every candidate once, at every resolution of fmap_sizes, and returns a function
+    that maps a batch of grouped feature maps [(bn, nf_r, n_pix, n_pix), ...] to their pooled values (bn, nf, nt).
+
+    engine ~ 'dense': one dot product per candidate with its (n_pix, n_pix) field, which take nt x sum(n_pix**2) x 4
+                      bytes of memory and cost bn x nf x n_pix**2 x nt operations.
+             'separable': for every sigma, the feature maps are filtered along x by the ns x nx column factors and the
+                      result along y by the row factors (see separable_pooling_factors), i.e. one separable gaussian
+                      filtering pass per sigma evaluated only at the candidate centers. This costs
+                      bn x nf x n_pix x ns x nx x (n_pix + ny) operations, and gives the same values.
+             'pyramid': as 'separable', but each sigma level pools the feature maps area-downsampled to the coarsest
+                      level of a halving pyramid whose pooling error stays under tolerance (relative, see
+                      pyramid_pooling_levels), so that the large receptive fields pool a few pixels only.
+    '''
+    if engine=='dense':
+        _, (mx, my, ms) = candidate_grid(sharedModel_specs)
+        fields = candidate_pooling_fields(fmap_sizes, mx, my, ms, view_angle=view_angle, dtype=dtype)
+        def pool(fmaps):
+            return np.concatenate([np.tensordot(fm, fields[r], axes=[[2,3],[1,2]]) for r,fm in enumerate(fmaps)], axis=1)
+        return pool
+    assert engine in ['separable', 'pyramid'], "unknown pooling engine %s" % engine
+    (rx, ry, rs), _ = candidate_grid(sharedModel_specs)
+    nx, ny, ns = len(rx), len(ry), len(rs)
+    if engine=='pyramid':
+        levels = pyramid_pooling_levels(fmap_sizes, sharedModel_specs, tolerance=tolerance, view_angle=view_angle)
+    else:
+        levels = [np.zeros(ns, dtype=int) for fs in fmap_sizes]
+    ## for every resolution, the downsampling steps of its pyramid and the factors of the sigma levels pooling at each level
+    plans = []
+    for fs,level in zip(fmap_sizes, levels):
+        sizes = pyramid_sizes(fs[2])[:np.max(level)+1]
+        bands = [_band(area_downsampling_matrix(sizes[l-1], sizes[l], dtype=dtype)) for l in range(1, len(sizes))]
+        factors = []
+        for l in range(len(sizes)):
+            sigmas = np.where(level==l)[0]
+            factors += [(sigmas,) + separable_pooling_factors(rx, ry, rs[sigmas], sizes[l], view_angle=view_angle, dtype=dtype),]
+        plans += [(bands, factors),]
+        if verbose:
+            print "> %d pixels feature maps pooled at %s pixels for sigma %s" % (fs[2], [sizes[l] for l in level], list(rs))
+    def pool(fmaps):
+        out = []
+        for fm,(bands,factors) in zip(fmaps, plans):
+            fm = np.asarray(fm, dtype=dtype)
+            bn, nf_r = fm.shape[:2]
+            pooled = np.ndarray(shape=(bn, nf_r, nx, ny, ns), dtype=dtype)
+            for l,(sigmas,Gx,Gy) in enumerate(factors):
+                if l>0:
+                    fm = _downsample(fm, bands[l-1])
+                for k,s in enumerate(sigmas):
+                    cols = np.dot(fm, Gx[k].T)                                  # (bn, nf_r, m, nx)
+                    pooled[...,s] = np.tensordot(cols, Gy[k], axes=[[2],[1]])   # (bn, nf_r, nx, ny)
+            out += [pooled.reshape((bn, nf_r, nx*ny*ns)),]
+        return np.concatenate(out, axis=1)
+    return pool
+
+
+########################################################################
+###              FUSED FEATURE MAPS -> MODEL SPACE TENSOR            ###
+########################################################################
+
+def iterate_model_space_rows(fmap_batches, pool, nonlinearity=None):
+    '''
+    Generator. For every batch of grouped feature maps in fmap_batches, yields the matching rows (bn, nf, 1, nt) of the
+    model space tensor. The full feature maps are pooled as soon as they are produced and are never accumulated.
+    '''
+    for fmaps in fmap_batches:
+        rows = pool(fmaps)[:,:,np.newaxis,:].astype(fpX)
+        if nonlinearity:
+            rows = nonlinearity(rows)
+        yield rows
+
+
+def fused_model_space_tensor(
+        fmap_batches, n, sharedModel_specs, pool=None, nonlinearity=None, zscore=False, mst_avg=None, mst_std=None,
+        epsilon=1e-6, trn_size=None, view_angle=20., out=None):
+    '''
+    A streaming equivalent of fwrf.model_space_tensor. Instead of the full feature maps of every sample, it takes an
+    iterable of feature map batches, e.g. for the gabor feature space
+
+        fmap_batches = ([act_func(fm) for _,_,fm in b] for b in iterate_gabor_feature_maps(image_batches, ...))
+
+    and pools each batch against the candidate gaussians as soon as it is produced. Peak memory is therefore set by one
+    batch of feature maps (plus the pooling fields) rather than by the whole feature map dictionary.
+
+    n is the total number of samples in fmap_batches. The output can be written to a preallocated (n, nf, 1, nt) array
+    or memmap with out. pool defaults to make_pooling_function at the resolutions of the first batch.
+
+    Returns the same (mst_data, mst_avg, mst_std) as fwrf.model_space_tensor.
+    '''
+    nt = np.prod([sms.length for sms in sharedModel_specs[1]])
+    if trn_size==None:
+        trn_size = n
+    mst_data = out
+    mst_avg_loc, mst_std_loc = mst_avg, mst_std
+    self_zscore = zscore and (mst_avg is None or mst_std is None)
+    print "\nPrecomputing mst candidate responses..."
+    sys.stdout.flush()
+    start_time = time.time()
+    i = 0
+    for fmaps in fmap_batches:
+        if pool is None:
+            pool = make_pooling_function([fm.shape for fm in fmaps], sharedModel_specs, view_angle=view_angle)
+        rows, = iterate_model_space_rows([fmaps], pool, nonlinearity=nonlinearity)
+        bn = len(rows)
+        if mst_data is None:
+            mst_data = np.ndarray(shape=(n,)+rows.shape[1:], dtype=fpX)
+        if self_zscore: # accumulate the training statistics as we go
+            if i==0:
+                sum_loc = np.zeros(shape=(1,)+rows.shape[1:], dtype=np.float64)
+                sqr_loc = np.zeros(shape=(1,)+rows.shape[1:], dtype=np.float64)
+            trn_rows = rows[:max(0, trn_size-i)]
+            sum_loc[0] += np.sum(trn_rows, axis=0, dtype=np.float64)
+            sqr_loc[0] += np.sum(np.square(trn_rows, dtype=np.float64), axis=0)
+        elif zscore:
+            rows = np.nan_to_num((rows - mst_avg_loc) / mst_std_loc)
+        mst_data[i:i+bn] = rows
+        i += bn
+    assert i==n, "fmap_batches produced %d samples instead of %d" % (i, n)
+    full_time = time.time() - start_time
+    print "%d samples x %d mst candidate responses took %.3fs @ %.3f samples/s" % (n, nt, full_time, fpX(n)/full_time)
+    if self_zscore:
+        print "Z-scoring modelspace tensor..."
+        mst_avg_loc = (sum_loc / trn_size).astype(fpX)
+        mst_std_loc = (np.sqrt(np.maximum(sqr_loc / trn_size - np.square(sum_loc / trn_size), 0.)) + epsilon).astype(fpX)
+        for rr in range(0, n, 1000):
+            mst_data[rr:rr+1000] = np.nan_to_num((mst_data[rr:rr+1000] - mst_avg_loc) / mst_std_loc)
+    return mst_data, mst_avg_loc, mst_std_loc
@@ -0,0 +1,184 @@
+import os
+import pickle
+import numpy as np
+import h5py
+from multiprocessing import Pool
+
+
+########################################################################
+###              CHUNKING                                            ###
+########################################################################
+
+### axes that are read whole for the usual access pattern of the standard fwrf outputs:
+### val_scores (epochs, nv, nt) are read per voxel across candidates, predictions (n, nv) per voxel across samples,
+### the model space tensor (n, nf, 1, nt) per candidate batch across samples and features.
+default_keep_axes = {
+    'val_scores': (-1,),
+    'val_pred': (0,),
+    'predictions': (0,),
+    'voxels': (0,),
+    'mst_data': (0, 1, 2),
+}
+
+def chunk_shape(shape, itemsize, keep_axes=(), target_bytes=1024**2):
+    '''
+    Chunk shape of about target_bytes for an array of the given shape. The axes in keep_axes are kept whole
+    as long as possible, the other axes are halved (largest first) until the chunk fits.
+    '''
+    if len(shape)==0:
+        return None
+    chunks = [max(1, int(s)) for s in shape]
+    keep = set([a % len(shape) for a in keep_axes])
+    for axes in [[a for a in range(len(shape)) if a not in keep], range(len(shape))]:
+        while np.prod(chunks)*itemsize > target_bytes:
+            free = [a for a in axes if chunks[a]>1]
+            if len(free)==0:
+                break
+            a = max(free, key=lambda a: chunks[a])
+            chunks[a] = (chunks[a]+1) // 2
+    return tuple(chunks)
+
+
+########################################################################
+###              WRITING                                             ###
+########################################################################
+
+def _write_object(group, name, obj, compression='lzf', keep_axes=None):
+    '''write obj under name in group: arrays as chunked (and compressed) datasets, dicts and lists as groups,
+    and anything else pickled into an opaque dataset.'''
+    if isinstance(obj, dict):
+        g = group.create_group(name)
+        g.attrs['type'] = 'dict'
+        for k,v in obj.items():
+            _write_object(g, str(k), v, compression=compression, keep_axes=keep_axes)
+            g[str(k)].attrs['key'] = pickle.dumps(k)
+    elif isinstance(obj, (list, tuple)) and all([isinstance(o, np.ndarray) for o in obj]):
+        g = group.create_group(name)
+        g.attrs['type'] = type(obj).__name__
+        for i,v in enumerate(obj):
+            _write_object(g, '%d' % i, v, compression=compression, keep_axes=keep_axes)
+    elif isinstance(obj, np.ndarray) and obj.dtype!=object and obj.size>0 and obj.ndim>0:
+        if keep_axes is None:
+            keep_axes = default_keep_axes.get(name, ())
+        chunks = chunk_shape(obj.shape, obj.dtype.itemsize, keep_axes=keep_axes)
+        group.create_dataset(name, data=obj, chunks=chunks, compression=compression, shuffle=(compression is not None))
+    elif np.isscalar(obj):
+        group.create_dataset(name, data=obj)
+    else:
+        group.create_dataset(name, data=np.void(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)))
+        group[name].attrs['type'] = 'pickle'
+
+
+_pending = {}
+
+def _write_external(args):
+    '''pool worker. Writes one key of _pending, inherited from the parent by fork, to its own file.'''
+    key, filename, compression = args
+    with h5py.File(filename, 'w') as hf:
+        _write_object(hf, key, _pending[key], compression=compression)
+    return key
+
+
+def save_results(filename, data_objects_dict, compression='lzf', n_workers=1, parallel_min_bytes=64*1024**2):
+    '''
+    Save a dictionary of results (arrays, lists of arrays such as w_params, nested dicts such as the k-out models,
+    or any picklable object) to the hdf5 file filename.
+
+    Arrays are chunked according to their expected access pattern (see default_keep_axes) and compressed with
+    compression ('lzf' by default, 'gzip', or None). With n_workers > 1, the arrays larger than parallel_min_bytes
+    are written in parallel by forked processes, each to its own file in the directory filename + '.d', and linked
+    from the main file, so that compression of independent keys proceeds on several cores.
+
+    Use load_results to read it back.
+    '''
+    global _pending
+    big = []
+    if n_workers > 1:
+        big = [k for k,v in data_objects_dict.items() if isinstance(v, np.ndarray) and v.nbytes>=parallel_min_bytes]
+    if len(big)>0:
+        ext_dir = filename + '.d'
+        if not os.path.exists(ext_dir):
+            os.makedirs(ext_dir)
+        _pending = data_objects_dict
+        pool = Pool(min(n_workers, len(big)))
+        try:
+            for k in pool.imap_unordered(_write_external, [(k, os.path.join(ext_dir, '%s.h5' % k), compression) for k in big]):
+                print 'saved %s in h5py file' % k
+        finally:
+            pool.close()
+            pool.join()
+            _pending = {}
+    with h5py.File(filename, 'w') as hf:
+        for k,v in data_objects_dict.items():
+            if k in big:
+                hf[k] = h5py.ExternalLink(os.path.join(os.path.basename(filename) + '.d', '%s.h5' % k), k)
+            else:
+                _write_object(hf, k, v, compression=compression)
+                print 'saved %s in h5py file' % k
+
+
+########################################################################
+###              LAZY LOADING                                        ###
+########################################################################
+
+class results_view(object):
+    '''
+    A lazy dictionary-like view of a group of a results file. Arrays are returned as h5py datasets, which are only
+    read when sliced (e.g. view['val_scores'][-1, vidx, :]), nested dicts as results_view, lists of arrays as lists of
+    datasets, and pickled objects are unpickled on access.
+    '''
+    def __init__(self, group):
+        self.group = group
+        self._keys = dict([(pickle.loads(str(group[name].attrs['key'])) if 'key' in group[name].attrs else name, name)
+                            for name in group.keys()])
+
+    def keys(self):
+        return self._keys.keys()
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, key):
+        obj = self.group[self._keys[key]]
+        kind = obj.attrs.get('type', None)
+        if isinstance(obj, h5py.Group):
+            if kind in ('list', 'tuple'):
+                items = [obj['%d' % i] for i in range(len(obj))]
+                return items if kind=='list' else tuple(items)
+            return results_view(obj)
+        if kind=='pickle':
+            return pickle.loads(obj[()].tostring())
+        if obj.shape==():
+            return obj[()]
+        return obj
+
+    def load(self):
+        '''reads everything into memory and returns plain python objects.'''
+        out = {}
+        for k in self.keys():
+            v = self[k]
+            if isinstance(v, results_view):
+                v = v.load()
+            elif isinstance(v, (list, tuple)):
+                v = type(v)([d[...] if isinstance(d, h5py.Dataset) else d for d in v])
+            elif isinstance(v, h5py.Dataset):
+                v = v[...]
+            out[k] = v
+        return out
+
+    def close(self):
+        self.group.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_results(filename):
+    '''Open a file written by save_results. Returns a lazy results_view; call .load() to read everything at once.'''
+    return results_view(h5py.File(filename, 'r'))
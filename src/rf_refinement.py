@@ -0,0 +1,197 @@
+'''
+Continuous refinement of the receptive fields selected on the candidate grid.
+
+fwrf.learn_params picks each voxel's receptive field (x, y, sigma) among the discrete candidates of svModelSpace.
+refine_rf_params starts from these (e.g. from real_space_model) and moves every receptive field continuously, by
+gradient descent with a backtracking line search, using the analytic derivatives of the gaussian mass pooling fields.
+
+For a given receptive field the feature weights are the ridge regression solution on the z-scored pooled features,
+and the z-scoring statistics are recomputed at every position. The gradient of the fit loss with respect to (x, y, sigma)
+is then exact with the weights held at their optimum (envelope theorem), so the weights and the receptive field are
+effectively optimized together. A refined receptive field is only kept if it also lowers the holdout loss.
+'''
+import sys
+import time
+import numpy as np
+from tqdm import tqdm
+
+import numpy_utility as pnu
+
+
+fpX = np.float32
+
+########################################################################
+###              POOLING FIELDS AND THEIR DERIVATIVES                ###
+########################################################################
+
+def gaussian_mass_and_grad(xs, ys, ss, n_pix, size=20., grad=True):
+    '''
+    Returns the pooling fields of the receptive fields (xs, ys, ss), (nv, n_pix, n_pix), as numpy_utility.make_gaussian_mass_stack,
+    and if grad, their derivatives with respect to x, y and sigma, (nv, 3, n_pix, n_pix).
+    '''
+    coords, dpix = pnu.pixel_centers(n_pix, size=size)
+    x, y, s = [np.asarray(a, dtype=np.float64).reshape((-1,1)) for a in (xs, ys, ss)]
+    ## columns: X = coords, rows: Y = -coords
+    px, px_c, px_s = pnu.gaussian_mass_profile(coords[np.newaxis,:], x, s, dpix)
+    py, py_c, py_s = pnu.gaussian_mass_profile(-coords[np.newaxis,:], y, s, dpix)
+    G = py[:,:,np.newaxis] * px[:,np.newaxis,:]
+    if not grad:
+        return G.astype(fpX), None
+    dG = np.stack([py[:,:,np.newaxis] * px_c[:,np.newaxis,:],
+                   py_c[:,:,np.newaxis] * px[:,np.newaxis,:],
+                   py_s[:,:,np.newaxis] * px[:,np.newaxis,:] + py[:,:,np.newaxis] * px_s[:,np.newaxis,:]], axis=1)
+    return G.astype(fpX), dG.astype(fpX)
+
+
+def pool_with_grad(fmaps, rf_params, view_angle=20., grad=True):
+    '''
+    Pools the feature maps [(n, nf_r, n_pix, n_pix), ...] with the receptive fields rf_params (nv, 3).
+    Returns the pooled features (n, nf, nv) and, if grad, their derivatives (n, nf, nv, 3) with respect to x, y, sigma.
+    '''
+    nv = len(rf_params)
+    P, dP = [], []
+    for fm in fmaps:
+        n, nfr, n_pix, _ = fm.shape
+        G, dG = gaussian_mass_and_grad(rf_params[:,0], rf_params[:,1], rf_params[:,2], n_pix, size=view_angle, grad=grad)
+        K = G.reshape((nv, -1)) if not grad else np.concatenate([G.reshape((nv, -1)), dG.reshape((nv*3, -1))], axis=0)
+        out = np.asarray(fm, dtype=fpX).reshape((n*nfr, n_pix*n_pix)).dot(K.T)
+        P += [out[:, :nv].reshape((n, nfr, nv)),]
+        if grad:
+            dP += [out[:, nv:].reshape((n, nfr, nv, 3)),]
+    return np.concatenate(P, axis=1), (np.concatenate(dP, axis=1) if grad else None)
+
+
+########################################################################
+###              LOSS AND GRADIENT                                   ###
+########################################################################
+
+def _zscore(P, dP, epsilon):
+    '''z-scores P (n, nf, nv) over samples, and propagates the derivatives dP (n, nf, nv, 3) through the statistics.'''
+    avg = P.mean(axis=0, dtype=np.float64)
+    c = P - avg
+    std = np.sqrt(np.mean(np.square(c, dtype=np.float64), axis=0))
+    Z = c / (std + epsilon)
+    if dP is None:
+        return Z, None, avg, std + epsilon
+    dc = dP - dP.mean(axis=0, dtype=np.float64)
+    dstd = np.mean(c[...,np.newaxis] * dc, axis=0) / np.maximum(std, epsilon)[...,np.newaxis]
+    dZ = (dc - c[...,np.newaxis] * (dstd / (std + epsilon)[...,np.newaxis])) / (std + epsilon)[...,np.newaxis]
+    return Z, dZ, avg, std + epsilon
+
+
+def _ridge_fit(Z, y, l2):
+    '''per voxel ridge regression of y (m, nv) on Z (m, nf, nv) with an unpenalized bias. Returns W (nv, nf) and b (nv).'''
+    m, nf, nv = Z.shape
+    A = np.concatenate([Z, np.ones(shape=(m, 1, nv))], axis=1)
+    AtA = np.einsum('mfv,mgv->vfg', A, A)
+    AtA[:, np.arange(nf), np.arange(nf)] += max(l2, 1e-6)
+    Aty = np.einsum('mfv,mv->vf', A, y)
+    sol = np.linalg.solve(AtA, Aty[...,np.newaxis])[...,0]
+    return sol[:,:nf], sol[:,nf]
+
+
+def rf_loss(fmaps, voxels, rf_params, trn_size, l2=0., nonlinearity=None, nonlinearity_grad=None, epsilon=1e-6, view_angle=20., grad=True):
+    '''
+    For the voxels (n, nv) and their receptive fields rf_params (nv, 3), fits the feature weights on the first trn_size
+    samples and returns a dictionary with the fit loss (mean squared error plus the ridge penalty), the holdout loss
+    (mean squared error on the remaining samples), the weights W (nv, nf) and b (nv), the z-scoring statistics avg
+    and std (nv, nf), and if grad, the gradient of the fit loss with respect to (x, y, sigma), (nv, 3).
+    '''
+    P, dP = pool_with_grad(fmaps, rf_params, view_angle=view_angle, grad=grad)
+    if nonlinearity is not None:
+        if grad:
+            dP = dP * nonlinearity_grad(P)[...,np.newaxis]
+        P = nonlinearity(P)
+    Z, dZ, avg, std = _zscore(P, dP, epsilon)
+    y = np.asarray(voxels, dtype=np.float64)
+    W, b = _ridge_fit(Z[:trn_size], y[:trn_size], l2)
+    r = y - np.einsum('nfv,vf->nv', Z, W) - b
+    out = {'fit_loss': np.mean(np.square(r[:trn_size]), axis=0) + l2 * np.sum(np.square(W), axis=1) / trn_size,
+           'holdout_loss': np.mean(np.square(r[trn_size:]), axis=0) if trn_size<len(y) else np.full(len(rf_params), np.nan),
+           'W': W, 'b': b, 'avg': avg.T, 'std': std.T}
+    if grad:
+        out['grad'] = -2. / trn_size * np.einsum('nv,nfvk,vf->vk', r[:trn_size], dZ[:trn_size], W)
+    return out
+
+
+########################################################################
+###              REFINEMENT                                          ###
+########################################################################
+
+def refine_rf_params(
+        fmaps, voxels, rf_params, val_test_size=100, l2=0., num_iters=20, step=0.5, max_halvings=6, bounds=None,
+        nonlinearity=None, nonlinearity_grad=None, epsilon=1e-6, view_angle=20., batch_size=20, verbose=False):
+    '''
+    Refines the receptive fields rf_params (nv, 3) of voxels (n, nv), e.g. the best_rf_params of fwrf.real_space_model,
+    on the feature maps [(n, nf_r, n_pix, n_pix), ...] of the same (training) samples. The feature maps should fit in
+    memory: they are read once per iteration for every batch of batch_size voxels.
+
+    The last val_test_size samples are held out (as in fwrf.learn_params, shuffle the samples first if they are ordered).
+    Each iteration takes a step along the negative gradient in (x, y, log sigma), scaled by (sigma, sigma, 1) so that
+    step is in units of the receptive field size, and halves it (up to max_halvings times) until the fit loss decreases.
+    bounds ~ [(xmin, xmax), (ymin, ymax), (smin, smax)], by default the view_angle square and sigmas up to view_angle.
+    nonlinearity ~ the nonlinearity applied to the model space tensor, if any, with its derivative nonlinearity_grad.
+
+    Returns refined rf_params (nv, 3), w_params [W (nv, nf), b (nv)], the z-scoring statistics avg and std (nv, nf)
+    at the refined receptive fields (as returned by real_space_model) and the holdout scores (nv).
+    '''
+    n, nv = voxels.shape
+    trn_size = n - val_test_size
+    if bounds is None:
+        bounds = [(-view_angle/2., view_angle/2.), (-view_angle/2., view_angle/2.), (1e-2, view_angle)]
+    lo, hi = np.asarray(bounds, dtype=np.float64).T
+    nf = sum([fm.shape[1] for fm in fmaps])
+    kwargs = {'l2': l2, 'nonlinearity': nonlinearity, 'nonlinearity_grad': nonlinearity_grad, 'epsilon': epsilon, 'view_angle': view_angle}
+
+    best_rf_params = np.asarray(rf_params, dtype=np.float64).copy()
+    best_w_params = [np.zeros(shape=(nv, nf), dtype=fpX), np.zeros(shape=(nv), dtype=fpX)]
+    best_avg = np.zeros(shape=(nv, nf), dtype=fpX)
+    best_std = np.zeros(shape=(nv, nf), dtype=fpX)
+    best_scores = np.zeros(shape=(nv), dtype=fpX)
+    print "\nRefining %d receptive fields..." % nv
+    sys.stdout.flush()
+    start_time = time.time()
+    for rv in tqdm(range(0, nv, batch_size)):
+        vs = slice(rv, min(nv, rv+batch_size))
+        y = voxels[:, vs]
+        rf = best_rf_params[vs]
+        initial = rf_loss(fmaps, y, rf, trn_size, grad=True, **kwargs)
+        current = initial
+        alpha = np.full(len(rf), step)
+        for it in range(num_iters):
+            ## preconditioned descent direction in (x, y, log sigma)
+            scale = np.stack([rf[:,2], rf[:,2], np.ones(len(rf))], axis=1)
+            g = current['grad'] * rf[:,2:3] ## d/d(x/sigma), d/d(y/sigma), d/dlog(sigma) are all sigma times the gradient
+            direction = -g / np.maximum(np.sqrt(np.sum(np.square(g), axis=1, keepdims=True)), 1e-30)
+            accepted = np.zeros(len(rf), dtype=bool)
+            trial_alpha = alpha.copy()
+            for h in range(max_halvings+1):
+                step_u = trial_alpha[:,np.newaxis] * direction
+                trial = np.clip(np.stack([rf[:,0] + step_u[:,0]*scale[:,0], rf[:,1] + step_u[:,1]*scale[:,1], rf[:,2]*np.exp(step_u[:,2])], axis=1), lo, hi)
+                trial_loss = rf_loss(fmaps, y, trial, trn_size, grad=False, **kwargs)['fit_loss']
+                improved = ~accepted & (trial_loss < current['fit_loss'])
+                rf = np.where(improved[:,np.newaxis], trial, rf)
+                accepted |= improved
+                if np.all(accepted):
+                    break
+                trial_alpha = np.where(accepted, trial_alpha, trial_alpha / 2)
+            alpha = np.where(accepted, np.minimum(2*trial_alpha, step), trial_alpha / 2)
+            current = rf_loss(fmaps, y, rf, trn_size, grad=True, **kwargs)
+            if verbose:
+                print "  voxels %d:%d, iteration %d: <fit loss> %.6f, %d moved" % (vs.start, vs.stop, it, current['fit_loss'].mean(), accepted.sum())
+            if not np.any(accepted) and np.all(alpha < 1e-4):
+                break
+        ## keep the refinement only where it generalizes
+        if val_test_size>0:
+            keep = current['holdout_loss'] <= initial['holdout_loss']
+        else:
+            keep = np.ones(len(rf), dtype=bool)
+        for key in ['W', 'b', 'avg', 'std', 'holdout_loss']:
+            current[key] = np.where(keep.reshape((-1,)+(1,)*(current[key].ndim-1)), current[key], initial[key])
+        best_rf_params[vs] = np.where(keep[:,np.newaxis], rf, best_rf_params[vs])
+        best_w_params[0][vs], best_w_params[1][vs] = current['W'], current['b']
+        best_avg[vs], best_std[vs] = current['avg'], current['std']
+        best_scores[vs] = current['holdout_loss']
+    full_time = time.time() - start_time
+    print "%d receptive fields refined in %.3fs @ %.3f voxels/s" % (nv, full_time, fpX(nv)/full_time)
+    return best_rf_params.astype(fpX), best_w_params, best_avg, best_std, best_scores
@@ -0,0 +1,141 @@
+import numpy as np
+
+
+def _zscore_columns(X, dtype=np.float64):
+    '''returns the columns of X centered and scaled to unit norm (not unit variance), so that a dot product between
+    two such columns is their correlation coefficient. Constant columns are left at zero.'''
+    Z = np.asarray(X, dtype=dtype)
+    Z = Z - Z.mean(axis=0, keepdims=True)
+    norm = np.sqrt(np.sum(np.square(Z), axis=0, keepdims=True))
+    norm[norm==0] = np.inf
+    return Z / norm
+
+
+def column_corr(X, Y, dtype=np.float32):
+    '''
+    Column-wise pearson correlation coefficient between two matrices of shape (samples, voxels).
+    This is the vectorized equivalent of
+        for v in range(nv):
+            cc[v] = np.corrcoef(X[:,v], Y[:,v])[0,1]
+    except that constant columns score 0 instead of nan.
+    '''
+    assert X.shape==Y.shape, "%s!=%s" % (X.shape, Y.shape)
+    return np.sum(_zscore_columns(X) * _zscore_columns(Y), axis=0).astype(dtype)
+
+
+def column_partition_corr(part, full, target, dtype=np.float32):
+    '''
+    Column-wise share of the correlation of the full prediction that is carried by the partial prediction part, i.e.
+        cov(part, target) / sqrt(var(full) * var(target))
+    which sums to column_corr(full, target) over a partition of the features of a linear model.
+    '''
+    assert part.shape==full.shape==target.shape, "%s, %s, %s" % (part.shape, full.shape, target.shape)
+    P = np.asarray(part, dtype=np.float64)
+    P = P - P.mean(axis=0, keepdims=True)
+    F = np.asarray(full, dtype=np.float64)
+    norm = np.sqrt(np.sum(np.square(F - F.mean(axis=0, keepdims=True)), axis=0))
+    norm[norm==0] = np.inf
+    return (np.sum(P * _zscore_columns(target), axis=0) / norm).astype(dtype)
+
+
+def column_r2(pred, target, dtype=np.float32):
+    '''
+    Column-wise coefficient of determination 1 - SS_res / SS_tot of a prediction matrix of shape (samples, voxels).
+    '''
+    assert pred.shape==target.shape, "%s!=%s" % (pred.shape, target.shape)
+    t = np.asarray(target, dtype=np.float64)
+    ss_res = np.sum(np.square(t - pred), axis=0)
+    ss_tot = np.sum(np.square(t - t.mean(axis=0, keepdims=True)), axis=0)
+    ss_tot[ss_tot==0] = np.inf
+    return (1. - ss_res / ss_tot).astype(dtype)
+
+
+def _resample_batches(n, count, batch_size, replace, rng):
+    '''yields batches of sample index resamplings of shape (batch, n). Permutations if replace is False, bootstrap draws otherwise.'''
+    for start in range(0, count, batch_size):
+        b = min(batch_size, count-start)
+        if replace:
+            yield rng.randint(0, n, size=(b, n))
+        else:
+            yield np.argsort(rng.rand(b, n), axis=1)
+
+
+def _resample_batch_sizes(n, nv, count, bytes_per_element, max_bytes, max_resamples=100):
+    '''(resamples, voxels) batch dims whose (resamples, n, voxels) temporaries of bytes_per_element fit in max_bytes.'''
+    bp = min(count, max_resamples)
+    bv = max_bytes // (bytes_per_element * bp * n)
+    if bv < 1:
+        bp, bv = max(1, max_bytes // (bytes_per_element * n)), 1
+    return int(bp), int(min(nv, bv))
+
+
+def permutation_null(pred, target, n_perm=1000, batches=None, seed=None, dtype=np.float32, max_bytes=256*1024**2):
+    '''
+    Null distribution of the column-wise correlation between pred and target under random permutations of the sample order.
+    The same permutation is applied to every voxel, which preserves the spatial correlation of the noise.
+
+    batches dims are (resamples, voxels). The working memory is approx. 8 x resamples x samples x voxels bytes, and the
+    default batches keep it under max_bytes.
+
+    Returns:
+     a (n_perm, nv) array of null correlation coefficients.
+    '''
+    assert pred.shape==target.shape, "%s!=%s" % (pred.shape, target.shape)
+    n, nv = target.shape
+    bp, bv = batches or _resample_batch_sizes(n, nv, n_perm, 8, max_bytes)
+    rng = np.random.RandomState(seed)
+    null = np.ndarray(shape=(n_perm, nv), dtype=dtype)
+    Zp = _zscore_columns(pred)
+    Zt = _zscore_columns(target)
+    p = 0
+    for perms in _resample_batches(n, n_perm, bp, False, rng):
+        for v in range(0, nv, bv):
+            vs = slice(v, v+bv)
+            null[p:p+len(perms), vs] = np.einsum('bnv,nv->bv', Zp[:,vs][perms], Zt[:,vs])
+        p += len(perms)
+    return null
+
+
+def permutation_pvalues(observed, null):
+    '''
+    One-sided permutation p-values (observed >= null) for each voxel, with the usual +1 correction so that p is never 0.
+    '''
+    return (1. + np.sum(null >= observed[np.newaxis], axis=0)) / (1. + len(null))
+
+
+def bootstrap_corr(pred, target, n_boot=1000, batches=None, seed=None, dtype=np.float32, max_bytes=256*1024**2):
+    '''
+    Bootstrap distribution of the column-wise correlation between pred and target. Samples are drawn with replacement
+    jointly for pred and target, and the same draw is used for every voxel.
+
+    batches dims are (resamples, voxels). The working memory is approx. 24 x resamples x samples x voxels bytes (the
+    resampled predictions, the resampled data and their product), and the default batches keep it under max_bytes.
+
+    Returns:
+     a (n_boot, nv) array of resampled correlation coefficients.
+    '''
+    assert pred.shape==target.shape, "%s!=%s" % (pred.shape, target.shape)
+    n, nv = target.shape
+    bb, bv = batches or _resample_batch_sizes(n, nv, n_boot, 24, max_bytes)
+    rng = np.random.RandomState(seed)
+    boot = np.ndarray(shape=(n_boot, nv), dtype=dtype)
+    P = np.asarray(pred, dtype=np.float64)
+    Y = np.asarray(target, dtype=np.float64)
+    b = 0
+    for draws in _resample_batches(n, n_boot, bb, True, rng):
+        for v in range(0, nv, bv):
+            vs = slice(v, v+bv)
+            p = P[:,vs][draws]
+            y = Y[:,vs][draws]
+            p -= p.mean(axis=1, keepdims=True)
+            y -= y.mean(axis=1, keepdims=True)
+            den = np.sqrt(np.sum(np.square(p), axis=1) * np.sum(np.square(y), axis=1))
+            den[den==0] = np.inf
+            boot[b:b+len(draws), vs] = np.sum(p * y, axis=1) / den
+        b += len(draws)
+    return boot
+
+
+def bootstrap_interval(boot, alpha=0.05):
+    '''returns the (lower, upper) percentile confidence bounds of a bootstrap distribution, per voxel.'''
+    return np.percentile(boot, 100.*alpha/2, axis=0), np.percentile(boot, 100.*(1.-alpha/2), axis=0)
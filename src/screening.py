@@ -0,0 +1,187 @@
+'''
+Screening of the voxels before the full fit.
+
+Most voxels of a whole brain mask are not predictable, but fwrf.learn_params spends the same candidate x epoch budget
+on each of them. screen_voxels runs a cheap proxy fit on every voxel: a coarse subset of the candidates, optionally a
+reduced feature basis (feature_reduction), and the closed form ridge regression of sufficient_stats, scored on the
+last val_test_size samples. select_voxels keeps the voxels above a threshold and/or the top k, e.g.
+
+    screen = screening.screen_voxels(mst_data, voxels, sharedModel_specs, val_test_size=200, reduce_dim=16)
+    selected = screening.select_voxels(screen['scores'], threshold=0.02, top_k=5000)
+    model = fwrf.kout_learn_params(mst_data, voxels[:,selected], val_sample_order, [p[selected] for p in w_params], ...)
+
+which only covers the selected voxels, or screened_learn_params and screened_kout_learn_params, which run
+learn_params (kout_learn_params) on the selected voxels only and fill in the other voxels with their proxy models,
+so that the outputs still cover every voxel:
+
+    model = screening.screened_kout_learn_params(mst_data, voxels, val_sample_order, w_params, threshold=0.02,
+                                                 top_k=5000, sharedModel_specs=sharedModel_specs, reduce_dim=16)
+
+The proxy scores are not comparable with the ones of the full fit (they are scored on other samples, and are not
+trained by gradient descent), so the scores of the voxels that were not fitted are nan, and the proxy scores are
+returned with the screen.
+'''
+import sys
+import time
+import numpy as np
+
+import feature_reduction as pfr
+import sufficient_stats as pss
+
+
+fpX = np.float32
+
+########################################################################
+###              PROXY FIT                                           ###
+########################################################################
+
+def coarse_candidates(sharedModel_specs, step=(2,2,1)):
+    '''the indices of every step-th candidate along x, y and sigma, in the candidate order (ix*ny + iy)*ns + is.'''
+    nx, ny, ns = [sms.length for sms in sharedModel_specs[1]]
+    ix, iy, is_ = np.meshgrid(np.arange(0, nx, step[0]), np.arange(0, ny, step[1]), np.arange(0, ns, step[2]), indexing='ij')
+    return ((ix*ny + iy)*ns + is_).flatten()
+
+
+def screen_voxels(mst_data, voxels, sharedModel_specs=None, candidates=None, reduce_dim=None, val_test_size=100,
+                  l2=[1., 10., 100.], batch_size=None, epsilon=1e-6, max_bytes=512*1024**2):
+    '''
+    Proxy fit of every voxel (n, nv) on the candidates (default: coarse_candidates of sharedModel_specs) of the model
+    space tensor mst_data (n, nf, 1, nt), optionally reduced to reduce_dim features by a global projection learned on
+    the fit samples. The ridge penalties l2 are swept in closed form and the last val_test_size samples are held out.
+    The statistics of the features (x, xx) are accumulated once, and only their cross products with the voxels are
+    accumulated for each batch of batch_size voxels (default: as many as fit in max_bytes).
+
+    Returns a dictionary with
+     scores: the holdout coefficient of determination of the proxy model of every voxel (nv)
+     val_mse: its holdout mean squared error (nv)
+     candidates: its candidate, as an index of mst_data (nv)
+     w_params: its weights [W (nv, nf), b (nv)] on the candidate columns of mst_data, as the ones of learn_params
+     selection: the screened candidates
+    '''
+    n, nf, _, nt = mst_data.shape
+    _, nv = voxels.shape
+    trn_size = n - val_test_size
+    if candidates is None:
+        candidates = coarse_candidates(sharedModel_specs) if sharedModel_specs is not None else np.arange(nt)
+    candidates = np.asarray(candidates, dtype=int)
+    X = np.asarray(mst_data[:,:,:,candidates], dtype=fpX)
+    projection = None
+    if reduce_dim is not None:
+        projection = pfr.fit_projection(X, reduce_dim, trn_size=trn_size, mode='global')
+        X = pfr.apply_projection(X, projection)
+    X = X[:,:,0,:]
+    k = X.shape[1]
+    print "\nScreening %d voxels on %d candidates x %d features..." % (nv, len(candidates), k)
+    sys.stdout.flush()
+    start_time = time.time()
+    screen = {'scores': np.zeros(shape=(nv), dtype=fpX), 'val_mse': np.zeros(shape=(nv), dtype=fpX), 'candidates': np.zeros(shape=(nv), dtype=int),
+              'w_params': [np.zeros(shape=(nv, nf), dtype=fpX), np.zeros(shape=(nv), dtype=fpX)], 'selection': candidates}
+    nc = len(candidates)
+    features = {'fit': pss.update_stats(pss.empty_stats(k, 0, nc), X[:trn_size], np.zeros(shape=(trn_size, 0))),
+                'holdout': pss.update_stats(pss.empty_stats(k, 0, nc), X[trn_size:], np.zeros(shape=(n-trn_size, 0)))}
+    if batch_size is None:
+        ## the fit and holdout xy (nc, k, voxels) and the z-scored copy of fit_from_stats, in float64
+        batch_size = int(max(1, min(nv, max_bytes // (3 * nc * k * 8))))
+    for v in range(0, nv, batch_size):
+        rv = slice(v, min(nv, v+batch_size))
+        Y = np.asarray(voxels[:,rv], dtype=np.float64)
+        stats = {'fit': pss.voxel_stats(features['fit'], X[:trn_size], Y[:trn_size]),
+                 'holdout': pss.voxel_stats(features['holdout'], X[trn_size:], Y[trn_size:])}
+        _, mse, _, best, (W, b) = pss.fit_from_stats(stats, l2=l2, epsilon=epsilon, output_val_scores=False)
+        ## weights on the raw (projected) columns instead of the proxy z-scored ones
+        W, b = pss.raw_w_params(stats, best, [W, b], epsilon=epsilon)
+        if projection is not None:
+            W, b = pfr.project_w_params([W, b], projection, candidates=best)
+        h = stats['holdout']
+        var = h['yy'] / h['n'] - np.square(h['y'] / h['n'])
+        screen['scores'][rv] = 1. - mse / np.maximum(var, 1e-12)
+        screen['val_mse'][rv] = mse
+        screen['candidates'][rv] = candidates[best]
+        screen['w_params'][0][rv], screen['w_params'][1][rv] = W, b
+    full_time = time.time() - start_time
+    print "%d voxels screened in %.3fs, median holdout R2 %.4f" % (nv, full_time, np.median(screen['scores']))
+    return screen
+
+
+def select_voxels(scores, threshold=None, top_k=None):
+    '''the indices (sorted) of the voxels whose score is above threshold, limited to the top_k best.'''
+    selected = np.arange(len(scores)) if threshold is None else np.where(scores > threshold)[0]
+    if top_k is not None and len(selected) > top_k:
+        selected = selected[np.argsort(-scores[selected], kind='mergesort')[:top_k]]
+    return np.sort(selected)
+
+
+########################################################################
+###              SCREENED FIT                                        ###
+########################################################################
+
+def _expand(a, selected, proxy, nv, axis):
+    '''the result a of the selected voxels in an array over all the nv voxels, initialized with proxy.'''
+    if not isinstance(a, np.ndarray) or a.ndim<=axis or a.shape[axis]!=len(selected):
+        return a
+    out = np.array(np.broadcast_to(proxy, a.shape[:axis] + (nv,) + a.shape[axis+1:]), dtype=a.dtype)
+    out[(slice(None),)*axis + (selected,)] = a
+    return out
+
+
+def screened_learn_params(mst_data, voxels, w_params, threshold=None, top_k=None, screen=None, sharedModel_specs=None,
+                          candidates=None, reduce_dim=None, val_test_size=100, l2=0.0, screen_l2=[1., 10., 100.], **kwargs):
+    '''
+    fwrf.learn_params restricted to the voxels selected by a screening (see screen_voxels and select_voxels, a
+    precomputed screen can be passed). The other voxels keep the candidate and weights of their proxy model, with
+    nan best score, best_epochs -1 and nan val_scores: learn_params scores its (shuffled) holdout samples, the proxy
+    the last val_test_size samples, so the two are not comparable. The proxy scores are in the screen.
+
+    Returns the outputs of learn_params over all the voxels, followed by the selected voxel indices and the screen.
+    '''
+    import fwrf
+    nv = voxels.shape[1]
+    if screen is None:
+        screen = screen_voxels(mst_data, voxels, sharedModel_specs=sharedModel_specs, candidates=candidates, reduce_dim=reduce_dim,
+                               val_test_size=val_test_size, l2=screen_l2)
+    selected = select_voxels(screen['scores'], threshold=threshold, top_k=top_k)
+    print "\n%d of %d voxels selected for the full fit" % (len(selected), nv)
+    results = fwrf.learn_params(mst_data, voxels[:,selected], [p[selected] for p in w_params], val_test_size=val_test_size, l2=l2, **kwargs)
+    val_scores, best_scores, best_epochs, best_candidates, best_w_params = results[:5]
+    expanded = (_expand(val_scores, selected, np.nan, nv, 1),
+                _expand(best_scores, selected, np.nan, nv, 0),
+                _expand(best_epochs, selected, -1, nv, 0),
+                _expand(best_candidates, selected, screen['candidates'], nv, 0),
+                [_expand(best_w_params[i], selected, screen['w_params'][i], nv, 0) for i in range(2)])
+    if len(results)>5: # the hyperparameters of a sweep
+        expanded += (_expand(results[5], selected, np.nan, nv, 0),)
+    return expanded + (selected, screen)
+
+
+def screened_kout_learn_params(mst_data, voxels, val_sample_order, w_params, threshold=None, top_k=None, screen=None,
+                               sharedModel_specs=None, candidates=None, reduce_dim=None, val_test_size=100,
+                               screen_l2=[1., 10., 100.], **kwargs):
+    '''
+    fwrf.kout_learn_params restricted to the voxels selected by a screening, as screened_learn_params. The screening
+    sees all the samples (val_test_size is its own holdout), so the selection is not independent of the k-out parts.
+
+    Returns the model of kout_learn_params over all the voxels. The voxels that were not fitted keep the candidate and
+    weights of their proxy model in every part, with nan scores, val_cc and val_pred and epochs -1. The model also
+    holds the 'selected' voxel indices and the 'screen'.
+    '''
+    import fwrf
+    nv = voxels.shape[1]
+    if screen is None:
+        screen = screen_voxels(mst_data, voxels, sharedModel_specs=sharedModel_specs, candidates=candidates, reduce_dim=reduce_dim,
+                               val_test_size=val_test_size, l2=screen_l2)
+    selected = select_voxels(screen['scores'], threshold=threshold, top_k=top_k)
+    print "\n%d of %d voxels selected for the k-out fit" % (len(selected), nv)
+    model = fwrf.kout_learn_params(mst_data, voxels[:,selected], val_sample_order, [p[selected] for p in w_params], **kwargs)
+    proxy = {'candidates': screen['candidates'], 'epochs': -1}
+    for k,v in model.items():
+        if isinstance(v, dict): # one resampling block, whose val_mask is over the samples
+            for kk,vv in v.items():
+                if kk=='w_params':
+                    v[kk] = [_expand(vv[i], selected, screen['w_params'][i], nv, 0) for i in range(2)]
+                elif kk!='val_mask':
+                    v[kk] = _expand(vv, selected, proxy.get(kk, np.nan), nv, 1 if kk=='val_scores' else 0)
+        elif k in ('val_pred', 'val_cc'):
+            model[k] = _expand(v, selected, np.nan, nv, 1 if k=='val_pred' else 0)
+    model['selected'] = selected
+    model['screen'] = screen
+    return model
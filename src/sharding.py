@@ -0,0 +1,356 @@
+'''
+Sharded fits over many nodes, with a work queue on a shared filesystem.
+
+A coordinator splits the voxels (and the k-out parts) into work units and writes them to a queue directory. Any number
+of workers, on any node that sees the directory, claim the units atomically (a rename from todo/ to claimed/), fit them
+against the model space tensor memmapped from the shared directory, and write one result shard per unit. merge then
+assembles the standard outputs of fwrf.learn_params (or of fwrf.kout_learn_params):
+
+    sharding.create_job('/shared/fit', mst_data, voxels, voxels_per_unit=5000, batches=(200, 1000, 500), num_epochs=20,
+                        val_test_size=400, lr=1e-4)
+    # on every node, as many times as wanted:
+    python -m src.sharding worker /shared/fit
+    # or on one machine:
+    sharding.run_local_workers('/shared/fit', num_workers=4)
+    val_scores, best_scores, best_epochs, best_candidates, best_w_params = sharding.merge('/shared/fit')
+
+The queue directory holds
+    job.pkl       the job description (paths of the arrays, fit method and arguments)
+    todo/         the units waiting to be claimed
+    claimed/      the units being fitted, with the id of their worker (requeue moves the stale ones back)
+    done/         the fitted units
+    failed/       the units whose fit raised, with the traceback
+    results/      one result shard per fitted unit
+
+A worker refreshes the modification time of its claim every heartbeat seconds while it fits the unit, so requeue only
+takes back the units of dead workers if stale_seconds is a few heartbeats. A worker only moves a unit to done/ (or
+failed/) if the claim is still its own: a unit requeued and claimed again elsewhere is left to its new worker.
+
+method ~ 'sgd' (fwrf.learn_params) or 'closed_form' (ridge regression from the sufficient statistics of every
+candidate, see sufficient_stats.fit_from_stats, with best_epochs holding the index of the best l2).
+'''
+import os
+import sys
+import time
+import socket
+import pickle
+import threading
+import traceback
+import numpy as np
+from contextlib import contextmanager
+from multiprocessing import Process
+
+import scoring_utility as psu
+import sufficient_stats as pss
+
+
+fpX = np.float32
+
+queue_dirs = ['todo', 'claimed', 'done', 'failed', 'results']
+
+########################################################################
+###              QUEUE                                               ###
+########################################################################
+
+def _path(root, *names):
+    return os.path.join(root, *names)
+
+def _write_atomic(path, obj):
+    '''pickles obj to a temporary file next to path, then renames it, so that readers never see a partial file.'''
+    tmp = '%s.%s.%d.tmp' % (path, socket.gethostname(), os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def _units(root, d):
+    return sorted([u for u in os.listdir(_path(root, d)) if u.endswith('.pkl')])
+
+def _worker_id():
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def kout_folds(val_sample_order, val_part_size):
+    '''the held out rows of every k-out part, as in fwrf.kout_learn_params.'''
+    n = len(val_sample_order)
+    assert n % val_part_size==0, "val_part_size (%d) has to divide the number of samples (%d)" % (val_part_size, n)
+    return [np.asarray(val_sample_order[k:k+val_part_size], dtype=int) for k in range(0, n, val_part_size)]
+
+
+def create_job(root, mst_data, voxels, voxels_per_unit=1000, folds=None, method='sgd', seed=0, **fit_kwargs):
+    '''
+    Writes a job to the queue directory root (created if needed). mst_data (n, nf, 1, nt) and voxels (n, nv) are arrays,
+    saved to root as .npy, or paths to .npy files that every worker can read. The voxels are split in units of
+    voxels_per_unit voxels. With folds (a list of held out row indices, see kout_folds), there is one unit per part and
+    per voxel range, as in kout_learn_params. fit_kwargs are passed to learn_params, e.g. batches, num_epochs,
+    val_test_size (the holdout, holdout_size of kout_learn_params), lr and l2.
+    Returns the number of units.
+    '''
+    for d in queue_dirs:
+        if not os.path.exists(_path(root, d)):
+            os.makedirs(_path(root, d))
+    assert len(os.listdir(_path(root, 'todo')))==0 and len(os.listdir(_path(root, 'claimed')))==0, "%s already holds a job" % root
+    paths = {}
+    for name, a in [('mst_data', mst_data), ('voxels', voxels)]:
+        if isinstance(a, str):
+            paths[name] = os.path.abspath(a)
+        else:
+            paths[name] = os.path.abspath(_path(root, name + '.npy'))
+            np.save(paths[name], np.asarray(a, dtype=fpX))
+    n, nv = np.load(paths['voxels'], mmap_mode='r').shape
+    assert np.load(paths['mst_data'], mmap_mode='r').shape[0]==n, "data/target length mismatch"
+    assert method in ['sgd', 'closed_form'], "unknown method %s" % method
+    ranges = [(v, min(nv, v+voxels_per_unit)) for v in range(0, nv, voxels_per_unit)]
+    parts = [None,] if folds is None else range(len(folds))
+    units = [{'id': i, 'voxels': r, 'fold': k} for i,(k,r) in enumerate([(k, r) for k in parts for r in ranges])]
+    _write_atomic(_path(root, 'job.pkl'), {'mst_data': paths['mst_data'], 'voxels': paths['voxels'], 'n': n, 'nv': nv,
+        'folds': folds, 'method': method, 'seed': seed, 'fit_kwargs': fit_kwargs, 'num_units': len(units)})
+    for u in units:
+        _write_atomic(_path(root, 'todo', 'unit_%06d.pkl' % u['id']), u)
+    print "%d units (%d voxel ranges x %d parts) queued in %s" % (len(units), len(ranges), len(parts), root)
+    return len(units)
+
+
+def claim(root, worker=None):
+    '''
+    claims the first available unit for worker (default: this process), whose id is written in the claim.
+    Returns its name and description, or None if the queue is empty.
+    '''
+    worker = worker or _worker_id()
+    for name in _units(root, 'todo'):
+        try:
+            os.rename(_path(root, 'todo', name), _path(root, 'claimed', name))
+        except OSError: # claimed by another worker in the meantime
+            continue
+        unit = dict(_read(_path(root, 'claimed', name)), worker=worker)
+        _write_atomic(_path(root, 'claimed', name), unit) # also the claim time, for requeue
+        return name, unit
+    return None
+
+
+def owner(root, name):
+    '''the worker of the claimed unit name, or None if it is not claimed.'''
+    try:
+        return _read(_path(root, 'claimed', name)).get('worker', None)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def release(root, name, worker, dest='done'):
+    '''
+    moves the unit name claimed by worker to dest. Returns False, without moving anything, if the claim is no longer
+    the worker's: requeued, then claimed by another worker or already completed elsewhere.
+    '''
+    if owner(root, name)!=worker:
+        return False
+    try:
+        os.rename(_path(root, 'claimed', name), _path(root, dest, name))
+    except OSError:
+        return False
+    return True
+
+
+@contextmanager
+def heartbeat(root, name, worker, interval=60.):
+    '''refreshes the claim time of the unit name every interval seconds while worker fits it and still owns it.'''
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(interval):
+            if owner(root, name)==worker:
+                try:
+                    os.utime(_path(root, 'claimed', name), None)
+                except OSError:
+                    pass
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def requeue(root, stale_seconds=None, failed=False):
+    '''
+    moves the claimed units older than stale_seconds (e.g. of a dead worker: a few heartbeats of run_worker), and the
+    failed ones, back to todo.
+    '''
+    moved = 0
+    if stale_seconds is not None:
+        for name in _units(root, 'claimed'):
+            try:
+                if time.time() - os.path.getmtime(_path(root, 'claimed', name)) > stale_seconds:
+                    os.rename(_path(root, 'claimed', name), _path(root, 'todo', name))
+                    moved += 1
+            except OSError:
+                continue
+    if failed:
+        for name in _units(root, 'failed'):
+            os.rename(_path(root, 'failed', name), _path(root, 'todo', name))
+            moved += 1
+    return moved
+
+
+def status(root):
+    '''the number of units in every queue state.'''
+    return dict([(d, len(_units(root, d))) for d in queue_dirs[:-1]])
+
+
+########################################################################
+###              WORKERS                                             ###
+########################################################################
+
+def fit_unit(job, unit, mst_data, voxels):
+    '''fits one unit, returns its result shard.'''
+    np.random.seed(job['seed'] + unit['id'])
+    v0, v1 = unit['voxels']
+    Y = np.asarray(voxels[:, v0:v1], dtype=fpX)
+    n, nf = mst_data.shape[:2]
+    rows = np.arange(n, dtype=int)
+    if unit['fold'] is not None:
+        val_rows = np.sort(job['folds'][unit['fold']])
+        rows = np.setdiff1d(rows, val_rows)
+    if job['method']=='sgd':
+        import fwrf
+        w_params = [np.zeros(shape=(v1-v0, nf), dtype=fpX), np.zeros(shape=(v1-v0), dtype=fpX)]
+        results = fwrf.learn_params(mst_data, Y, w_params, rows=rows, **job['fit_kwargs'])
+    else:
+        results = pss.fit_model_space_tensor(mst_data, Y, rows=rows, **job['fit_kwargs'])
+    shard = {'unit': unit, 'results': results}
+    if unit['fold'] is not None:
+        candidates, (W, b) = results[3], results[4]
+        shard['val_rows'] = val_rows
+        shard['val_pred'] = (np.einsum('nfv,vf->nv', np.asarray(mst_data[val_rows][:,:,0,candidates], dtype=fpX), W) + b).astype(fpX)
+    return shard
+
+
+def run_worker(root, worker=None, max_units=None, heartbeat_seconds=60.):
+    '''
+    claims and fits units until the queue is empty (or max_units are done), refreshing the claim every
+    heartbeat_seconds. Returns the number of fitted units.
+    '''
+    worker = worker or _worker_id()
+    job = _read(_path(root, 'job.pkl'))
+    mst_data = np.load(job['mst_data'], mmap_mode='r')
+    voxels = np.load(job['voxels'], mmap_mode='r')
+    count = 0
+    while max_units is None or count<max_units:
+        claimed = claim(root, worker)
+        if claimed is None:
+            break
+        name, unit = claimed
+        print "[%s] unit %d: voxels %d:%d, part %s" % (worker, unit['id'], unit['voxels'][0], unit['voxels'][1], unit['fold'])
+        sys.stdout.flush()
+        start_time = time.time()
+        try:
+            with heartbeat(root, name, worker, interval=heartbeat_seconds):
+                shard = fit_unit(job, unit, mst_data, voxels)
+            shard.update({'worker': worker, 'seconds': time.time() - start_time})
+            _write_atomic(_path(root, 'results', name), shard)
+        except Exception:
+            error = traceback.format_exc()
+            if release(root, name, worker, 'failed'):
+                with open(_path(root, 'failed', name[:-4] + '.txt'), 'w') as f:
+                    f.write('%s\n%s' % (worker, error))
+            print "[%s] unit %d failed:\n%s" % (worker, unit['id'], error)
+            continue
+        if release(root, name, worker, 'done'):
+            count += 1
+        else: # requeued while it was fitted, the result shard is the same as the other worker's
+            print "[%s] unit %d was claimed again by %s, leaving it to that worker" % (worker, unit['id'], owner(root, name) or 'another worker')
+    print "[%s] %d units fitted" % (worker, count)
+    return count
+
+
+def run_local_workers(root, num_workers=2):
+    '''runs num_workers worker processes on this machine until the queue is empty. Returns the queue status.'''
+    workers = [Process(target=run_worker, args=(root, '%s-local%d' % (socket.gethostname(), i))) for i in range(num_workers)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return status(root)
+
+
+########################################################################
+###              MERGE                                               ###
+########################################################################
+
+def _assemble(shards, nv):
+    '''the learn_params outputs of every voxel from the shards of disjoint voxel ranges.'''
+    first = shards[0]['results']
+    val_scores = first[0]
+    if isinstance(val_scores, np.ndarray) and val_scores.ndim==3 and val_scores.shape[1]==first[1].shape[0]:
+        val_scores = np.zeros(shape=(val_scores.shape[0], nv, val_scores.shape[2]), dtype=fpX)
+    best_scores = np.zeros(shape=(nv), dtype=fpX)
+    best_epochs = np.zeros(shape=(nv), dtype=int)
+    best_candidates = np.zeros(shape=(nv), dtype=int)
+    best_w_params = [np.zeros(shape=(nv,) + first[4][0].shape[1:], dtype=fpX), np.zeros(shape=(nv), dtype=fpX)]
+    extra = [np.zeros(shape=(nv,) + r.shape[1:], dtype=r.dtype) for r in first[5:]] # e.g. the hyperparameters of a sweep
+    for s in shards:
+        rv = slice(*s['unit']['voxels'])
+        r = s['results']
+        if isinstance(val_scores, np.ndarray) and val_scores.ndim==3 and val_scores.shape[1]==nv:
+            val_scores[:, rv] = r[0]
+        best_scores[rv], best_epochs[rv], best_candidates[rv] = r[1], r[2], r[3]
+        best_w_params[0][rv], best_w_params[1][rv] = r[4]
+        for e,x in zip(extra, r[5:]):
+            e[rv] = x
+    return (val_scores, best_scores, best_epochs, best_candidates, best_w_params) + tuple(extra)
+
+
+def merge(root):
+    '''
+    Assembles the result shards of a completed job: the outputs of learn_params over all the voxels, or the model
+    dictionary of kout_learn_params for a job with folds.
+    '''
+    job = _read(_path(root, 'job.pkl'))
+    st = status(root)
+    assert st['todo']==0 and st['claimed']==0 and st['failed']==0, "the job is not complete: %s" % st
+    shards = [_read(_path(root, 'results', name)) for name in _units(root, 'results')]
+    assert len(shards)==job['num_units'], "%d result shards for %d units" % (len(shards), job['num_units'])
+    nv = job['nv']
+    if job['folds'] is None:
+        return _assemble(shards, nv)
+    voxels = np.load(job['voxels'], mmap_mode='r')
+    model = {}
+    full_val_pred = np.zeros(shape=(job['n'], nv), dtype=fpX)
+    for k in range(len(job['folds'])):
+        part = [s for s in shards if s['unit']['fold']==k]
+        _, best_scores, best_epochs, best_candidates, best_w_params = _assemble(part, nv)[:5]
+        val_rows = part[0]['val_rows']
+        for s in part:
+            full_val_pred[val_rows, slice(*s['unit']['voxels'])] = s['val_pred']
+        val_mask = np.zeros(shape=(job['n']), dtype=bool)
+        val_mask[val_rows] = True
+        model[k] = {'scores': best_scores, 'epochs': best_epochs, 'w_params': best_w_params, 'candidates': best_candidates,
+                    'val_mask': val_mask, 'val_cc': psu.column_corr(full_val_pred[val_rows], np.asarray(voxels[val_rows]))}
+    model['n_parts'] = len(job['folds'])
+    model['val_pred'] = full_val_pred
+    model['val_cc'] = psu.column_corr(full_val_pred, np.asarray(voxels))
+    return model
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='sharded fwrf fits with a work queue directory')
+    parser.add_argument('command', choices=['worker', 'local', 'status', 'requeue'])
+    parser.add_argument('root', help='queue directory of the job (see create_job)')
+    parser.add_argument('--num_workers', type=int, default=2, help='worker processes for the local command')
+    parser.add_argument('--max_units', type=int, default=None, help='units fitted by a worker before it exits')
+    parser.add_argument('--heartbeat', type=float, default=60., help='seconds between the claim refreshes of a worker')
+    parser.add_argument('--stale', type=float, default=None, help='requeue the units claimed for more than this many seconds')
+    parser.add_argument('--failed', action='store_true', help='requeue the failed units')
+    args = parser.parse_args()
+    if args.command=='worker':
+        run_worker(args.root, max_units=args.max_units, heartbeat_seconds=args.heartbeat)
+    elif args.command=='local':
+        print run_local_workers(args.root, num_workers=args.num_workers)
+    elif args.command=='requeue':
+        print "%d units requeued" % requeue(args.root, stale_seconds=args.stale, failed=args.failed)
+    else:
+        print status(args.root)
@@ -0,0 +1,247 @@
+'''
+Training from streamed sufficient statistics, without the model space tensor.
+
+A linear fit of the voxels Y on the (z-scored) pooled features X_t of candidate t only needs X_t'X_t, X_t'Y and the
+feature and voxel sums. accumulate_sufficient_stats streams batches of feature maps (as fused_model_space_tensor),
+pools them against every candidate and accumulates these statistics separately for the fit samples and the holdout
+samples, so that memory scales with nt x nf x (nf + nv) instead of n x nf x nt, and more samples only cost time:
+
+    stats = accumulate_sufficient_stats(fmap_batches, voxels, sharedModel_specs, val_test_size=200)
+    val_scores, best_scores, best_l2, best_candidates, best_w_params = fit_from_stats(stats, l2=[0.1, 1., 10.])
+    mst_avg, mst_std = stats_zscore(stats)
+
+The features are z-scored with the statistics of all the (fit and holdout) samples, as model_space_tensor with
+trn_size followed by learn_params with val_test_size, and the best candidate (and ridge penalty) of each voxel is the
+one with the lowest holdout mean squared error.
+'''
+import sys
+import time
+import numpy as np
+from tqdm import tqdm
+
+import pooling as ppl
+import scoring_utility as psu
+
+
+fpX = np.float32
+
+########################################################################
+###              ACCUMULATION                                        ###
+########################################################################
+
+def empty_stats(nf, nv, nt, dtype=np.float64):
+    return {'n': 0, 'x': np.zeros(shape=(nt, nf), dtype=dtype), 'xx': np.zeros(shape=(nt, nf, nf), dtype=dtype),
+            'xy': np.zeros(shape=(nt, nf, nv), dtype=dtype), 'y': np.zeros(shape=(nv), dtype=dtype), 'yy': np.zeros(shape=(nv), dtype=dtype)}
+
+
+def update_stats(s, rows, Y):
+    '''adds the pooled rows (bn, nf, nt) and the voxel rows Y (bn, nv) to the statistics s.'''
+    if len(rows)==0:
+        return s
+    rows = np.asarray(rows, dtype=s['xx'].dtype)
+    Y = np.asarray(Y, dtype=s['xx'].dtype)
+    s['n']  += len(rows)
+    s['x']  += np.sum(rows, axis=0).T
+    s['xx'] += np.einsum('nft,ngt->tfg', rows, rows)
+    s['xy'] += np.einsum('nft,nv->tfv', rows, Y)
+    s['y']  += np.sum(Y, axis=0)
+    s['yy'] += np.sum(np.square(Y), axis=0)
+    return s
+
+
+
+def voxel_stats(s, rows, Y):
+    '''
+    the statistics s of the pooled rows (bn, nf, nt) (e.g. accumulated with no voxels), completed with the ones of the
+    voxel rows Y (bn, nv). x and xx do not depend on the voxels and are shared with s, so that batches of voxels can be
+    fitted against the same rows without accumulating xx again.
+    '''
+    rows = np.asarray(rows, dtype=s['xx'].dtype)
+    Y = np.asarray(Y, dtype=s['xx'].dtype)
+    assert s['n']==len(rows)==len(Y), "the rows do not match the statistics"
+    return {'n': s['n'], 'x': s['x'], 'xx': s['xx'], 'xy': np.einsum('nft,nv->tfv', rows, Y),
+            'y': np.sum(Y, axis=0), 'yy': np.sum(np.square(Y), axis=0)}
+
+def accumulate_sufficient_stats(fmap_batches, voxels, sharedModel_specs, val_test_size=0, pool=None, nonlinearity=None,
+                                view_angle=20., dtype=np.float64):
+    '''
+    Streams fmap_batches (an iterable of grouped feature map batches [(bn, nf_r, n_pix, n_pix), ...], see
+    fused_model_space_tensor), pools every batch against the candidates of sharedModel_specs, applies the optional
+    nonlinearity, and accumulates the statistics of the pooled features and of the matching rows of voxels (n, nv).
+    The last val_test_size samples are the holdout samples.
+
+    The statistics take about 8 x nt x nf x (nf + nv) x 2 bytes; fit a subset of the voxels at a time if that is too much.
+    Returns a dictionary with the statistics of the 'fit' and the 'holdout' samples.
+    '''
+    n, nv = voxels.shape
+    trn_size = n - val_test_size
+    nt = np.prod([sms.length for sms in sharedModel_specs[1]])
+    stats = None
+    print "\nAccumulating the sufficient statistics of %d candidates..." % nt
+    sys.stdout.flush()
+    start_time = time.time()
+    i = 0
+    for fmaps in fmap_batches:
+        if pool is None:
+            pool = ppl.make_pooling_function([fm.shape for fm in fmaps], sharedModel_specs, view_angle=view_angle)
+        rows, = ppl.iterate_model_space_rows([fmaps], pool, nonlinearity=nonlinearity)
+        rows = rows[:,:,0,:]
+        bn, nf = rows.shape[:2]
+        if stats is None:
+            stats = {'fit': empty_stats(nf, nv, nt, dtype=dtype), 'holdout': empty_stats(nf, nv, nt, dtype=dtype)}
+        k = min(max(trn_size-i, 0), bn)
+        update_stats(stats['fit'], rows[:k], voxels[i:i+k])
+        update_stats(stats['holdout'], rows[k:], voxels[i+k:i+bn])
+        i += bn
+    assert i==n, "fmap_batches produced %d samples instead of %d" % (i, n)
+    full_time = time.time() - start_time
+    print "%d samples x %d candidates took %.3fs @ %.3f samples/s" % (n, nt, full_time, fpX(n)/full_time)
+    return stats
+
+
+def merge_stats(stats_list):
+    '''sums statistics accumulated on disjoint sets of samples (e.g. in parallel).'''
+    merged = {}
+    for part in stats_list[0].keys():
+        merged[part] = dict([(k, sum([s[part][k] for s in stats_list])) for k in stats_list[0][part].keys()])
+    return merged
+
+
+########################################################################
+###              Z-SCORING                                           ###
+########################################################################
+
+def _avg_std(stats, epsilon=1e-6):
+    '''mean and standard deviation (nt, nf) of the features over all the samples.'''
+    f, h = stats['fit'], stats['holdout']
+    n = f['n'] + h['n']
+    avg = (f['x'] + h['x']) / n
+    var = (np.diagonal(f['xx'], axis1=1, axis2=2) + np.diagonal(h['xx'], axis1=1, axis2=2)) / n - np.square(avg)
+    return avg, np.sqrt(np.maximum(var, 0.)) + epsilon
+
+
+def stats_zscore(stats, epsilon=1e-6):
+    '''the z-scoring statistics of all the samples, in the (1, nf, 1, nt) format of model_space_tensor.'''
+    avg, std = _avg_std(stats, epsilon=epsilon)
+    return avg.T[np.newaxis,:,np.newaxis,:].astype(fpX), std.T[np.newaxis,:,np.newaxis,:].astype(fpX)
+
+
+def _zscored(s, t, avg, std):
+    '''the statistics of z = (x - avg) / std of candidate t from the raw statistics s. avg, std ~ (nf)'''
+    m, x = s['n'], s['x'][t]
+    z  = (x - m*avg) / std
+    zz = (s['xx'][t] - np.outer(avg, x) - np.outer(x, avg) + m*np.outer(avg, avg)) / np.outer(std, std)
+    zy = (s['xy'][t] - np.outer(avg, s['y'])) / std[:,np.newaxis]
+    return m, z, zz, zy
+
+
+########################################################################
+###              FIT                                                 ###
+########################################################################
+
+def fit_from_stats(stats, l2=0., epsilon=1e-6, output_val_scores=True):
+    '''
+    Closed form ridge regression (with an unpenalized bias) of every voxel on the z-scored features of every candidate,
+    with one or several ridge penalties l2 (a scalar or a list, solved with one eigendecomposition per candidate).
+
+    Returns, in the format of fwrf.learn_params:
+     val_scores: the holdout mean squared error (nv, nt) of the best penalty of every candidate (or [])
+     best_scores: the holdout mean squared error of the best candidate (nv)
+     best_l2: the index in l2 of the best penalty of every voxel (nv) (in place of best_epochs)
+     best_candidates: the best candidate of every voxel (nv)
+     best_w_params: [W (nv, nf), b (nv)]
+    '''
+    l2s = np.atleast_1d(np.asarray(l2, dtype=np.float64))
+    f, h = stats['fit'], stats['holdout']
+    nt, nf, nv = f['xy'].shape
+    assert h['n']>0, "the holdout set is empty"
+    avg, std = _avg_std(stats, epsilon=epsilon)
+
+    val_scores = np.zeros(shape=(nv, nt), dtype=fpX) if output_val_scores else []
+    best_scores = np.full(shape=(nv), fill_value=np.inf, dtype=fpX)
+    best_l2 = np.zeros(shape=(nv), dtype=int)
+    best_candidates = np.zeros(shape=(nv), dtype=int)
+    best_w_params = [np.zeros(shape=(nv, nf), dtype=fpX), np.zeros(shape=(nv), dtype=fpX)]
+    print "\nClosed form fit of %d voxels x %d candidates x %d penalties..." % (nv, nt, len(l2s))
+    sys.stdout.flush()
+    start_time = time.time()
+    for t in tqdm(range(nt)):
+        m, fz, fzz, fzy = _zscored(f, t, avg[t], std[t])
+        hm, hz, hzz, hzy = _zscored(h, t, avg[t], std[t])
+        ## centering on the fit samples
+        zbar, ybar = fz / m, f['y'] / m
+        e, Q = np.linalg.eigh(fzz - m*np.outer(zbar, zbar))
+        Qzy = Q.T.dot(fzy - m*np.outer(zbar, ybar))  # (nf, nv)
+        t_scores = np.full(shape=(nv), fill_value=np.inf)
+        for l, lam in enumerate(l2s):
+            W = Q.dot(Qzy / np.maximum(e + lam, 1e-12)[:,np.newaxis])  # (nf, nv)
+            b = ybar - zbar.dot(W)
+            ## holdout mean squared error from the holdout statistics
+            sse = h['yy'] - 2*np.sum(W*hzy, axis=0) - 2*b*h['y'] + np.sum(W*hzz.dot(W), axis=0) + 2*b*hz.dot(W) + hm*np.square(b)
+            scores = sse / hm
+            better_l2 = scores < t_scores
+            t_scores = np.where(better_l2, scores, t_scores)
+            improved = scores < best_scores
+            best_scores[improved] = scores[improved]
+            best_l2[improved] = l
+            best_candidates[improved] = t
+            best_w_params[0][improved] = W[:, improved].T
+            best_w_params[1][improved] = b[improved]
+        if output_val_scores:
+            val_scores[:, t] = t_scores
+    full_time = time.time() - start_time
+    print "%d voxelmodel fits took %.3fs @ %.3f voxelmodels/s" % (nv*nt*len(l2s), full_time, fpX(nv*nt*len(l2s))/full_time)
+    return val_scores, best_scores, best_l2, best_candidates, best_w_params
+
+
+def raw_w_params(stats, candidates, w_params, epsilon=1e-6):
+    '''
+    maps the weights [W (nv, nf), b (nv)] of fit_from_stats, which apply to the features z-scored with stats_zscore,
+    to weights on the raw pooled features of the candidates (nv) of every voxel.
+    '''
+    avg, std = _avg_std(stats, epsilon=epsilon)
+    W = w_params[0] / std[candidates]
+    return [W.astype(fpX), (w_params[1] - np.sum(W * avg[candidates], axis=1)).astype(fpX)]
+
+
+def fit_model_space_tensor(mst_data, voxels, rows=None, val_test_size=100, l2=0., batches=(100,), epsilon=1e-6, **kwargs):
+    '''
+    The closed form counterpart of fwrf.learn_params on a model space tensor (n, nf, 1, nt), which can be a memmap:
+    the (shuffled) rows are split into fit and holdout samples as in learn_params, their statistics are accumulated
+    batches[0] rows at a time, and fit_from_stats fits every candidate. Other learn_params arguments are ignored.
+    Returns the outputs of learn_params, with the index of the best l2 in place of best_epochs and the weights on the
+    columns of mst_data.
+    '''
+    rows = np.arange(len(mst_data), dtype=int) if rows is None else np.asarray(rows, dtype=int)
+    order = np.arange(len(rows), dtype=int)
+    np.random.shuffle(order)
+    order = rows[order]
+    nt, nf, nv = mst_data.shape[3], mst_data.shape[1], voxels.shape[1]
+    stats = {'fit': empty_stats(nf, nv, nt), 'holdout': empty_stats(nf, nv, nt)}
+    trn_size = len(order) - val_test_size
+    for part, part_rows in [('fit', order[:trn_size]), ('holdout', order[trn_size:])]:
+        for i in range(0, len(part_rows), batches[0]):
+            r = np.sort(part_rows[i:i+batches[0]]) # sorted reads of the memmap
+            update_stats(stats[part], np.asarray(mst_data[r])[:,:,0,:], np.asarray(voxels[r]))
+    val_scores, best_scores, best_l2, best_candidates, best_w_params = fit_from_stats(stats, l2=l2, epsilon=epsilon)
+    return val_scores[np.newaxis], best_scores, best_l2, best_candidates, raw_w_params(stats, best_candidates, best_w_params, epsilon=epsilon)
+
+
+def get_streamed_prediction(fmap_batches, voxels, sharedModel_specs, candidates, w_params, mst_avg, mst_std, pool=None, nonlinearity=None,
+                            view_angle=20.):
+    '''
+    Predictions (n, nv) and correlations (nv) of the voxels (n, nv) on streamed feature map batches, from their best
+    candidates, weights and the z-scoring statistics (1, nf, 1, nt) of stats_zscore, without the model space tensor.
+    '''
+    n, nv = voxels.shape
+    predictions = np.zeros(shape=(n, nv), dtype=fpX)
+    avg, std = mst_avg[0,:,0,candidates].T, mst_std[0,:,0,candidates].T  # (nf, nv)
+    i = 0
+    for fmaps in fmap_batches:
+        if pool is None:
+            pool = ppl.make_pooling_function([fm.shape for fm in fmaps], sharedModel_specs, view_angle=view_angle)
+        rows, = ppl.iterate_model_space_rows([fmaps], pool, nonlinearity=nonlinearity)
+        z = np.nan_to_num((rows[:,:,0,candidates] - avg) / std)  # (bn, nf, nv)
+        predictions[i:i+len(z)] = np.einsum('nfv,vf->nv', z, w_params[0]) + w_params[1]
+        i += len(z)
+    return predictions, psu.column_corr(predictions, voxels)
@@ -0,0 +1,162 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gaborizer.src import feature_cache
+try:
+    from gaborizer.src import gabor_feature_dictionaries as gfd
+except ImportError: # theano, skimage
+    gfd = None
+
+
+class counting_create(object):
+    '''a create_fn that counts its calls and returns a feature map dictionary.'''
+    def __init__(self, size=8):
+        self.size, self.calls = size, 0
+
+    def __call__(self, scale=1.):
+        self.calls += 1
+        return {0: scale*np.ones(shape=(2, 3, self.size, self.size), dtype=np.float32),
+                1: scale*np.arange(2*3*4*4, dtype=np.float32).reshape((2, 3, 4, 4))}
+
+
+def gabor_key(gbr_table, filter_stack, image_stack, interp_order=3, complex_cell=True, modes=[(8, 'direct')]):
+    '''the key of gabor_feature_maps.create_feature_maps.'''
+    return feature_cache.content_key('gabor', gbr_table, filter_stack, image_stack, interp_order, complex_cell, modes)
+
+
+class content_key_test(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.gbr_table = pd.DataFrame({'cycles per deg.': [1., 1., 2.], 'orientation': [0., np.pi/2, 0.],
+                                       'pix per stimulus': [8., 8., 16.]})
+        self.filter_stack = rng.normal(size=(3, 1, 5, 5)).astype(np.complex64)
+        self.image_stack = rng.normal(size=(4, 1, 16, 16)).astype(np.float32)
+        self.key = gabor_key(self.gbr_table, self.filter_stack, self.image_stack)
+
+    def test_deterministic(self):
+        self.assertEqual(gabor_key(self.gbr_table.copy(), self.filter_stack.copy(), self.image_stack.copy()), self.key)
+        self.assertEqual(feature_cache.content_key({'b': 1, 'a': [2, 3]}), feature_cache.content_key({'a': [2, 3], 'b': 1}))
+
+    def test_sensitivity(self):
+        gbr_table = self.gbr_table.copy()
+        gbr_table.loc[2, 'pix per stimulus'] = 17.
+        filter_stack = self.filter_stack.copy()
+        filter_stack[0,0,2,2] += 1e-3
+        keys = [gabor_key(gbr_table, self.filter_stack, self.image_stack),
+                gabor_key(self.gbr_table.rename(columns={'orientation': 'angle'}), self.filter_stack, self.image_stack),
+                gabor_key(self.gbr_table, filter_stack, self.image_stack),
+                gabor_key(self.gbr_table, self.filter_stack.astype(np.complex128), self.image_stack),
+                gabor_key(self.gbr_table, self.filter_stack, self.image_stack[:3]),
+                gabor_key(self.gbr_table, self.filter_stack, self.image_stack, interp_order=1),
+                gabor_key(self.gbr_table, self.filter_stack, self.image_stack, complex_cell=False),
+                gabor_key(self.gbr_table, self.filter_stack, self.image_stack, modes=[(8, 'fft')]),
+                gabor_key(self.gbr_table, self.filter_stack, self.image_stack, modes=[(8, 'direct'), (16, 'fft')])]
+        self.assertEqual(len(set(keys + [self.key])), len(keys)+1)
+
+    def test_structure(self):
+        self.assertNotEqual(feature_cache.content_key([1, 2]), feature_cache.content_key((1, 2)))
+        self.assertNotEqual(feature_cache.content_key([[1], 2]), feature_cache.content_key([1, [2]]))
+        self.assertNotEqual(feature_cache.content_key(np.zeros(4)), feature_cache.content_key(np.zeros((2, 2))))
+
+
+class feature_map_cache_test(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp, 'fmaps')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def entries(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_hit_and_miss(self):
+        cache = feature_cache.feature_map_cache(self.cache_dir)
+        self.assertTrue(cache.get('missing') is None)
+        create = counting_create()
+        first = cache.get_or_create('a', create, scale=2.)
+        second = cache.get_or_create('a', create, scale=2.)
+        self.assertEqual(create.calls, 1)
+        self.assertEqual(sorted(second.keys()), [0, 1])
+        for k in first.keys():
+            self.assertEqual(second[k].dtype, first[k].dtype)
+            np.testing.assert_array_equal(second[k], first[k])
+        cache.get_or_create('b', create)
+        self.assertEqual(create.calls, 2)
+        self.assertEqual(self.entries(), ['a.h5', 'b.h5'])
+        ## a new cache on the same directory sees the entries
+        self.assertTrue(feature_cache.feature_map_cache(self.cache_dir).get('b') is not None)
+
+    def test_put_is_atomic(self):
+        cache = feature_cache.feature_map_cache(self.cache_dir)
+        renames = []
+        rename = os.rename
+        def checked_rename(src, dst):
+            ## the entry is complete under its temporary name before it appears under its key
+            self.assertFalse(os.path.exists(dst))
+            self.assertTrue(src.startswith(dst) and src.endswith('.tmp'))
+            with h5py.File(src, 'r') as hf:
+                self.assertEqual(len(hf.keys()), 2)
+            renames.append((src, dst))
+            rename(src, dst)
+        os.rename = checked_rename
+        try:
+            cache.put('a', counting_create()())
+        finally:
+            os.rename = rename
+        self.assertEqual(len(renames), 1)
+        self.assertEqual(self.entries(), ['a.h5'])
+
+    def test_lru_eviction(self):
+        create = counting_create(size=64)
+        cache = feature_cache.feature_map_cache(self.cache_dir)
+        cache.put('a', create())
+        entry_size = os.path.getsize(cache.path('a'))
+        cache.max_bytes = int(2.5*entry_size)
+        now = time.time()
+        cache.put('b', create())
+        os.utime(cache.path('a'), (now-30, now-30))
+        os.utime(cache.path('b'), (now-20, now-20))
+        cache.get('a') # a is now the most recently used
+        cache.put('c', create())
+        self.assertEqual(self.entries(), ['a.h5', 'c.h5'])
+        ## the new entry is kept even when it does not fit on its own
+        cache.max_bytes = entry_size // 2
+        cache.put('d', create())
+        self.assertEqual(self.entries(), ['d.h5'])
+        cache.max_bytes = 0
+        cache.evict()
+        self.assertEqual(self.entries(), [])
+
+
+@unittest.skipIf(gfd is None, "the gaborizer needs theano and skimage")
+class gabor_feature_cache_test(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_create_feature_maps(self):
+        cache = feature_cache.feature_map_cache(self.tmp)
+        gfm = gfd.gabor_feature_maps(4, 20., (1., 6., 3), pix_per_cycle=3.)
+        image_stack = np.random.RandomState(0).uniform(size=(3, 1, 32, 32)).astype(np.float32)
+        created = gfm.create_feature_maps(image_stack, conv_mode='fft', cache=cache)
+        self.assertEqual(len(os.listdir(self.tmp)), 1)
+        cached = gfm.create_feature_maps(image_stack, conv_mode='fft', cache=cache)
+        for k in created.keys():
+            np.testing.assert_array_equal(cached[k], created[k])
+        gfm.create_feature_maps(image_stack, conv_mode='fft', interp_order=1, cache=cache)
+        self.assertEqual(len(os.listdir(self.tmp)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
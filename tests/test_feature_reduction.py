@@ -0,0 +1,119 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import fwrf
+import feature_reduction as pfr
+
+
+def make_mst(seed=0, n=80, nf=12, nt=5, rank=4):
+    '''a model space tensor (n, nf, 1, nt) whose features mostly live in a rank dimensional subspace.'''
+    rng = np.random.RandomState(seed)
+    mst = np.einsum('nrt,rf->nft', rng.normal(size=(n, rank, nt)), rng.normal(size=(rank, nf)))
+    mst += 0.01 * rng.normal(size=mst.shape)
+    return mst[:,:,np.newaxis,:].astype(np.float32), rng
+
+
+class projection_test(unittest.TestCase):
+    def test_w_params_map_back(self):
+        mst, rng = make_mst()
+        nv = 6
+        candidates = rng.randint(mst.shape[-1], size=nv)
+        for mode in ('global', 'candidate'):
+            projection = pfr.fit_projection(mst, 4, trn_size=60, mode=mode)
+            reduced = pfr.apply_projection(mst, projection)
+            W, b = rng.normal(size=(nv, 4)).astype(np.float32), rng.normal(size=nv).astype(np.float32)
+            expected = np.einsum('nkv,vk->nv', reduced[:,:,0,candidates], W) + b
+            W_full, b_full = pfr.project_w_params([W, b], projection, candidates=candidates)
+            self.assertEqual(W_full.shape, (nv, mst.shape[1]))
+            np.testing.assert_allclose(np.einsum('nfv,vf->nv', mst[:,:,0,candidates], W_full) + b_full, expected, rtol=1e-4, atol=1e-4)
+
+    def test_components_have_unit_variance(self):
+        mst, _ = make_mst(seed=1)
+        for mode in ('global', 'candidate'):
+            projection = pfr.fit_projection(mst, 4, mode=mode)
+            reduced = pfr.apply_projection(mst, projection).astype(np.float64)
+            var = np.mean(np.square(reduced), axis=0)[:,0,:]
+            if mode=='global':
+                np.testing.assert_allclose(var.mean(axis=1), np.ones(4), rtol=1e-3)
+            else:
+                np.testing.assert_allclose(var, np.ones((4, mst.shape[-1])), rtol=1e-3)
+            self.assertGreater(projection['explained'], 0.99)
+
+    def test_randomized_matches_exact(self):
+        rng = np.random.RandomState(2)
+        A = rng.normal(size=(200, 40)).dot(np.diag(np.logspace(1, -3, 40)))
+        s, V = pfr.top_right_singular(A, 5, method='pca')
+        s_r, V_r = pfr.top_right_singular(A, 5, method='randomized', oversample=10)
+        np.testing.assert_allclose(s_r, s, rtol=1e-6)
+        np.testing.assert_allclose(np.abs(np.sum(V * V_r, axis=0)), np.ones(5), rtol=1e-6)
+        e, U = pfr.top_eigh(A.T.dot(A), 5, method='pca')
+        e_r, U_r = pfr.top_eigh(A.T.dot(A), 5, method='randomized', oversample=10)
+        np.testing.assert_allclose(e_r, e, rtol=1e-6)
+        np.testing.assert_allclose(e, np.square(s), rtol=1e-8)
+
+
+def aligned(reduced, reference):
+    '''reduced (n, k, 1, nt) with the sign of every component matched to reference (the basis is defined up to sign).'''
+    return reduced * np.sign(np.sum(reduced.astype(np.float64) * reference, axis=0))[np.newaxis]
+
+
+class model_space_reduction_test(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.specs = [[(0., 20.), (0., 20.), (0.5, 8.)], [fwrf.linspace(3), fwrf.linspace(3), fwrf.logspace(2)]]
+        ## correlated feature maps: 8 features mixed from 3 sources
+        sources = np.square(rng.normal(size=(60, 3, 16, 16)))
+        self.fmaps = [np.einsum('nsij,sf->nfij', sources, rng.uniform(size=(3, 8))).astype(np.float32),
+                      np.square(rng.normal(size=(60, 2, 8, 8))).astype(np.float32)]
+        self.kwargs = {'engine': 'separable', 'batches': (7, 18), 'trn_size': 40}
+
+    def test_streamed_reduction_matches_full_tensor(self):
+        for mode in ('global', 'candidate'):
+            for zscore in (True, False):
+                full, avg, std = fwrf.model_space_tensor(self.fmaps, self.specs, zscore=zscore, **self.kwargs)
+                expected = pfr.apply_projection(full, pfr.fit_projection(full, 4, trn_size=40, mode=mode))
+                projection = pfr.new_projection(4, mode=mode)
+                reduced, r_avg, r_std = fwrf.model_space_tensor(self.fmaps, self.specs, zscore=zscore, projection=projection, **self.kwargs)
+                self.assertEqual(reduced.shape, (60, 4, 1, 18))
+                self.assertTrue(pfr.fitted(projection))
+                if zscore:
+                    np.testing.assert_allclose(r_avg, avg, rtol=1e-4)
+                    np.testing.assert_allclose(r_std, std, rtol=1e-4)
+                else:
+                    self.assertIsNone(r_avg)
+                ## centered and scaled to unit variance on the training rows
+                np.testing.assert_allclose(reduced[:40].mean(axis=0), 0., atol=1e-3)
+                if mode=='candidate':
+                    np.testing.assert_allclose(reduced[:40].std(axis=0), 1., rtol=1e-3)
+                np.testing.assert_allclose(aligned(reduced, expected), expected, rtol=1e-3, atol=1e-3)
+
+    def test_w_params_round_trip(self):
+        full, avg, std = fwrf.model_space_tensor(self.fmaps, self.specs, zscore=True, **self.kwargs)
+        rng = np.random.RandomState(4)
+        candidates = rng.randint(18, size=5)
+        for mode in ('global', 'candidate'):
+            projection = pfr.new_projection(3, mode=mode)
+            reduced, _, _ = fwrf.model_space_tensor(self.fmaps, self.specs, zscore=True, projection=projection, **self.kwargs)
+            W, b = rng.normal(size=(5, 3)).astype(np.float32), rng.normal(size=5).astype(np.float32)
+            W_full, b_full = pfr.project_w_params([W, b], projection, candidates=candidates)
+            np.testing.assert_allclose(np.einsum('nfv,vf->nv', full[:,:,0,candidates], W_full) + b_full,
+                                       np.einsum('nkv,vk->nv', reduced[:,:,0,candidates], W) + b, rtol=1e-3, atol=1e-3)
+
+    def test_validation_set_with_fitted_projection(self):
+        projection = pfr.new_projection(4)
+        trn = [fm[:40] for fm in self.fmaps]
+        val = [fm[40:] for fm in self.fmaps]
+        kwargs = {'engine': 'separable', 'batches': (7, 18)}
+        _, avg, std = fwrf.model_space_tensor(trn, self.specs, zscore=True, projection=projection, **kwargs)
+        out = np.zeros(shape=(20, 4, 1, 18), dtype=np.float32)
+        val_reduced, _, _ = fwrf.model_space_tensor(val, self.specs, zscore=True, mst_avg=avg, mst_std=std, projection=projection, out=out, **kwargs)
+        self.assertIs(val_reduced, out)
+        val_full, _, _ = fwrf.model_space_tensor(val, self.specs, zscore=True, mst_avg=avg, mst_std=std, **kwargs)
+        np.testing.assert_allclose(val_reduced, pfr.apply_projection(val_full, projection), rtol=1e-3, atol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import unittest
+import numpy as np
+from scipy.signal import convolve2d, fftconvolve
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gaborizer.src import fft_convolution
+try:
+    from gaborizer.src import gabor_feature_dictionaries as gfd
+except ImportError: # theano, skimage
+    gfd = None
+
+
+def direct_feature_maps(stimuli, filter_stack, complex_cell=True):
+    '''the full convolution of every stimulus by every filter, summed over the colors, as the theano conv2d.'''
+    T, D, n_full = len(stimuli), len(filter_stack), stimuli.shape[2]+filter_stack.shape[2]-1
+    out = np.zeros(shape=(T, D, n_full, n_full))
+    for t in range(T):
+        for d in range(D):
+            conv = sum([convolve2d(stimuli[t,c], filter_stack[d,c], mode='full') for c in range(stimuli.shape[1])])
+            out[t,d] = np.abs(conv) if complex_cell else np.real(conv)
+    return out
+
+
+class fft_convolution_test(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.stimuli = rng.uniform(-1, 1, size=(5, 3, 12, 12)).astype(np.float32)
+        self.filters = (rng.normal(size=(4, 3, 5, 5)) + 1j*rng.normal(size=(4, 3, 5, 5))).astype(np.complex64)
+
+    def test_complex_cell(self):
+        fft = fft_convolution.make_fft_gabor_function(self.filters, 12, complex_cell=True, batch_size=2)(self.stimuli)
+        np.testing.assert_allclose(fft, direct_feature_maps(self.stimuli, self.filters), rtol=1e-4, atol=1e-4)
+
+    def test_simple_cell(self):
+        filters = np.real(self.filters)
+        fft = fft_convolution.make_fft_gabor_function(filters, 12, complex_cell=False)(self.stimuli)
+        np.testing.assert_allclose(fft, direct_feature_maps(self.stimuli, filters, complex_cell=False), rtol=1e-4, atol=1e-4)
+        ## scipy's fft convolution of the color stacks, with the filter colors reversed so that the middle plane sums the matching colors
+        expected = np.stack([fftconvolve(self.stimuli[t], filters[d,::-1], mode='full')[2] for t in range(5) for d in range(4)]).reshape((5, 4, 16, 16))
+        np.testing.assert_allclose(fft, expected, rtol=1e-4, atol=1e-4)
+
+    def test_byte_budget(self):
+        n_fft = fft_convolution.fft_size(16)
+        self.assertEqual(n_fft, 16)
+        self.assertEqual(fft_convolution.fft_size(17), 18)
+        self.assertEqual(fft_convolution.fft_batch_size(4, 3, n_fft, max_bytes=1), 1)
+        per_stimulus = 16*n_fft*(3*n_fft + 4*n_fft + 4*n_fft)
+        self.assertEqual(fft_convolution.fft_batch_size(4, 3, n_fft, max_bytes=10*per_stimulus), 10)
+        ## a budget of about two stimuli gives the same feature maps
+        small = fft_convolution.make_fft_gabor_function(self.filters, 12, max_bytes=2*per_stimulus)(self.stimuli)
+        large = fft_convolution.make_fft_gabor_function(self.filters, 12)(self.stimuli)
+        np.testing.assert_allclose(small, large, rtol=1e-6)
+
+
+class convolution_mode_test(unittest.TestCase):
+    def test_threads_only_override_auto(self):
+        self.assertEqual(fft_convolution.threaded_convolution_mode('auto', 1), 'auto')
+        self.assertEqual(fft_convolution.threaded_convolution_mode('direct', 1), 'direct')
+        self.assertEqual(fft_convolution.threaded_convolution_mode('auto', 4), 'fft')
+        self.assertEqual(fft_convolution.threaded_convolution_mode('fft', 4), 'fft')
+        self.assertRaises(AssertionError, fft_convolution.threaded_convolution_mode, 'direct', 4)
+
+    def test_select_convolution_mode(self):
+        self.assertEqual(fft_convolution.select_convolution_mode(64, 3), 'direct')
+        self.assertEqual(fft_convolution.select_convolution_mode(64, 41), 'fft')
+
+    @unittest.skipIf(gfd is None, "the gaborizer needs theano and skimage")
+    def test_resolved_convolution_modes(self):
+        gbr_table = gfd.make_gabor_table(4, 20., (1., 6., 4), pix_per_cycle=3.)[0]
+        filter_stack = np.zeros((len(gbr_table), 1, 13, 13), dtype=np.complex64)
+        modes = gfd.resolved_convolution_modes(filter_stack, gbr_table, conv_mode='auto', n_workers=2)
+        self.assertEqual(set([m for _,m in modes]), set(['fft']))
+        self.assertEqual(set([m for _,m in gfd.resolved_convolution_modes(filter_stack, gbr_table, conv_mode='direct')]), set(['direct']))
+        self.assertRaises(AssertionError, gfd.resolved_convolution_modes, filter_stack, gbr_table, conv_mode='direct', n_workers=2)
+
+
+@unittest.skipIf(gfd is None, "the gaborizer needs theano and skimage")
+class theano_convolution_test(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.stimuli = rng.uniform(-1, 1, size=(3, 2, 12, 12)).astype(np.float32)
+        self.filters = (rng.normal(size=(4, 2, 5, 5)) + 1j*rng.normal(size=(4, 2, 5, 5))).astype(np.complex64)
+
+    def test_theano_direct(self):
+        apply_filter = gfd.make_apply_gabor_function((None,)+self.filters.shape[1:], complex_cell=True)
+        direct = apply_filter(self.stimuli, np.real(self.filters).astype('float32'), np.imag(self.filters).astype('float32'))
+        fft = gfd.make_fft_gabor_function(self.filters, 12, complex_cell=True)(self.stimuli)
+        np.testing.assert_allclose(fft, direct, rtol=1e-4, atol=1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
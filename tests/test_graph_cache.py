@@ -0,0 +1,93 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import graph_cache as pgc
+
+
+class counting_build(object):
+    '''a build function that counts its calls.'''
+    def __init__(self, value):
+        self.value, self.calls = value, 0
+
+    def __call__(self):
+        self.calls += 1
+        return {'value': self.value}
+
+
+class graph_cache_test(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.saved_dir = pgc.cache_dir
+        pgc.disable()
+        pgc.clear()
+
+    def tearDown(self):
+        pgc.clear()
+        pgc.cache_dir = self.saved_dir
+        shutil.rmtree(self.tmp)
+
+    def test_memory_hit(self):
+        build = counting_build(1)
+        first = pgc.cached('test_graph', (10, 3), build)
+        self.assertIs(pgc.cached('test_graph', (10, 3), build), first)
+        self.assertEqual(build.calls, 1)
+        pgc.cached('test_graph', (20, 3), build)
+        self.assertEqual(build.calls, 2)
+        self.assertNotEqual(pgc.key('test_graph', (10, 3)), pgc.key('test_graph', (20, 3)))
+        self.assertNotEqual(pgc.key('test_graph', (10, 3)), pgc.key('other_graph', (10, 3)))
+
+    def test_bypassed(self):
+        build = counting_build(1)
+        pgc.cached('test_graph', (10,), build)
+        with pgc.bypassed():
+            pgc.cached('test_graph', (10,), build)
+            with pgc.bypassed():
+                pgc.cached('test_graph', (11,), build)
+            pgc.cached('test_graph', (11,), build)
+        self.assertEqual(build.calls, 4)
+        ## nothing was cached within the block
+        pgc.cached('test_graph', (11,), build)
+        self.assertEqual(build.calls, 5)
+
+    def test_disk_store_and_load(self):
+        pgc.enable(os.path.join(self.tmp, 'graphs'))
+        build = counting_build(np.arange(5))
+        pgc.cached('test_graph', (10,), build)
+        self.assertEqual(os.listdir(pgc.cache_dir), [pgc.key('test_graph', (10,)) + '.pkl'])
+        pgc.clear() # a fresh process
+        graph = pgc.cached('test_graph', (10,), build)
+        self.assertEqual(build.calls, 1)
+        np.testing.assert_array_equal(graph['value'], np.arange(5))
+        pgc.clear(disk=True)
+        self.assertEqual(os.listdir(pgc.cache_dir), [])
+
+    def test_corrupted_entry_is_rebuilt(self):
+        pgc.enable(self.tmp)
+        with open(os.path.join(self.tmp, pgc.key('test_graph', (10,)) + '.pkl'), 'wb') as f:
+            f.write('not a pickle')
+        build = counting_build(2)
+        self.assertEqual(pgc.cached('test_graph', (10,), build)['value'], 2)
+        self.assertEqual(build.calls, 1)
+
+    def test_compiled_function_roundtrip(self):
+        import theano
+        import theano.tensor as T
+        def build():
+            w = theano.shared(np.zeros(3, dtype=theano.config.floatX))
+            x = T.vector()
+            return {'step': theano.function([x], w.sum(), updates=[(w, w + x)]), 'w': w}
+        pgc.enable(self.tmp)
+        pgc.cached('test_step', (3,), build)
+        pgc.clear()
+        graph = pgc.cached('test_step', (3,), build)
+        graph['step'](np.ones(3, dtype=theano.config.floatX))
+        np.testing.assert_allclose(graph['w'].get_value(), np.ones(3))
+
+
+if __name__ == '__main__':
+    unittest.main()
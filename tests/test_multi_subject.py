@@ -0,0 +1,157 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import fwrf
+
+
+class recording_learn_params(object):
+    '''
+    a stand-in for fwrf.learn_params that records its calls. The best score of every voxel is the mean of its rows,
+    its best candidate its column, and its weights the initial ones plus one.
+    '''
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, mst_data, voxels, w_params, rows=None, **kwargs):
+        self.calls += [(voxels, rows),]
+        rows = np.arange(len(mst_data)) if rows is None else rows
+        nv, nt = voxels.shape[1], mst_data.shape[3]
+        val_scores = np.tile(voxels[rows].mean(axis=0)[np.newaxis,:,np.newaxis], (2, 1, nt))
+        return (val_scores, voxels[rows].mean(axis=0), np.zeros(nv, dtype=int), np.arange(nv), [p + 1 for p in w_params])
+
+
+class recording_kout_learn_params(recording_learn_params):
+    '''a stand-in for fwrf.kout_learn_params, with two parts over the rows.'''
+    def __call__(self, mst_data, voxels, val_sample_order, w_params, rows=None, **kwargs):
+        val_scores, scores, epochs, candidates, params = recording_learn_params.__call__(self, mst_data, voxels, w_params, rows=rows)
+        rows = np.arange(len(mst_data)) if rows is None else rows
+        n = len(rows)
+        model = {'n_parts': 2, 'val_pred': voxels[rows] + 1, 'val_cc': scores.copy()}
+        for k in range(2):
+            val_mask = np.zeros(n, dtype=bool)
+            val_mask[val_sample_order[k*n//2:(k+1)*n//2]] = True
+            model[k] = {'val_scores': val_scores[:,:1], 'scores': scores, 'epochs': epochs, 'candidates': candidates,
+                        'w_params': params, 'val_mask': val_mask, 'val_cc': scores + k}
+        return model
+
+
+def make_subjects(seed=0, n=12, nf=3, nt=5):
+    '''subjects a and c see all the rows, b and d the same subset, e another one.'''
+    rng = np.random.RandomState(seed)
+    mst_data = rng.normal(size=(n, nf, 1, nt)).astype(np.float32)
+    samples = {'b': np.array([1, 3, 5, 7]), 'd': [1, 3, 5, 7], 'e': np.array([0, 2, 4, 6, 8, 10])}
+    nvs = {'a': 2, 'b': 3, 'c': 1, 'd': 4, 'e': 2}
+    voxels = dict([(s, rng.normal(size=(n if s not in samples else len(samples[s]), nv)).astype(np.float32)) for s,nv in nvs.items()])
+    return mst_data, voxels, samples
+
+
+class group_subjects_test(unittest.TestCase):
+    def test_grouping(self):
+        _, voxels, samples = make_subjects()
+        groups = fwrf.group_subjects(voxels, samples)
+        self.assertEqual([subjects for _,subjects in groups], [['a', 'c'], ['b', 'd'], ['e']])
+        self.assertTrue(groups[0][0] is None)
+        np.testing.assert_array_equal(groups[1][0], samples['b'])
+        np.testing.assert_array_equal(groups[2][0], samples['e'])
+        ## an explicit None is all the rows, and without samples every subject is in one group
+        self.assertEqual([subjects for _,subjects in fwrf.group_subjects(voxels, dict(samples, e=None))], [['a', 'c', 'e'], ['b', 'd']])
+        self.assertEqual(fwrf.group_subjects(voxels), [(None, ['a', 'b', 'c', 'd', 'e'])])
+
+    def test_group_voxels(self):
+        _, voxels, samples = make_subjects()
+        group = fwrf._group_voxels(['b', 'd'], voxels, samples['b'], 12)
+        self.assertEqual(group.shape, (12, 7))
+        np.testing.assert_array_equal(group[samples['b']], np.concatenate([voxels['b'], voxels['d']], axis=1))
+        np.testing.assert_array_equal(np.delete(group, samples['b'], axis=0), 0)
+        np.testing.assert_array_equal(fwrf._group_voxels(['a', 'c'], voxels, None, 12), np.concatenate([voxels['a'], voxels['c']], axis=1))
+
+    def test_mismatched_samples(self):
+        _, voxels, samples = make_subjects()
+        self.assertRaises(AssertionError, fwrf._group_voxels, ['b'], voxels, np.array([1, 3, 5]), 12)
+        self.assertRaises(AssertionError, fwrf._group_voxels, ['b'], voxels, np.array([1, 3, 3, 7]), 12)
+
+    def test_split_columns(self):
+        _, voxels, _ = make_subjects()
+        cols = fwrf._subject_columns(['a', 'b', 'c'], voxels)
+        self.assertEqual(cols, {'a': slice(0, 2), 'b': slice(2, 5), 'c': slice(5, 6)})
+        a = np.arange(4*6).reshape((4, 6))
+        for s in cols.keys():
+            np.testing.assert_array_equal(fwrf._split_columns(a, cols[s], 6, 1), a[:,cols[s]])
+        ## the round trip of the concatenated columns
+        np.testing.assert_array_equal(np.concatenate([fwrf._split_columns(a, cols[s], 6, 1) for s in ['a', 'b', 'c']], axis=1), a)
+        ## only the axis that spans all the voxels is split, lists element-wise along their first axis
+        self.assertTrue(fwrf._split_columns(a, cols['b'], 6, 0) is a)
+        self.assertEqual(fwrf._split_columns([], cols['b'], 6, 1), [])
+        W, b = fwrf._split_columns([np.ones((6, 3)), np.arange(6)], cols['b'], 6, 0)
+        self.assertEqual(W.shape, (3, 3))
+        np.testing.assert_array_equal(b, [2, 3, 4])
+        self.assertEqual(fwrf._split_columns(2, cols['b'], 6, 0), 2)
+
+
+class multi_subject_fit_test(unittest.TestCase):
+    def setUp(self):
+        self.learn_params, self.kout_learn_params = fwrf.learn_params, fwrf.kout_learn_params
+        self.mst_data, self.voxels, self.samples = make_subjects(seed=1)
+
+    def tearDown(self):
+        fwrf.learn_params, fwrf.kout_learn_params = self.learn_params, self.kout_learn_params
+
+    def test_learn_params_multi(self):
+        fwrf.learn_params = recording_learn_params()
+        w_params = dict([(s, [np.full((v.shape[1], 3), i, dtype=np.float32), np.zeros(v.shape[1], dtype=np.float32)]) \
+                         for i,(s,v) in enumerate(sorted(self.voxels.items()))])
+        results = fwrf.learn_params_multi(self.mst_data, self.voxels, w_params=w_params, samples=self.samples, num_epochs=2)
+        ## one call per sample set, reading its rows of mst_data in place
+        self.assertEqual(len(fwrf.learn_params.calls), 3)
+        self.assertEqual([v.shape for v,_ in fwrf.learn_params.calls], [(12, 3), (12, 7), (12, 2)])
+        self.assertTrue(fwrf.learn_params.calls[0][1] is None)
+        np.testing.assert_array_equal(fwrf.learn_params.calls[1][1], self.samples['b'])
+        self.assertEqual(sorted(results.keys()), sorted(self.voxels.keys()))
+        for s,v in self.voxels.items():
+            val_scores, best_scores, best_epochs, best_candidates, best_w_params = results[s]
+            nv = v.shape[1]
+            self.assertEqual(val_scores.shape, (2, nv, 5))
+            np.testing.assert_allclose(best_scores, v.mean(axis=0), rtol=1e-6)
+            self.assertEqual(len(best_epochs), nv)
+            np.testing.assert_array_equal(best_w_params[0], w_params[s][0] + 1)
+            self.assertEqual(best_w_params[1].shape, (nv,))
+        ## the columns of the second subject of a group follow the ones of the first
+        np.testing.assert_array_equal(results['d'][3], 3 + np.arange(4))
+
+    def test_kout_learn_params_multi(self):
+        ## a group of 4 samples and 4 voxels (d), so that the val_mask of its parts spans as many samples as voxels
+        voxels = {'d': self.voxels['d'], 'e': self.voxels['e']}
+        samples = {'d': self.samples['d'], 'e': self.samples['e']}
+        order = {'d': np.array([3, 0, 2, 1]), 'e': np.arange(6)[::-1]}
+        fwrf.kout_learn_params = recording_kout_learn_params()
+        models = fwrf.kout_learn_params_multi(self.mst_data, voxels, order, samples=samples)
+        for s,v in voxels.items():
+            n, nv = v.shape
+            model = models[s]
+            self.assertEqual(model['n_parts'], 2)
+            np.testing.assert_array_equal(model['val_pred'], v + 1)
+            np.testing.assert_allclose(model['val_cc'], v.mean(axis=0), rtol=1e-6)
+            for k in range(2):
+                np.testing.assert_array_equal(np.where(model[k]['val_mask'])[0], np.sort(order[s][k*n//2:(k+1)*n//2]))
+                np.testing.assert_allclose(model[k]['val_cc'], v.mean(axis=0) + k, rtol=1e-6)
+                np.testing.assert_array_equal(model[k]['candidates'], np.arange(nv))
+                self.assertEqual(model[k]['w_params'][0].shape, (nv, 3))
+                ## the sampled val_scores of a test run do not span the voxels, and are kept whole
+                self.assertEqual(model[k]['val_scores'].shape, (2, 1, 5))
+
+    def test_mismatched_samples(self):
+        fwrf.learn_params = recording_learn_params()
+        self.assertRaises(AssertionError, fwrf.learn_params_multi, self.mst_data, self.voxels, samples=dict(self.samples, e=[0, 1]))
+
+    def test_kout_shared_order(self):
+        fwrf.kout_learn_params = recording_kout_learn_params()
+        order = {'b': np.arange(4), 'd': np.arange(4)[::-1], 'e': np.arange(6)}
+        voxels = dict([(s, self.voxels[s]) for s in order.keys()])
+        self.assertRaises(AssertionError, fwrf.kout_learn_params_multi, self.mst_data, voxels, order, samples=self.samples)
+
+
+if __name__ == '__main__':
+    unittest.main()
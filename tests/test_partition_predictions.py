@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import fwrf
+import scoring_utility as psu
+
+
+def masked_prediction(mst_data, mst_rel_models, w_params, features):
+    '''the prediction of every voxel with the weights of the features outside of features set to zero, as the notebooks.'''
+    mask = np.zeros(mst_data.shape[1], dtype=bool)
+    mask[features] = True
+    W, b = w_params
+    x = mst_data[:, :, 0, mst_rel_models].astype(np.float64)   # (n, nf, nv)
+    return np.einsum('nfv,vf->nv', x, W * mask) + b
+
+
+class partition_predictions_test(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        n, nf, nt, nv = 50, 7, 6, 5
+        self.mst_data = rng.normal(size=(n, nf, 1, nt)).astype(np.float32)
+        self.candidates = rng.randint(nt, size=nv)
+        self.w_params = [rng.normal(size=(nv, nf)).astype(np.float32), rng.normal(size=nv).astype(np.float32)]
+        self.voxels = masked_prediction(self.mst_data, self.candidates, self.w_params, np.arange(nf)) + rng.normal(size=(n, nv))
+        ## an index list, a slice and an index array, which partition the features
+        self.partitions = [[0, 3], slice(4, 7), np.array([1, 2])]
+
+    def test_matches_masked_w_params(self):
+        for batch_size in (None, 2):
+            results = fwrf.get_partition_predictions(self.mst_data, self.voxels, self.candidates, self.w_params, self.partitions,
+                                                     leave_one_out=True, batch_size=batch_size)
+            full = masked_prediction(self.mst_data, self.candidates, self.w_params, np.arange(7))
+            np.testing.assert_allclose(results['pred'], full, rtol=1e-4, atol=1e-4)
+            np.testing.assert_allclose(results['cc'], psu.column_corr(full, self.voxels), atol=1e-5)
+            self.assertEqual(results['partition_pred'].shape, (3,) + self.voxels.shape)
+            for g,features in enumerate(self.partitions):
+                part = masked_prediction(self.mst_data, self.candidates, self.w_params, features)
+                np.testing.assert_allclose(results['partition_pred'][g], part, rtol=1e-4, atol=1e-4)
+                np.testing.assert_allclose(results['partition_cc'][g], psu.column_corr(part, self.voxels), atol=1e-5)
+                ## the complement of the group, with the bias counted once
+                others = np.setdiff1d(np.arange(7), np.arange(7)[features])
+                loo = masked_prediction(self.mst_data, self.candidates, self.w_params, others)
+                np.testing.assert_allclose(results['loo_pred'][g], loo, rtol=1e-4, atol=1e-4)
+                np.testing.assert_allclose(results['loo_cc'][g], psu.column_corr(loo, self.voxels), atol=1e-5)
+                np.testing.assert_allclose(results['loo_r'][g], psu.column_partition_corr(loo, full, self.voxels), atol=1e-5)
+            ## the shares of a partition add up to the full correlation
+            np.testing.assert_allclose(results['partition_r'].sum(axis=0), results['cc'], atol=1e-5)
+
+    def test_without_leave_one_out(self):
+        results = fwrf.get_partition_predictions(self.mst_data, self.voxels, self.candidates, self.w_params, self.partitions[:1])
+        self.assertFalse('loo_pred' in results)
+        self.assertEqual(results['partition_r'].shape, (1, self.voxels.shape[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import sys
+import copy
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import benchmark
+import pipeline as ppi
+import results_store as prs
+
+
+class pipeline_test(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        specs = benchmark.synthetic_model_specs((4, 4, 2))
+        data = benchmark.synthetic_fwrf_data(160, 6, 12, 10, specs, n_res=2, noise=0.3)
+        fmaps = []
+        for i,fm in enumerate(data['fmaps']):
+            fmaps += [os.path.join(self.tmp, 'fm%d.npy' % i),]
+            np.save(fmaps[-1], fm)
+        np.save(os.path.join(self.tmp, 'voxels.npy'), data['voxels'])
+        self.truth = data
+        self.config = {
+            'output': os.path.join(self.tmp, 'results.h5py'),
+            'data': {'voxels': os.path.join(self.tmp, 'voxels.npy'), 'trn_size': 130},
+            'features': {'kind': 'npy', 'fmaps': fmaps},
+            'model_space': {'grid': [4, 4, 2], 'batches': [80, 32], 'engine': 'separable'},
+            'train': {'method': 'closed_form', 'batches': [50, 10, 32], 'val_test_size': 30, 'l2': [1., 10.]},
+            'predict': {'partitions': 'resolution'}}
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_pipeline(self, config, **kwargs):
+        return ppi.pipeline(config, cache_dir=self.cache_dir, verbose=False).run(**kwargs)
+
+    def test_cache_hit(self):
+        self.assertEqual(self.run_pipeline(self.config), ['model_space', 'train', 'real_space', 'predict'])
+        mtime = os.path.getmtime(self.config['output'])
+        self.assertEqual(self.run_pipeline(self.config), [])
+        self.assertEqual(os.path.getmtime(self.config['output']), mtime)
+        p = ppi.pipeline(self.config, cache_dir=self.cache_dir, verbose=False)
+        self.assertTrue(all([cached is not False for _,_,cached in p.status()]))
+        with prs.load_results(self.config['output']) as results:
+            self.assertEqual(results['pipeline_keys']['train'], p.key('train'))
+            self.assertEqual(results['val_pred'].shape, (30, 10))
+            self.assertEqual(len(results['val_partition_pred']), 2)
+            ## the ground truth candidates are recovered
+            np.testing.assert_array_equal(results['best_candidates'][...], self.truth['candidates'])
+
+    def test_invalidation(self):
+        self.run_pipeline(self.config)
+        keys = dict([(name, key) for name,key,_ in ppi.pipeline(self.config, cache_dir=self.cache_dir).status()])
+        config = copy.deepcopy(self.config)
+        config['train']['l2'] = [0.1, 1.]
+        self.assertEqual(self.run_pipeline(config), ['train', 'real_space', 'predict'])
+        changed = dict([(name, key) for name,key,_ in ppi.pipeline(config, cache_dir=self.cache_dir).status()])
+        self.assertEqual(changed['model_space'], keys['model_space'])
+        self.assertNotEqual(changed['real_space'], keys['real_space'])
+        with prs.load_results(self.config['output']) as results:
+            self.assertEqual(results['pipeline_keys'].load(), changed)
+        ## the previous artifacts are still there, and the results file is brought back to the original config
+        self.assertEqual(self.run_pipeline(self.config), [])
+        with prs.load_results(self.config['output']) as results:
+            self.assertEqual(results['pipeline_keys'].load(), keys)
+        config['predict']['leave_one_out'] = True
+        self.assertEqual(self.run_pipeline(config), ['predict'])
+
+    def test_force_propagates(self):
+        config = self.config
+        self.run_pipeline(config)
+        mtime = os.path.getmtime(config['output'])
+        self.assertEqual(self.run_pipeline(config, targets=['train'], force=['train']), ['train'])
+        ## real_space and predict are out of date, the results file is left as is
+        self.assertEqual(os.path.getmtime(config['output']), mtime)
+        p = ppi.pipeline(config, cache_dir=self.cache_dir, verbose=False)
+        self.assertEqual(p.dependents(['train']), set(['train', 'real_space', 'predict']))
+        self.assertFalse(p.cached('real_space') or p.cached('predict'))
+        self.assertTrue(p.cached('model_space'))
+        os.utime(config['output'], (mtime - 10, mtime - 10))
+        self.assertEqual(self.run_pipeline(config), ['real_space', 'predict'])
+        self.assertGreater(os.path.getmtime(config['output']), mtime - 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import fwrf
+import pooling as ppl
+import numpy_utility as pnu
+
+
+def model_specs(nx, ny, ns, view_angle=20.):
+    return [[(0., view_angle), (0., view_angle), (0.5, 8.)], [fwrf.linspace(nx), fwrf.linspace(ny), fwrf.logspace(ns)]]
+
+def random_fmaps(n, sizes, seed=0):
+    rng = np.random.RandomState(seed)
+    return [np.square(rng.normal(size=(n, nf, n_pix, n_pix))).astype(np.float32) for nf,n_pix in sizes]
+
+def reference_pooling(fmaps, specs, view_angle=20.):
+    '''every candidate's gaussian mass field, built one at a time, dotted with the feature maps (n, nf, nt).'''
+    _, (mx, my, ms) = ppl.candidate_grid(specs)
+    out = []
+    for fm in fmaps:
+        G = np.stack([pnu.make_gaussian_mass(x, y, s, fm.shape[2], size=view_angle)[2] for x,y,s in zip(mx, my, ms)])
+        out += [np.einsum('nfij,tij->nft', fm.astype(np.float64), G)]
+    return np.concatenate(out, axis=1)
+
+
+class pooling_engine_test(unittest.TestCase):
+    def test_separable_matches_dense(self):
+        specs = model_specs(5, 4, 3)
+        fmaps = random_fmaps(6, [(3, 20), (2, 7)])
+        sizes = [fm.shape for fm in fmaps]
+        dense = ppl.make_pooling_function(sizes, specs, engine='dense')(fmaps)
+        separable = ppl.make_pooling_function(sizes, specs, engine='separable')(fmaps)
+        self.assertEqual(separable.shape, (6, 5, 60))
+        np.testing.assert_allclose(separable, dense, rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(dense, reference_pooling(fmaps, specs), rtol=1e-4, atol=1e-6)
+
+    def test_pyramid_within_tolerance(self):
+        specs = model_specs(4, 4, 4)
+        fmaps = random_fmaps(4, [(2, 64), (2, 16)])
+        sizes = [fm.shape for fm in fmaps]
+        levels = ppl.pyramid_pooling_levels(sizes, specs, tolerance=5e-2)
+        self.assertTrue(np.all(np.diff(levels[0])>=0))
+        self.assertGreater(levels[0][-1], 0)
+        dense = ppl.make_pooling_function(sizes, specs, engine='dense')
+        pyramid = ppl.make_pooling_function(sizes, specs, engine='pyramid', tolerance=5e-2)(fmaps)
+        ## the bound is relative to the mass of the fields, for feature maps in [0, max]
+        mass = dense([np.ones_like(fm[:1]) for fm in fmaps])
+        bound = 5e-2 * mass * np.concatenate([np.full((1, fm.shape[1], 1), fm.max()) for fm in fmaps], axis=1)
+        self.assertTrue(np.all(np.abs(pyramid - dense(fmaps)) <= bound + 1e-5))
+
+
+class fused_model_space_tensor_test(unittest.TestCase):
+    def test_streamed_batches(self):
+        specs = model_specs(4, 3, 2)
+        fmaps = random_fmaps(30, [(3, 16), (2, 8)])
+        batches = [[fm[b:b+7] for fm in fmaps] for b in range(0, 30, 7)]
+        mst_data, mst_avg, mst_std = ppl.fused_model_space_tensor(batches, 30, specs, zscore=True, trn_size=20)
+        P = reference_pooling(fmaps, specs)[:,:,np.newaxis,:]
+        avg, std = P[:20].mean(axis=0), P[:20].std(axis=0) + 1e-6
+        self.assertEqual(mst_data.shape, (30, 5, 1, 24))
+        np.testing.assert_allclose(mst_avg[0], avg, rtol=1e-4)
+        np.testing.assert_allclose(mst_data, (P - avg) / std, rtol=1e-3, atol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
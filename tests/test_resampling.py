@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from gaborizer.src import resampling
+
+
+class resampling_test(unittest.TestCase):
+    def test_constant_image(self):
+        for order in (0, 1, 3):
+            for n_in, n_out in [(37, 10), (10, 37), (64, 32)]:
+                R = resampling.resampling_matrix(n_in, n_out, interp_order=order, dtype=np.float64)
+                np.testing.assert_allclose(R.dot(np.ones(n_in)), np.ones(n_out), rtol=1e-12)
+
+    def test_box_downsampling_is_block_mean(self):
+        x = np.random.RandomState(0).normal(size=(2, 3, 16, 16))
+        out = resampling.resample_stack(x, 8, interp_order=0, dtype=np.float64)
+        np.testing.assert_allclose(out, x.reshape((2, 3, 8, 2, 8, 2)).mean(axis=(3, 5)), rtol=1e-10)
+
+    def test_linear_upsampling_keeps_ramps(self):
+        R = resampling.resampling_matrix(8, 16, interp_order=1, dtype=np.float64)
+        ramp = np.arange(8, dtype=np.float64)
+        ## away from the borders, the pixel centers of the output are on the input ramp
+        np.testing.assert_allclose(R.dot(ramp)[1:-1], ((np.arange(16) + 0.5) / 2. - 0.5)[1:-1], atol=1e-12)
+
+    def test_pyramid_levels(self):
+        x = np.random.RandomState(1).uniform(size=(2, 1, 64, 64)).astype(np.float32)
+        pyramid = resampling.make_image_pyramid(x, [64, 32, 16, 5], interp_order=3)
+        self.assertEqual(sorted(pyramid.keys()), [5, 16, 32, 64])
+        for n_pix, level in pyramid.items():
+            self.assertEqual(level.shape, (2, 1, n_pix, n_pix))
+            np.testing.assert_allclose(level.mean(), x.mean(), atol=2e-2)
+        ## resampled from the 32 pixel level, which is the box average of the original for halving
+        box = resampling.make_image_pyramid(x, [32, 16], interp_order=0)
+        np.testing.assert_allclose(box[16], x.reshape((2, 1, 16, 4, 16, 4)).mean(axis=(3, 5)), rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import results_store as prs
+
+
+class results_store_test(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'results.h5py')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_roundtrip(self):
+        rng = np.random.RandomState(0)
+        data = {'val_scores': rng.normal(size=(3, 50, 20)).astype(np.float32),
+                'w_params': [rng.normal(size=(50, 8)), rng.normal(size=(50,))],
+                'kout': {0: {'best_rf': np.arange(50)}, 1: {'best_rf': np.arange(50)[::-1].copy()}},
+                'l2': 1e-3,
+                'options': {'lx': 'gaussian', 'sizes': (2, 3)}}
+        prs.save_results(self.filename, data)
+        with prs.load_results(self.filename) as view:
+            self.assertIsNotNone(view['val_scores'].chunks)
+            np.testing.assert_array_equal(view['val_scores'][-1, 3, :], data['val_scores'][-1, 3, :])
+            out = view.load()
+        np.testing.assert_array_equal(out['val_scores'], data['val_scores'])
+        self.assertIsInstance(out['w_params'], list)
+        for a,b in zip(out['w_params'], data['w_params']):
+            np.testing.assert_array_equal(a, b)
+        self.assertEqual(sorted(out['kout'].keys()), [0, 1])
+        np.testing.assert_array_equal(out['kout'][1]['best_rf'], data['kout'][1]['best_rf'])
+        self.assertEqual(out['l2'], 1e-3)
+        self.assertEqual(out['options'], data['options'])
+
+    def test_parallel_external_write(self):
+        x = np.random.RandomState(1).normal(size=(200, 100))
+        prs.save_results(self.filename, {'predictions': x, 'small': np.ones(3)}, n_workers=2, parallel_min_bytes=1024)
+        self.assertTrue(os.path.exists(os.path.join(self.filename + '.d', 'predictions.h5')))
+        with prs.load_results(self.filename) as view:
+            np.testing.assert_array_equal(view['predictions'][...], x)
+            np.testing.assert_array_equal(view['small'][...], np.ones(3))
+
+    def test_chunk_shape_keeps_axes(self):
+        chunks = prs.chunk_shape((4000, 500), 4, keep_axes=(0,), target_bytes=1024**2)
+        self.assertEqual(chunks[0], 4000)
+        self.assertLessEqual(np.prod(chunks)*4, 1024**2)
+
+
+if __name__ == '__main__':
+    unittest.main()
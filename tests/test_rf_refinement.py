@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import numpy_utility as pnu
+import rf_refinement as prf
+
+
+def make_problem(seed=0, n=120, nv=4, nf_r=3, n_pix=16):
+    rng = np.random.RandomState(seed)
+    fmaps = [rng.normal(size=(n, nf_r, n_pix, n_pix)).astype(np.float32),
+             rng.normal(size=(n, nf_r, n_pix//2, n_pix//2)).astype(np.float32)]
+    rf_params = np.stack([rng.uniform(-4, 4, nv), rng.uniform(-4, 4, nv), rng.uniform(1.5, 4, nv)], axis=1)
+    return rng, fmaps, rf_params
+
+
+class rf_loss_test(unittest.TestCase):
+    def test_mass_matches_numpy_utility(self):
+        G, _ = prf.gaussian_mass_and_grad([1.], [-2.], [3.], 20, size=20., grad=False)
+        _,_,expected = pnu.make_gaussian_mass(1., -2., 3., 20, size=20.)
+        np.testing.assert_allclose(G[0], expected, atol=1e-6)
+
+    def test_gradient_matches_finite_differences(self):
+        rng, fmaps, rf_params = make_problem()
+        voxels = rng.normal(size=(120, len(rf_params)))
+        for l2 in (0., 10.):
+            out = prf.rf_loss(fmaps, voxels, rf_params, 100, l2=l2, grad=True)
+            h = 1e-2
+            numeric = np.zeros_like(out['grad'])
+            for k in range(3):
+                d = np.zeros(3)
+                d[k] = h
+                up = prf.rf_loss(fmaps, voxels, rf_params + d, 100, l2=l2, grad=False)['fit_loss']
+                down = prf.rf_loss(fmaps, voxels, rf_params - d, 100, l2=l2, grad=False)['fit_loss']
+                numeric[:,k] = (up - down) / (2*h)
+            np.testing.assert_allclose(out['grad'], numeric, rtol=2e-2, atol=1e-3*np.abs(numeric).max())
+
+    def test_refinement_lowers_the_fit_loss(self):
+        rng, fmaps, rf_params = make_problem(seed=1, n=200, nv=3)
+        true_rf = rf_params.copy()
+        P, _ = prf.pool_with_grad(fmaps, true_rf, grad=False)
+        voxels = P.sum(axis=1) + 0.1 * rng.normal(size=(200, len(true_rf)))
+        start = true_rf + np.array([1., -1., 0.5])
+        refined = prf.refine_rf_params(fmaps, voxels, start, val_test_size=50, num_iters=10)[0]
+        before = prf.rf_loss(fmaps, voxels, start, 150, grad=False)['fit_loss']
+        after = prf.rf_loss(fmaps, voxels, refined.astype(np.float64), 150, grad=False)['fit_loss']
+        self.assertTrue(np.all(after <= before))
+        self.assertLess(np.abs(refined - true_rf).mean(), np.abs(start - true_rf).mean())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import scoring_utility as psu
+
+
+class column_corr_test(unittest.TestCase):
+    def test_matches_corrcoef(self):
+        rng = np.random.RandomState(0)
+        X, Y = rng.normal(size=(50, 7)), rng.normal(size=(50, 7))
+        Y[:,:3] += X[:,:3]
+        expected = [np.corrcoef(X[:,v], Y[:,v])[0,1] for v in range(7)]
+        np.testing.assert_allclose(psu.column_corr(X, Y), expected, atol=1e-6)
+
+    def test_constant_column_scores_zero(self):
+        X = np.random.RandomState(1).normal(size=(20, 2))
+        Y = np.ones(shape=(20, 2))
+        np.testing.assert_array_equal(psu.column_corr(X, Y), [0., 0.])
+
+    def test_partition_corr_sums_to_corr(self):
+        rng = np.random.RandomState(2)
+        parts = rng.normal(size=(3, 40, 5))
+        target = parts.sum(axis=0) + rng.normal(size=(40, 5))
+        full = parts.sum(axis=0)
+        shares = [psu.column_partition_corr(p, full, target) for p in parts]
+        np.testing.assert_allclose(np.sum(shares, axis=0), psu.column_corr(full, target), atol=1e-5)
+
+
+class resampling_test(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.pred = rng.normal(size=(60, 9))
+        self.target = self.pred + rng.normal(size=(60, 9))
+
+    def test_permutation_null_batches(self):
+        a = psu.permutation_null(self.pred, self.target, n_perm=25, seed=4)
+        b = psu.permutation_null(self.pred, self.target, n_perm=25, seed=4, batches=(7, 4))
+        np.testing.assert_allclose(a, b, atol=1e-6)
+        self.assertEqual(a.shape, (25, 9))
+
+    def test_permutation_null_is_permuted_corr(self):
+        null = psu.permutation_null(self.pred, self.target, n_perm=3, seed=5, batches=(3, 9))
+        perms = np.argsort(np.random.RandomState(5).rand(3, 60), axis=1)
+        for p,perm in enumerate(perms):
+            np.testing.assert_allclose(null[p], psu.column_corr(self.pred[perm], self.target), atol=1e-6)
+
+    def test_pvalues(self):
+        observed = psu.column_corr(self.pred, self.target)
+        p = psu.permutation_pvalues(observed, psu.permutation_null(self.pred, self.target, n_perm=99, seed=6))
+        self.assertTrue(np.all(p > 0) and np.all(p <= 1))
+        self.assertTrue(np.all(p <= 0.01 + 1e-9)) # the correlations are far above chance
+
+    def test_bootstrap_budget(self):
+        a = psu.bootstrap_corr(self.pred, self.target, n_boot=20, seed=7)
+        b = psu.bootstrap_corr(self.pred, self.target, n_boot=20, seed=7, max_bytes=24*60*2)
+        np.testing.assert_allclose(a, b, atol=1e-6)
+        lo, hi = psu.bootstrap_interval(a)
+        self.assertTrue(np.all(lo <= hi))
+
+
+if __name__ == '__main__':
+    unittest.main()
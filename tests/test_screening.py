@@ -0,0 +1,140 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import fwrf
+import screening as pscr
+
+
+def make_problem(seed=0, n=200, nf=6, nt=12, nv=9, val_test_size=60):
+    '''voxels driven by candidate 2 * v for the first 6, and pure noise for the rest.'''
+    rng = np.random.RandomState(seed)
+    mst_data = rng.normal(size=(n, nf, 1, nt)).astype(np.float32) * 2. + 1.
+    voxels = rng.normal(size=(n, nv))
+    for v in range(6):
+        voxels[:, v] += 3. * mst_data[:,:,0,2*v].dot(rng.normal(size=nf))
+    return mst_data, voxels, val_test_size
+
+
+class screen_voxels_test(unittest.TestCase):
+    def test_recovers_the_true_candidates(self):
+        mst_data, voxels, val_test_size = make_problem()
+        screen = pscr.screen_voxels(mst_data, voxels, val_test_size=val_test_size)
+        np.testing.assert_array_equal(screen['candidates'][:6], 2*np.arange(6))
+        self.assertTrue(np.all(screen['scores'][:6] > 0.5))
+        self.assertTrue(np.all(screen['scores'][6:] < 0.2))
+        ## the weights apply to the raw columns of mst_data, and reproduce the holdout error
+        W, b = screen['w_params']
+        pred = np.einsum('nfv,vf->nv', mst_data[-val_test_size:,:,0,screen['candidates']], W) + b
+        np.testing.assert_allclose(np.mean(np.square(voxels[-val_test_size:] - pred), axis=0), screen['val_mse'], rtol=1e-3)
+
+    def test_batch_size_invariance(self):
+        mst_data, voxels, val_test_size = make_problem(seed=1)
+        specs = [[(0., 20.), (0., 20.), (0.5, 8.)], [fwrf.linspace(3), fwrf.linspace(2), fwrf.logspace(2)]]
+        whole = pscr.screen_voxels(mst_data, voxels, specs, val_test_size=val_test_size, reduce_dim=4)
+        for batch_size in (1, 4):
+            batched = pscr.screen_voxels(mst_data, voxels, specs, val_test_size=val_test_size, reduce_dim=4, batch_size=batch_size)
+            for key in ['scores', 'val_mse']:
+                np.testing.assert_allclose(batched[key], whole[key], rtol=1e-5)
+            np.testing.assert_array_equal(batched['candidates'], whole['candidates'])
+            np.testing.assert_allclose(batched['w_params'][0], whole['w_params'][0], rtol=1e-4, atol=1e-6)
+        np.testing.assert_array_equal(whole['selection'], pscr.coarse_candidates(specs))
+        self.assertTrue(np.all(np.in1d(whole['candidates'], whole['selection'])))
+
+
+class select_voxels_test(unittest.TestCase):
+    def test_threshold_and_top_k(self):
+        scores = np.array([0.3, -0.1, 0.5, 0.05, 0.5, 0.2])
+        np.testing.assert_array_equal(pscr.select_voxels(scores), np.arange(6))
+        np.testing.assert_array_equal(pscr.select_voxels(scores, threshold=0.1), [0, 2, 4, 5])
+        np.testing.assert_array_equal(pscr.select_voxels(scores, top_k=3), [0, 2, 4])
+        np.testing.assert_array_equal(pscr.select_voxels(scores, threshold=0.1, top_k=2), [2, 4])
+
+    def test_coarse_candidates(self):
+        specs = [[(0., 20.), (0., 20.), (0.5, 8.)], [fwrf.linspace(5), fwrf.linspace(4), fwrf.logspace(3)]]
+        coarse = pscr.coarse_candidates(specs, step=(2, 2, 1))
+        self.assertEqual(len(coarse), 3*2*3)
+        ix, iy, is_ = coarse // (4*3), (coarse // 3) % 4, coarse % 3
+        self.assertTrue(np.all(ix % 2==0) and np.all(iy % 2==0))
+        self.assertEqual(sorted(set(is_)), [0, 1, 2])
+
+
+def fake_learn_params(mst_data, voxels, w_params, val_test_size=100, l2=0.0, **kwargs):
+    '''the outputs of fwrf.learn_params, with every voxel on candidate 0 and a score of its index.'''
+    nv, nt = voxels.shape[1], mst_data.shape[3]
+    return (np.zeros(shape=(1, nv, nt), dtype=np.float32), np.arange(nv, dtype=np.float32), np.zeros(nv, dtype=int),
+            np.zeros(nv, dtype=int), [np.ones_like(p) for p in w_params])
+
+
+def fake_kout_learn_params(mst_data, voxels, val_sample_order, w_params, val_part_size=1, **kwargs):
+    '''a model of fwrf.kout_learn_params with two parts, the same fake fit in both.'''
+    n, nv = voxels.shape
+    model = {'n_parts': 2, 'val_pred': np.ones(shape=(n, nv), dtype=np.float32), 'val_cc': np.ones(nv, dtype=np.float32)}
+    for k in range(2):
+        _, scores, epochs, candidates, params = fake_learn_params(mst_data, voxels, w_params)
+        val_mask = np.zeros(n, dtype=bool)
+        val_mask[val_sample_order[k*n//2:(k+1)*n//2]] = True
+        model[k] = {'scores': scores, 'epochs': epochs, 'candidates': candidates, 'w_params': params,
+                    'val_mask': val_mask, 'val_cc': np.ones(nv, dtype=np.float32)}
+    return model
+
+
+class screened_fit_test(unittest.TestCase):
+    def setUp(self):
+        self.learn_params, self.kout_learn_params = fwrf.learn_params, fwrf.kout_learn_params
+        fwrf.learn_params, fwrf.kout_learn_params = fake_learn_params, fake_kout_learn_params
+        self.mst_data, self.voxels, self.val_test_size = make_problem(seed=2)
+        nv, nf = self.voxels.shape[1], self.mst_data.shape[1]
+        self.w_params = [np.zeros(shape=(nv, nf), dtype=np.float32), np.zeros(nv, dtype=np.float32)]
+        self.screen = pscr.screen_voxels(self.mst_data, self.voxels, val_test_size=self.val_test_size)
+
+    def tearDown(self):
+        fwrf.learn_params, fwrf.kout_learn_params = self.learn_params, self.kout_learn_params
+
+    def check_proxy(self, selected, candidates, w_params):
+        unselected = np.setdiff1d(np.arange(self.voxels.shape[1]), selected)
+        np.testing.assert_array_equal(candidates[selected], 0)
+        np.testing.assert_array_equal(candidates[unselected], self.screen['candidates'][unselected])
+        np.testing.assert_array_equal(w_params[0][selected], 1)
+        np.testing.assert_array_equal(w_params[0][unselected], self.screen['w_params'][0][unselected])
+        return unselected
+
+    def test_screened_learn_params(self):
+        results = pscr.screened_learn_params(self.mst_data, self.voxels, self.w_params, top_k=4, screen=self.screen,
+                                             val_test_size=self.val_test_size)
+        val_scores, best_scores, best_epochs, best_candidates, best_w_params, selected, screen = results
+        np.testing.assert_array_equal(selected, pscr.select_voxels(self.screen['scores'], top_k=4))
+        self.assertTrue(screen is self.screen)
+        unselected = self.check_proxy(selected, best_candidates, best_w_params)
+        ## the full fit scores of the selected voxels only, the proxy scores are in the screen
+        np.testing.assert_array_equal(best_scores[selected], np.arange(4))
+        self.assertTrue(np.all(np.isnan(best_scores[unselected])))
+        self.assertTrue(np.all(np.isnan(val_scores[:,unselected])))
+        np.testing.assert_array_equal(best_epochs[unselected], -1)
+
+    def test_screened_kout_learn_params(self):
+        n, nv = self.voxels.shape
+        order = np.random.RandomState(0).permutation(n)
+        model = pscr.screened_kout_learn_params(self.mst_data, self.voxels, order, self.w_params, threshold=0.5,
+                                                screen=self.screen, val_part_size=n//2)
+        selected = model['selected']
+        np.testing.assert_array_equal(selected, pscr.select_voxels(self.screen['scores'], threshold=0.5))
+        self.assertTrue(0 < len(selected) < nv)
+        self.assertEqual(model['val_pred'].shape, (n, nv))
+        self.assertEqual(model['val_cc'].shape, (nv,))
+        for k in range(model['n_parts']):
+            unselected = self.check_proxy(selected, model[k]['candidates'], model[k]['w_params'])
+            self.assertEqual(model[k]['val_mask'].shape, (n,))
+            self.assertEqual(model[k]['val_mask'].sum(), n//2)
+            np.testing.assert_array_equal(model[k]['scores'][selected], np.arange(len(selected)))
+            np.testing.assert_array_equal(model[k]['epochs'][unselected], -1)
+            for key in ['scores', 'val_cc']:
+                self.assertTrue(np.all(np.isnan(model[k][key][unselected])))
+        self.assertTrue(np.all(np.isnan(model['val_pred'][:,unselected])) and np.all(model['val_pred'][:,selected]==1))
+        self.assertTrue(np.all(np.isnan(model['val_cc'][unselected])))
+
+
+if __name__ == '__main__':
+    unittest.main()
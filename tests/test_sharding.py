@@ -0,0 +1,145 @@
+import os
+import sys
+import shutil
+import time
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import sharding
+
+
+def make_problem(seed=0, n=120, nf=4, nt=6, nv=10):
+    '''voxel v is driven by candidate v % nt.'''
+    rng = np.random.RandomState(seed)
+    mst_data = rng.normal(size=(n, nf, 1, nt)).astype(np.float32)
+    voxels = 0.3 * rng.normal(size=(n, nv))
+    for v in range(nv):
+        voxels[:, v] += mst_data[:,:,0,v % nt].dot(rng.normal(size=nf) + 2.)
+    return mst_data, voxels.astype(np.float32)
+
+
+class sharding_test(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_claim_and_requeue(self):
+        mst_data, voxels = make_problem()
+        self.assertEqual(sharding.create_job(self.root, mst_data, voxels, voxels_per_unit=3, method='closed_form'), 4)
+        claimed = [sharding.claim(self.root) for i in range(4)]
+        self.assertEqual([name for name,unit in claimed], ['unit_%06d.pkl' % i for i in range(4)])
+        self.assertEqual([unit['voxels'] for name,unit in claimed], [(0, 3), (3, 6), (6, 9), (9, 10)])
+        self.assertIsNone(sharding.claim(self.root))
+        self.assertEqual(sharding.status(self.root), {'todo': 0, 'claimed': 4, 'done': 0, 'failed': 0})
+        self.assertEqual(sharding.requeue(self.root, stale_seconds=3600), 0)
+        self.assertEqual(sharding.requeue(self.root, stale_seconds=-1), 4)
+        self.assertEqual(sharding.claim(self.root)[0], 'unit_000000.pkl')
+
+    def test_requeued_claim_stays_with_its_new_worker(self):
+        mst_data, voxels = make_problem()
+        sharding.create_job(self.root, mst_data, voxels, voxels_per_unit=10, method='closed_form', val_test_size=30)
+        name, unit = sharding.claim(self.root, 'slow')
+        self.assertEqual(sharding.owner(self.root, name), 'slow')
+        ## the slow worker is taken for dead, and the unit claimed again
+        self.assertEqual(sharding.requeue(self.root, stale_seconds=-1), 1)
+        self.assertEqual(sharding.claim(self.root, 'fast')[0], name)
+        self.assertFalse(sharding.release(self.root, name, 'slow', 'done'))
+        self.assertEqual(sharding.owner(self.root, name), 'fast')
+        self.assertTrue(sharding.release(self.root, name, 'fast', 'done'))
+        ## completed elsewhere: the claim is gone
+        self.assertFalse(sharding.release(self.root, name, 'slow', 'failed'))
+        self.assertEqual(sharding.status(self.root), {'todo': 0, 'claimed': 0, 'done': 1, 'failed': 0})
+
+    def test_worker_leaves_a_stolen_unit(self):
+        mst_data, voxels = make_problem()
+        sharding.create_job(self.root, mst_data, voxels, voxels_per_unit=10, method='closed_form', val_test_size=30)
+        job = sharding._read(os.path.join(self.root, 'job.pkl'))
+        fit_unit = sharding.fit_unit
+        def stolen(job, unit, mst_data, voxels):
+            ## requeued and claimed by another worker during the fit
+            sharding.requeue(self.root, stale_seconds=-1)
+            sharding.claim(self.root, 'other')
+            return fit_unit(job, unit, mst_data, voxels)
+        sharding.fit_unit = stolen
+        try:
+            self.assertEqual(sharding.run_worker(self.root, worker='slow'), 0)
+        finally:
+            sharding.fit_unit = fit_unit
+        self.assertEqual(sharding.status(self.root), {'todo': 0, 'claimed': 1, 'done': 0, 'failed': 0})
+        self.assertEqual(sharding.owner(self.root, 'unit_000000.pkl'), 'other')
+        self.assertEqual(os.listdir(os.path.join(self.root, 'failed')), [])
+        ## the other worker completes it
+        self.assertTrue(sharding.release(self.root, 'unit_000000.pkl', 'other', 'done'))
+        np.testing.assert_array_equal(sharding.merge(self.root)[3], np.arange(10) % 6)
+
+    def test_heartbeat(self):
+        mst_data, voxels = make_problem()
+        sharding.create_job(self.root, mst_data, voxels, voxels_per_unit=5, method='closed_form')
+        mine, _ = sharding.claim(self.root, 'a')
+        other, _ = sharding.claim(self.root, 'b')
+        old = time.time() - 1000
+        for name in (mine, other):
+            os.utime(os.path.join(self.root, 'claimed', name), (old, old))
+        with sharding.heartbeat(self.root, mine, 'a', interval=0.01):
+            with sharding.heartbeat(self.root, other, 'a', interval=0.01): # not a's claim
+                time.sleep(0.2)
+        self.assertGreater(os.path.getmtime(os.path.join(self.root, 'claimed', mine)), old + 500)
+        self.assertLess(os.path.getmtime(os.path.join(self.root, 'claimed', other)), old + 500)
+        self.assertEqual(sharding.requeue(self.root, stale_seconds=500), 1)
+
+    def test_closed_form_merge(self):
+        mst_data, voxels = make_problem()
+        kwargs = {'val_test_size': 30, 'l2': [0.1, 10.]}
+        sharding.create_job(self.root, mst_data, voxels, voxels_per_unit=3, method='closed_form', **kwargs)
+        ## two workers, the second one finishing the queue
+        self.assertEqual(sharding.run_worker(self.root, worker='a', max_units=1), 1)
+        self.assertEqual(sharding.run_worker(self.root, worker='b'), 3)
+        val_scores, best_scores, best_epochs, best_candidates, (W, b) = sharding.merge(self.root)
+        self.assertEqual(val_scores.shape, (1, 10, 6))
+        np.testing.assert_array_equal(best_candidates, np.arange(10) % 6)
+        ## every voxel range in its place, as fitted by a single unit
+        job = sharding._read(os.path.join(self.root, 'job.pkl'))
+        for i,(v0, v1) in enumerate([(0, 3), (3, 6), (6, 9), (9, 10)]):
+            r = sharding.fit_unit(job, {'id': i, 'voxels': (v0, v1), 'fold': None}, mst_data, voxels)['results']
+            np.testing.assert_allclose(best_scores[v0:v1], r[1], rtol=1e-5)
+            np.testing.assert_allclose(W[v0:v1], r[4][0], rtol=1e-5)
+            np.testing.assert_allclose(val_scores[:, v0:v1], r[0], rtol=1e-5)
+
+    def test_failed_units(self):
+        mst_data, voxels = make_problem()
+        ## no holdout samples: the closed form fit raises
+        sharding.create_job(self.root, mst_data, voxels, voxels_per_unit=5, method='closed_form', val_test_size=0)
+        self.assertEqual(sharding.run_worker(self.root, worker='a'), 0)
+        self.assertEqual(sharding.status(self.root)['failed'], 2)
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'failed', 'unit_000000.txt')))
+        self.assertRaises(AssertionError, sharding.merge, self.root)
+        self.assertEqual(sharding.requeue(self.root, failed=True), 2)
+        self.assertEqual(sharding.status(self.root)['todo'], 2)
+
+    def test_kout_merge(self):
+        mst_data, voxels = make_problem(n=120)
+        order = np.random.RandomState(1).permutation(120)
+        folds = sharding.kout_folds(order, 40)
+        self.assertEqual(len(folds), 3)
+        self.assertRaises(AssertionError, sharding.kout_folds, order, 50)
+        sharding.create_job(self.root, mst_data, voxels, voxels_per_unit=4, folds=folds, method='closed_form', val_test_size=20, l2=1.)
+        self.assertEqual(sharding.run_worker(self.root), 9)
+        model = sharding.merge(self.root)
+        self.assertEqual(model['n_parts'], 3)
+        masks = np.array([model[k]['val_mask'] for k in range(3)])
+        np.testing.assert_array_equal(masks.sum(axis=0), np.ones(120))
+        for k in range(3):
+            np.testing.assert_array_equal(np.where(masks[k])[0], np.sort(folds[k]))
+            ## the held out predictions of a part come from its own weights
+            rows = np.sort(folds[k])
+            c, (W, b) = model[k]['candidates'], model[k]['w_params']
+            np.testing.assert_allclose(model['val_pred'][rows], np.einsum('nfv,vf->nv', mst_data[rows][:,:,0,c], W) + b, rtol=1e-4, atol=1e-4)
+        self.assertTrue(np.all(model['val_cc'] > 0.9))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import sufficient_stats as pss
+
+
+def make_problem(seed=0, n=150, nf=5, nt=4, nv=6, trn_size=110):
+    rng = np.random.RandomState(seed)
+    rows = rng.normal(size=(n, nf, nt)) * rng.uniform(0.5, 3., size=(1, nf, nt)) + rng.normal(size=(1, nf, nt))
+    Y = rng.normal(size=(n, nv))
+    Y[:, :3] += np.einsum('nf,fv->nv', rows[:,:,2], rng.normal(size=(nf, 3)))
+    stats = {'fit': pss.empty_stats(nf, nv, nt), 'holdout': pss.empty_stats(nf, nv, nt)}
+    pss.update_stats(stats['fit'], rows[:trn_size], Y[:trn_size])
+    pss.update_stats(stats['holdout'], rows[trn_size:], Y[trn_size:])
+    return rows, Y, stats, trn_size
+
+
+def reference_fit(rows, Y, trn_size, lam, epsilon=1e-6):
+    '''ridge fit of every voxel on every candidate from the z-scored samples, with the bias left unpenalized.'''
+    Z = (rows - rows.mean(axis=0)) / (rows.std(axis=0) + epsilon)
+    n, nf, nt = Z.shape
+    W, b, scores = np.zeros((nt, Y.shape[1], nf)), np.zeros((nt, Y.shape[1])), np.zeros((Y.shape[1], nt))
+    for t in range(nt):
+        Zt, Yt = Z[:trn_size,:,t], Y[:trn_size]
+        if lam==0:
+            sol = np.linalg.lstsq(np.concatenate([Zt, np.ones((trn_size, 1))], axis=1), Yt, rcond=None)[0]
+            W[t], b[t] = sol[:nf].T, sol[nf]
+        else:
+            zbar, ybar = Zt.mean(axis=0), Yt.mean(axis=0)
+            W[t] = np.linalg.solve((Zt-zbar).T.dot(Zt-zbar) + lam*np.eye(nf), (Zt-zbar).T.dot(Yt-ybar)).T
+            b[t] = ybar - W[t].dot(zbar)
+        scores[:,t] = np.mean(np.square(Y[trn_size:] - Z[trn_size:,:,t].dot(W[t].T) - b[t]), axis=0)
+    return W, b, scores, Z
+
+
+class fit_from_stats_test(unittest.TestCase):
+    def test_matches_lstsq(self):
+        rows, Y, stats, trn_size = make_problem()
+        for lam in (0., 20.):
+            val_scores, best_scores, best_l2, best_candidates, (W, b) = pss.fit_from_stats(stats, l2=lam)
+            W_ref, b_ref, scores_ref, _ = reference_fit(rows, Y, trn_size, lam)
+            np.testing.assert_allclose(val_scores, scores_ref, rtol=1e-4)
+            np.testing.assert_array_equal(best_candidates, np.argmin(scores_ref, axis=1))
+            v = np.arange(len(best_candidates))
+            np.testing.assert_allclose(W, W_ref[best_candidates, v], rtol=1e-4, atol=1e-5)
+            np.testing.assert_allclose(b, b_ref[best_candidates, v], rtol=1e-4, atol=1e-5)
+        self.assertTrue(np.all(best_candidates[:3]==2))
+
+    def test_penalty_selection(self):
+        rows, Y, stats, trn_size = make_problem(seed=1)
+        l2s = [0., 20., 1000.]
+        _, best_scores, best_l2, _, _ = pss.fit_from_stats(stats, l2=l2s, output_val_scores=False)
+        ref = np.min([reference_fit(rows, Y, trn_size, lam)[2] for lam in l2s], axis=(0, 2))
+        np.testing.assert_allclose(best_scores, ref, rtol=1e-4)
+
+    def test_raw_w_params(self):
+        rows, Y, stats, trn_size = make_problem(seed=2)
+        _, _, _, candidates, w_params = pss.fit_from_stats(stats, l2=1.)
+        _, _, _, Z = reference_fit(rows, Y, trn_size, 1.)
+        v = np.arange(len(candidates))
+        expected = np.einsum('nfv,vf->nv', Z[:,:,candidates], w_params[0]) + w_params[1]
+        W_raw, b_raw = pss.raw_w_params(stats, candidates, w_params)
+        np.testing.assert_allclose(np.einsum('nfv,vf->nv', rows[:,:,candidates], W_raw) + b_raw, expected, rtol=1e-4, atol=1e-4)
+
+
+class accumulation_test(unittest.TestCase):
+    def test_voxel_stats_and_merge(self):
+        rows, Y, stats, trn_size = make_problem(seed=3)
+        nf, nt = rows.shape[1:]
+        s = pss.update_stats(pss.empty_stats(nf, 0, nt), rows[:trn_size], Y[:trn_size,:0])
+        completed = pss.voxel_stats(s, rows[:trn_size], Y[:trn_size])
+        for k in stats['fit'].keys():
+            np.testing.assert_allclose(completed[k], stats['fit'][k], rtol=1e-12)
+        halves = []
+        for part in (slice(0, 50), slice(50, None)):
+            r, y = rows[:trn_size][part], Y[:trn_size][part]
+            halves += [{'fit': pss.update_stats(pss.empty_stats(nf, Y.shape[1], nt), r, y)},]
+        merged = pss.merge_stats(halves)
+        for k in stats['fit'].keys():
+            np.testing.assert_allclose(merged['fit'][k], stats['fit'][k], rtol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()